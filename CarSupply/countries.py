@@ -0,0 +1,29 @@
+"""
+Country choices shared by Manufacturer.country and Dealership.country.
+
+countries-django.json is read from the project directory (not the current
+working directory) the first time the choices are needed and then kept for
+the life of the process, so every module shares one parsed copy.
+"""
+
+import functools
+import json
+import os
+
+from django.conf import settings
+
+
+def json_path():
+    return os.path.join(settings.BASE_DIR, "countries-django.json")
+
+
+@functools.lru_cache(maxsize=None)
+def get_countries():
+    """ Returns the [code, name] pairs used as country choices. """
+
+    with open(json_path(), encoding="utf-8") as file:
+        return json.load(file)
+
+
+def get_country_codes():
+    return [code for code, _ in get_countries()]
@@ -0,0 +1,295 @@
+"""
+Per-view request metrics.
+
+RequestMetricsMiddleware measures every request and adds it to this
+process's totals for the URL name that handled it:
+
+- latency, as a histogram,
+- number of SQL queries and the time spent running them,
+- template render time (templates loaded through InstrumentedTemplates,
+  the TEMPLATES backend in settings.py),
+- response size.
+
+The totals are served in the Prometheus text format at /metrics to staff
+users, or to scrapers sending "Authorization: Bearer <METRICS_TOKEN>", along
+with the catalogue page cache hits and misses (see inventory.page_cache).
+Like those, they are kept per process, so each server process has to be
+scraped (or its totals summed) separately.
+
+Requests slower than SLOW_REQUEST_SECONDS are also logged as one JSON line
+on the "CarSupply.metrics" logger. Nothing is measured, and /metrics is
+not found, unless REQUEST_METRICS = True.
+
+The latency of a streaming response covers producing the response, not
+sending it; its size is added as the content is sent.
+"""
+
+import contextvars
+import hmac
+import json
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import Http404, HttpResponse
+from django.template.backends.django import DjangoTemplates, Template
+from django.views import View
+
+from users.permissions import UserIsStaff
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# View label of requests that matched no URL pattern
+UNRESOLVED = "<unresolved>"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_requests = Counter()
+_durations = defaultdict(lambda: [0] * len(BUCKETS))
+_totals = defaultdict(Counter)
+_lock = threading.Lock()
+
+# Measurements of the request being handled
+_current = contextvars.ContextVar("request_metrics", default=None)
+
+
+class RequestMeasurement:
+    """ What one request has spent so far. """
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0
+        self.render_seconds = 0
+        self.render_depth = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        """ connection.execute_wrapper() timing every query. """
+
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_seconds += time.perf_counter() - start
+            self.queries += 1
+
+
+class TimedTemplate(Template):
+    """ Template adding its render time to the current request's measurement. """
+
+    def render(self, context=None, request=None):
+        measurement = _current.get()
+        # Templates rendered while rendering another one (e.g. crispy
+        # forms) are already included in the outer render
+        if measurement is None or measurement.render_depth:
+            return super().render(context, request)
+        measurement.render_depth += 1
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            measurement.render_seconds += time.perf_counter() - start
+            measurement.render_depth -= 1
+
+
+class InstrumentedTemplates(DjangoTemplates):
+    """ The Django template backend, with render times measured. """
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code).template, self)
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name).template, self)
+
+
+def observe(view, method, status, seconds, queries=0, db_seconds=0, render_seconds=0,
+            size=0):
+    """ Adds a request to the totals of view. """
+
+    with _lock:
+        _requests[view, method, status] += 1
+        buckets = _durations[view]
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                buckets[index] += 1
+        totals = _totals[view]
+        totals["seconds"] += seconds
+        totals["queries"] += queries
+        totals["db_seconds"] += db_seconds
+        totals["render_seconds"] += render_seconds
+        totals["bytes"] += size
+
+
+def _add_bytes(view, size):
+    with _lock:
+        _totals[view]["bytes"] += size
+
+
+def reset():
+    """ Drops all totals, e.g. between tests. """
+
+    with _lock:
+        _requests.clear()
+        _durations.clear()
+        _totals.clear()
+
+
+def _label(value):
+    return '"%s"' % str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels):
+    return "{%s}" % ",".join("%s=%s" % (name, _label(value)) for name, value in labels.items())
+
+
+def render():
+    """ Returns the totals in the Prometheus text exposition format. """
+
+    from inventory import page_cache
+
+    with _lock:
+        requests = dict(_requests)
+        durations = {view: list(buckets) for view, buckets in _durations.items()}
+        totals = {view: dict(values) for view, values in _totals.items()}
+    counts = Counter()
+    for (view, _, _), count in requests.items():
+        counts[view] += count
+
+    lines = [
+        "# HELP carsupply_requests_total Requests handled, by view, method and status.",
+        "# TYPE carsupply_requests_total counter",
+    ]
+    for (view, method, status), count in sorted(requests.items()):
+        lines.append("carsupply_requests_total%s %d" % (
+            _labels(view=view, method=method, status=status), count))
+
+    lines += [
+        "# HELP carsupply_request_duration_seconds Request latency, by view.",
+        "# TYPE carsupply_request_duration_seconds histogram",
+    ]
+    for view, buckets in sorted(durations.items()):
+        for bound, count in zip(BUCKETS, buckets):
+            lines.append("carsupply_request_duration_seconds_bucket%s %d" % (
+                _labels(view=view, le=bound), count))
+        lines.append("carsupply_request_duration_seconds_bucket%s %d" % (
+            _labels(view=view, le="+Inf"), counts[view]))
+        lines.append("carsupply_request_duration_seconds_sum%s %.6f" % (
+            _labels(view=view), totals[view]["seconds"]))
+        lines.append("carsupply_request_duration_seconds_count%s %d" % (
+            _labels(view=view), counts[view]))
+
+    for name, key, help_text, format in (
+            ("carsupply_request_queries_total", "queries", "SQL queries run", "%d"),
+            ("carsupply_request_db_seconds_total", "db_seconds",
+             "Time spent running SQL queries", "%.6f"),
+            ("carsupply_request_render_seconds_total", "render_seconds",
+             "Time spent rendering templates", "%.6f"),
+            ("carsupply_response_bytes_total", "bytes", "Response body bytes sent", "%d")):
+        lines += [
+            "# HELP %s %s, by view." % (name, help_text),
+            "# TYPE %s counter" % name,
+        ]
+        for view, values in sorted(totals.items()):
+            lines.append(("%s%s " + format) % (name, _labels(view=view), values[key]))
+
+    lines += [
+        "# HELP carsupply_catalogue_cache_requests_total Catalogue page cache lookups.",
+        "# TYPE carsupply_catalogue_cache_requests_total counter",
+    ]
+    for (catalogue, outcome), count in sorted(page_cache.stats().items()):
+        lines.append("carsupply_catalogue_cache_requests_total%s %d" % (
+            _labels(catalogue=catalogue, outcome=outcome), count))
+    return "\n".join(lines) + "\n"
+
+
+def _view_name(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return UNRESOLVED
+    return match.view_name
+
+
+def _counted(view, content):
+    for chunk in content:
+        _add_bytes(view, len(chunk))
+        yield chunk
+
+
+class RequestMetricsMiddleware:
+    """
+    Measures every request; see the module docstring. Should come first in
+    MIDDLEWARE, so that the other middleware is measured too.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, "REQUEST_METRICS", False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.slow_seconds = getattr(settings, "SLOW_REQUEST_SECONDS", None)
+
+    def __call__(self, request):
+        measurement = RequestMeasurement()
+        token = _current.set(measurement)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(measurement))
+                response = self.get_response(request)
+        finally:
+            seconds = time.perf_counter() - start
+            _current.reset(token)
+
+        view = _view_name(request)
+        if response.streaming:
+            size = 0
+            response.streaming_content = _counted(view, response.streaming_content)
+        else:
+            size = len(response.content)
+        observe(view, request.method, response.status_code, seconds, measurement.queries,
+                measurement.db_seconds, measurement.render_seconds, size)
+
+        if self.slow_seconds is not None and seconds >= self.slow_seconds:
+            logger.warning(json.dumps({
+                "event": "slow_request",
+                "view": view,
+                "method": request.method,
+                "path": request.path,
+                "status": response.status_code,
+                "seconds": round(seconds, 4),
+                "queries": measurement.queries,
+                "db_seconds": round(measurement.db_seconds, 4),
+                "render_seconds": round(measurement.render_seconds, 4),
+                "bytes": size if not response.streaming else None,
+            }))
+        return response
+
+
+class MetricsView(UserIsStaff, View):
+    """
+    Serves the request metrics in the Prometheus text format to staff
+    users, and to requests bearing settings.METRICS_TOKEN when it is set.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        if not getattr(settings, "REQUEST_METRICS", False):
+            raise Http404
+        return super().dispatch(request, *args, **kwargs)
+
+    def test_func(self):
+        token = getattr(settings, "METRICS_TOKEN", None)
+        header = self.request.META.get("HTTP_AUTHORIZATION", "")
+        if token and hmac.compare_digest(header.encode(), ("Bearer %s" % token).encode()):
+            return True
+        return super().test_func()
+
+    def get(self, request):
+        return HttpResponse(render(), content_type=CONTENT_TYPE)
@@ -44,7 +44,8 @@ INSTALLED_APPS = [
     'dealerships',
     'blueprints',
     'deals',
-    'inventory',
+    'inventory.apps.InventoryConfig',
+    'ledger',
 
 
     'crispy_forms',
@@ -55,12 +56,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'CarSupply.metrics.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'users.middleware.PermissionCacheMiddleware',
+    'users.middleware.AffiliationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -69,7 +73,8 @@ ROOT_URLCONF = 'CarSupply.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates, with render times reported by CarSupply.metrics
+        'BACKEND': 'CarSupply.metrics.InstrumentedTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -111,6 +116,68 @@ DATABASES = {
 db_from_env = dj_database_url.config(conn_max_age=600)
 DATABASES['default'].update(db_from_env)
 
+# Caches
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+#
+# The catalogue pages (see inventory.page_cache) are cached per process in
+# local memory by default. When running several processes, point
+# CATALOGUE_CACHE_BACKEND and CATALOGUE_CACHE_LOCATION at a shared cache,
+# e.g. django_redis.cache.RedisCache and redis://localhost:6379/1, so that
+# invalidations reach every process. Otherwise stock changed by another
+# process (a worker, an import, another server process) shows up on cached
+# pages, and ends 304 Not Modified answers (see inventory.versions), within
+# CATALOGUE_CACHE_TIMEOUT seconds.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'catalogue': {
+        'BACKEND': os.environ.get(
+            'CATALOGUE_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CATALOGUE_CACHE_LOCATION', 'catalogue'),
+        'TIMEOUT': int(os.environ.get('CATALOGUE_CACHE_TIMEOUT', 60)),
+    },
+}
+
+# Affiliations
+#
+# users.affiliation keeps the pk of the manufacturer or dealership of a user
+# in their session, so that list views can filter by it without a query.
+
+AFFILIATION_SESSION_CACHE = os.environ.get(
+    'AFFILIATION_SESSION_CACHE', 'true').lower() in ('1', 'true', 'yes')
+
+# Request metrics
+#
+# CarSupply.metrics records the latency, SQL queries, database and template
+# time and response size of every request per URL name, and serves them to
+# staff users at /metrics in the Prometheus text format. Scrapers can send
+# "Authorization: Bearer <METRICS_TOKEN>" instead of logging in. Requests
+# taking SLOW_REQUEST_SECONDS or longer are logged as JSON lines. Off
+# unless REQUEST_METRICS=true, as it times every query and template.
+
+REQUEST_METRICS = os.environ.get('REQUEST_METRICS', 'false').lower() in ('1', 'true', 'yes')
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', 1.0))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'CarSupply.metrics': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -165,7 +232,47 @@ LOGOUT_REDIRECT_URL = '/user/'
 
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
+# To derive object permissions from ownership instead of storing guardian
+# rows, replace 'guardian.backends.ObjectPermissionBackend' with
+# 'users.permissions.OwnershipPermissionBackend' and run
+# `python manage.py migrate_object_permissions` to drop the old rows.
+# ModelBackend stays after CachedModelBackend so that sessions logged in
+# with it before the cached backend keep working; those users are read from
+# the database until they log in again.
 AUTHENTICATION_BACKENDS = [
+    'users.user_cache.CachedModelBackend',
     'django.contrib.auth.backends.ModelBackend',
     'guardian.backends.ObjectPermissionBackend',
 ]
+
+# Sessions and users
+#
+# With CACHED_SESSIONS=true, sessions (the cached_db engine) and the users
+# logged in with them (users.user_cache) are read from the "sessions" cache
+# instead of the database, which saves two queries on every authenticated
+# request. Both are still written to the database. The default cache lives
+# in each server process's memory, where a logout or a balance change made
+# in one process is not seen by the others; when running several
+# processes, point them at a shared cache, e.g. SESSION_CACHE_BACKEND=
+# django_redis.cache.RedisCache and SESSION_CACHE_LOCATION=
+# redis://localhost:6379/2.
+
+CACHED_SESSIONS = os.environ.get('CACHED_SESSIONS', 'false').lower() in ('1', 'true', 'yes')
+USER_CACHE_TIMEOUT = int(os.environ.get('USER_CACHE_TIMEOUT', 300))
+CACHES['sessions'] = {
+    'BACKEND': os.environ.get(
+        'SESSION_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+    'LOCATION': os.environ.get('SESSION_CACHE_LOCATION', 'sessions'),
+}
+if CACHED_SESSIONS:
+    SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+    SESSION_CACHE_ALIAS = 'sessions'
+
+# Stock reservations
+#
+# Making a deal reserves its cars for RESERVATION_TTL seconds, or until the
+# deal is accepted or rejected (see inventory.reservations). Expired
+# reservations are released by "python manage.py release_reservations",
+# the sweeper process of the Procfile.
+
+RESERVATION_TTL = int(os.environ.get('RESERVATION_TTL', 7 * 24 * 3600))
@@ -0,0 +1,356 @@
+"""
+Query count and latency benchmarks for every view in CarSupply/urls.py.
+
+Each view is requested once against a fixed dataset seeded with
+populate.seed_database, and the number of queries and the wall-clock time
+are checked against a ceiling. Set BENCHMARK_REPORT to a file path to also
+write the measurements as JSON, e.g.
+
+    BENCHMARK_REPORT=bench.json python manage.py test CarSupply
+
+and diff the file between commits.
+
+MetricsTestCase covers the per-view request metrics of CarSupply.metrics.
+"""
+
+import json
+import os
+import time
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLResolver, get_resolver, reverse
+from guardian.shortcuts import assign_perm
+
+from blueprints.models import Car
+from CarSupply import metrics
+from dealerships.models import Dealership
+from deals.models import RetailDeal, WholesaleDeal
+from inventory import reservations
+from inventory.models import RetailCar, WholesaleCar
+from manufacturers.models import Manufacturer, ManufacturingOrder
+from populate import seed_database
+from users.models import User
+
+
+CARS = 300
+DEALERSHIPS = 5
+CUSTOMERS = 3
+DEALS = 100
+
+# Django's own authentication views
+EXCLUDED_URL_NAMES = {
+    "user:login", "user:logout", "user:password_change", "user:password_change_done",
+    "user:password_reset", "user:password_reset_done", "user:password_reset_confirm",
+    "user:password_reset_complete",
+}
+
+# Default wall-clock ceiling for a single request, in seconds
+SECONDS = 1.0
+
+
+def url_names(patterns=None, namespace=None):
+    """ Yields the names of all URL patterns outside the admin site. """
+
+    if patterns is None:
+        patterns = get_resolver().url_patterns
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            if pattern.namespace == "admin":
+                continue
+            yield from url_names(pattern.url_patterns, pattern.namespace or namespace)
+        elif pattern.name:
+            yield "%s:%s" % (namespace, pattern.name) if namespace else pattern.name
+
+
+class Case:
+    """
+    A benchmarked request.
+
+    Parameters:
+        name (str): URL name
+        user (str): attribute of the test case holding the user to log in as
+        kwargs (func): returns the URL kwargs given the test case
+        method (str): "get" or "post"
+        data (func): returns the POST data given the test case
+        status (int): expected status code
+        queries (int): maximum number of queries
+        seconds (float): maximum wall-clock time
+    """
+
+    def __init__(self, name, user, queries, kwargs=None, method="get", data=None,
+                 status=200, seconds=SECONDS):
+        self.name = name
+        self.user = user
+        self.queries = queries
+        self.kwargs = kwargs or (lambda test: {})
+        self.method = method
+        self.data = data or (lambda test: {})
+        self.status = status
+        self.seconds = seconds
+
+
+CASES = [
+    Case("home", None, 0),
+    Case("user:register", None, 0),
+    Case("user:profile", "customer", 2),
+    Case("user:profile", "manufacturer_admin", 3),
+    Case("user:profile", "dealership_admin", 3),
+    Case("user:add_balance", "customer", 2),
+    Case("user:add_balance", "customer", 6, method="post", data=lambda t: {"balance": 10},
+         status=302),
+
+    Case("manufacturers:create", "manufacturer_admin", 3),
+    Case("manufacturers:create", "manufacturer_admin", 19, method="post", data=lambda t: {
+        "car": t.blueprint.pk, "count": 2}, status=302),
+    Case("manufacturers:mo_detail", "manufacturer_admin", 7,
+         kwargs=lambda t: {"pk": t.manufacturing_order.pk}),
+
+    Case("blueprints:index", "manufacturer_admin", 4),
+    Case("blueprints:create", "manufacturer_admin", 2),
+    Case("blueprints:detail", "manufacturer_admin", 6, kwargs=lambda t: {"pk": t.blueprint.pk}),
+    Case("blueprints:edit", "manufacturer_admin", 5, kwargs=lambda t: {"pk": t.blueprint.pk}),
+    Case("blueprints:delete", "manufacturer_admin", 5, kwargs=lambda t: {"pk": t.blueprint.pk}),
+
+    Case("inventory:index", "manufacturer_admin", 4),
+    Case("inventory:index", "dealership_admin", 4),
+    Case("inventory:manufacturers_inventory", "dealership_admin", 5),
+    Case("inventory:dealership_inventory", "customer", 5),
+    # The same page again, from the catalogue cache
+    Case("inventory:dealership_inventory", "customer", 2),
+    Case("inventory:retail_search", "customer", 5, data=lambda t: {"q": "acura"}),
+    Case("inventory:wholesale_detail", "manufacturer_admin", 5,
+         kwargs=lambda t: {"pk": t.wholesale_car.pk}),
+    Case("inventory:wholesale_update", "manufacturer_admin", 5,
+         kwargs=lambda t: {"pk": t.wholesale_car.pk}),
+    Case("inventory:wholesale_delete", "manufacturer_admin", 6,
+         kwargs=lambda t: {"pk": t.wholesale_car.pk}),
+    Case("inventory:import", "dealership_admin", 2),
+    Case("inventory:import", "dealership_admin", 16, method="post", data=lambda t: {
+        "file": SimpleUploadedFile("stock.csv", b"brand,name,price,amount\n" + b"".join(
+            b"Acura,import_%d,20000,5\n" % i for i in range(50)))}),
+    Case("inventory:retail_detail", "dealership_admin", 5,
+         kwargs=lambda t: {"pk": t.retail_car.pk}),
+    Case("inventory:retail_update", "dealership_admin", 5,
+         kwargs=lambda t: {"pk": t.retail_car.pk}),
+    Case("inventory:retail_delete", "dealership_admin", 6,
+         kwargs=lambda t: {"pk": t.retail_car.pk}),
+
+    Case("deals:wholesale_deal_create", "dealership_admin", 7,
+         kwargs=lambda t: {"pk": t.wholesale_car.pk}),
+    Case("deals:wholesale_deal_create", "dealership_admin", 39, method="post",
+         kwargs=lambda t: {"pk": t.wholesale_car.pk},
+         data=lambda t: {"car": t.wholesale_car.pk, "amount": 1, "asking_price": 1000},
+         status=302),
+    Case("deals:wholesale_deal_detail", "manufacturer_admin", 7,
+         kwargs=lambda t: {"pk": t.wholesale_deal.pk}),
+    Case("deals:from_dealerships", "manufacturer_admin", 5),
+    Case("deals:to_manufacturers", "dealership_admin", 3),
+    Case("deals:wholesale_deal_accept", "manufacturer_admin", 17,
+         kwargs=lambda t: {"pk": t.wholesale_deal.pk}, status=302),
+    Case("deals:wholesale_deal_reject", "manufacturer_admin", 12,
+         kwargs=lambda t: {"pk": t.rejected_wholesale_deal.pk}, status=302),
+    Case("deals:wholesale_deal_bulk", "manufacturer_admin", 20, method="post",
+         data=lambda t: {"deals": t.bulk_wholesale_deals, "action": "accept"}, status=302),
+
+    Case("deals:retail_deal_create", "customer", 6, kwargs=lambda t: {"pk": t.retail_car.pk}),
+    Case("deals:retail_deal_create", "customer", 37, method="post",
+         kwargs=lambda t: {"pk": t.retail_car.pk},
+         data=lambda t: {"car": t.retail_car.pk, "asking_price": 1000}, status=302),
+    Case("deals:retail_deal_detail", "dealership_admin", 7,
+         kwargs=lambda t: {"pk": t.retail_deal.pk}),
+    Case("deals:from_customers", "dealership_admin", 5),
+    Case("deals:to_dealerships", "customer", 3),
+    Case("deals:retail_deal_accept", "dealership_admin", 16,
+         kwargs=lambda t: {"pk": t.retail_deal.pk}, status=302),
+    Case("deals:retail_deal_reject", "dealership_admin", 12,
+         kwargs=lambda t: {"pk": t.rejected_retail_deal.pk}, status=302),
+    Case("metrics", "staff", 2),
+    Case("deals:export", "staff", 3, kwargs=lambda t: {"name": "wholesale-deals", "format": "csv"}),
+]
+
+
+@override_settings(REQUEST_METRICS=True)
+class ViewBenchmarkTestCase(TestCase):
+    """ Checks the query count and latency of every view against a ceiling. """
+
+    report = {}
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_database(cars=CARS, dealerships=DEALERSHIPS, customers=CUSTOMERS, seed=0)
+
+        cls.manufacturer_admin = User.objects.get(username="acura_admin")
+        cls.dealership_admin = User.objects.get(username="andrew_admin")
+        cls.customer = User.objects.get(username="customer")
+        cls.staff = User.objects.create(username="finance", is_staff=True)
+        User.objects.filter(pk=cls.customer.pk).update(balance=10 ** 8)
+        Manufacturer.objects.update(balance=10 ** 8)
+        Dealership.objects.update(balance=10 ** 8)
+
+        manufacturer = Manufacturer.objects.get(admin=cls.manufacturer_admin)
+        dealership = Dealership.objects.get(admin=cls.dealership_admin)
+        cls.blueprint = Car.objects.filter(manufacturer=manufacturer).order_by("pk").first()
+        cls.wholesale_car = WholesaleCar.objects.filter(
+            manufacturer=manufacturer).order_by("pk").first()
+        WholesaleCar.objects.filter(pk=cls.wholesale_car.pk).update(amount=10 ** 6)
+
+        RetailCar.objects.bulk_create([
+            RetailCar(name=car.name, cost_price=car.wholesale_price,
+                      retail_price=car.wholesale_price, amount=2 * DEALS,
+                      manufacturer_id=car.manufacturer_id, dealership=dealership)
+            for car in WholesaleCar.objects.order_by("pk")[:DEALS]
+        ])
+        cls.retail_car = RetailCar.objects.filter(dealership=dealership).order_by("pk").first()
+
+        WholesaleDeal.objects.bulk_create([
+            WholesaleDeal(car=cls.wholesale_car, asking_price=1000, amount=1, dealership=dealership,
+                          manufacturer=manufacturer)
+            for _ in range(DEALS)
+        ])
+        RetailDeal.objects.bulk_create([
+            RetailDeal(car=cls.retail_car, asking_price=1000, amount=1, customer=cls.customer,
+                       dealership=dealership)
+            for _ in range(DEALS)
+        ])
+        ManufacturingOrder.objects.bulk_create([
+            ManufacturingOrder(manufacturer=manufacturer, car=cls.blueprint, count=1)
+            for _ in range(DEALS)
+        ])
+
+        wholesale_deals = list(WholesaleDeal.objects.order_by("pk"))
+        retail_deals = list(RetailDeal.objects.order_by("pk"))
+        # The deals hold their cars, as if made through the deal views
+        for car_model, deals in ((WholesaleCar, wholesale_deals), (RetailCar, retail_deals)):
+            for deal in deals:
+                deal.reservation = reservations.reserve(car_model, deal.car_id, deal.amount)
+            type(deals[0]).objects.bulk_update(deals, ["reservation"])
+        cls.wholesale_deal, cls.rejected_wholesale_deal = wholesale_deals[:2]
+        cls.bulk_wholesale_deals = [deal.pk for deal in wholesale_deals[2:12]]
+        cls.retail_deal, cls.rejected_retail_deal = retail_deals[:2]
+        cls.manufacturing_order = ManufacturingOrder.objects.order_by("pk").first()
+
+        for deal in (cls.wholesale_deal, cls.rejected_wholesale_deal):
+            assign_perm("view_wholesaledeal", cls.manufacturer_admin, deal)
+            assign_perm("change_wholesaledeal", cls.manufacturer_admin, deal)
+        for deal in (cls.retail_deal, cls.rejected_retail_deal):
+            assign_perm("view_retaildeal", cls.dealership_admin, deal)
+            assign_perm("change_retaildeal", cls.dealership_admin, deal)
+        assign_perm("change_manufacturingorder", cls.manufacturer_admin, cls.manufacturing_order)
+        assign_perm("change_retailcar", cls.dealership_admin, cls.retail_car)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        path = os.environ.get("BENCHMARK_REPORT")
+        if path and cls.report:
+            with open(path, "w") as file:
+                json.dump(cls.report, file, indent=2, sort_keys=True)
+
+    def measure(self, case):
+        if case.user:
+            self.client.force_login(getattr(self, case.user))
+        else:
+            self.client.logout()
+
+        url = reverse(case.name, kwargs=case.kwargs(self))
+        send = getattr(self.client, case.method)
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            response = send(url, case.data(self))
+            if response.streaming:
+                b"".join(response.streaming_content)
+            seconds = time.perf_counter() - start
+        return response, len(queries), seconds
+
+    def test_views(self):
+        for case in CASES:
+            with self.subTest(name=case.name, user=case.user, method=case.method):
+                response, queries, seconds = self.measure(case)
+                key = "%s %s %s" % (case.method.upper(), case.name, case.user or "anonymous")
+                self.report[key] = {
+                    "status": response.status_code,
+                    "queries": queries,
+                    "seconds": round(seconds, 4),
+                }
+                self.assertEqual(response.status_code, case.status)
+                self.assertLessEqual(queries, case.queries)
+                self.assertLessEqual(seconds, case.seconds)
+
+    def test_every_view_is_benchmarked(self):
+        benchmarked = {case.name for case in CASES}
+        missing = set(url_names()) - EXCLUDED_URL_NAMES - benchmarked
+        self.assertEqual(missing, set())
+
+
+@override_settings(REQUEST_METRICS=True)
+class MetricsTestCase(TestCase):
+    """ Checks that requests are measured per view and served to staff users only. """
+
+    def setUp(self):
+        metrics.reset()
+        self.staff = User.objects.create(username="finance", is_staff=True)
+        self.customer = User.objects.create(username="customer", user_type=User.CUSTOMER)
+
+    def scrape(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response["Content-Type"], metrics.CONTENT_TYPE)
+        return response.content.decode()
+
+    def test_requests_are_measured(self):
+        self.client.force_login(self.customer)
+        self.client.get(reverse("user:profile"))
+        self.client.get(reverse("user:profile"))
+        self.client.get("/no-such-page/")
+        text = self.scrape()
+
+        self.assertIn('carsupply_requests_total{view="user:profile",method="GET",status="200"} 2',
+                      text)
+        self.assertIn('carsupply_requests_total{view="<unresolved>",method="GET",status="404"} 1',
+                      text)
+        self.assertIn('carsupply_request_duration_seconds_count{view="user:profile"} 2', text)
+        self.assertIn('carsupply_request_duration_seconds_bucket{view="user:profile",le="+Inf"} 2',
+                      text)
+        values = {line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+                  for line in text.splitlines() if not line.startswith("#")}
+        self.assertGreater(values['carsupply_request_queries_total{view="user:profile"}'], 0)
+        self.assertGreater(values['carsupply_request_db_seconds_total{view="user:profile"}'], 0)
+        self.assertGreater(
+            values['carsupply_request_render_seconds_total{view="user:profile"}'], 0)
+        self.assertGreater(values['carsupply_response_bytes_total{view="user:profile"}'], 0)
+
+    def test_streamed_bytes_are_counted(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse("deals:export", kwargs={
+            "name": "wholesale-cars", "format": "csv"}))
+        size = len(b"".join(response.streaming_content))
+        self.assertIn('carsupply_response_bytes_total{view="deals:export"} %d' % size,
+                      self.scrape())
+
+    def test_access(self):
+        self.client.force_login(self.customer)
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 403)
+        self.client.logout()
+        with self.settings(METRICS_TOKEN="secret"):
+            response = self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret")
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer wrong")
+            self.assertEqual(response.status_code, 302)
+
+    @override_settings(SLOW_REQUEST_SECONDS=0)
+    def test_slow_requests_are_logged(self):
+        with self.assertLogs("CarSupply.metrics", "WARNING") as logs:
+            self.client.get(reverse("home"))
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual((line["event"], line["view"], line["status"]), ("slow_request", "home", 200))
+
+    def test_disabled(self):
+        with self.settings(REQUEST_METRICS=False):
+            self.client.get(reverse("home"))
+            self.client.force_login(self.staff)
+            self.assertEqual(self.client.get(reverse("metrics")).status_code, 404)
+        self.assertNotIn('view="home"', self.scrape())
+
@@ -17,6 +17,8 @@ from django.contrib import admin
 from django.urls import path, include
 from users.views import HomeView
 
+from .metrics import MetricsView
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('user/',include("users.urls")),
@@ -24,5 +26,6 @@ urlpatterns = [
     path('blueprints/',include("blueprints.urls")),
     path('deals/',include("deals.urls")),
     path('inventory/',include("inventory.urls")),
+    path('metrics', MetricsView.as_view(), name='metrics'),
     path('', HomeView.as_view(), name='home'),
 ]
@@ -3,11 +3,29 @@ from django.db import models
 
 # Create your models here.
 
+class CarQuerySet(models.QuerySet):
+    """ QuerySet for blueprints. """
+
+    def owned_by(self, manufacturer_id):
+        """ Blueprints of a manufacturer, none if manufacturer_id is None. """
+
+        if manufacturer_id is None:
+            return self.none()
+        return self.filter(manufacturer_id=manufacturer_id)
+
+    def for_listing(self):
+        """ Blueprints with the manufacturer joined in for rendering lists. """
+
+        return self.select_related("manufacturer").order_by("pk")
+
+
 class Car(models.Model):
     name = models.CharField(max_length=30)
     price = models.IntegerField()
     manufacturer = models.ForeignKey('manufacturers.Manufacturer', on_delete=models.CASCADE, null=True )
-    
+
+    objects = CarQuerySet.as_manager()
+
     def get_absolute_url(self):
         from django.urls import reverse
         return reverse('blueprints:detail', kwargs={'pk': self.pk})
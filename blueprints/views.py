@@ -2,10 +2,12 @@ from django.core.exceptions import PermissionDenied
 from django.urls import reverse_lazy
 from django.views.generic import (CreateView, DeleteView, DetailView, ListView,
                                   UpdateView)
-from guardian.shortcuts import assign_perm
-from guardian.mixins import PermissionRequiredMixin
 
+from inventory.versions import ConditionalGetMixin
+from manufacturers.models import Manufacturer
 from manufacturers.views import UserIsManufacturer
+from users.affiliation import affiliation_id, owner_id
+from users.permissions import CachedPermissionRequiredMixin, assign_object_perm
 
 from .models import Car
 
@@ -20,23 +22,27 @@ class BlueprintCreateView(UserIsManufacturer,CreateView):
     fields = ("name", "price")
 
     def form_valid(self, form):
-        form.instance.manufacturer = self.request.user.manufacturer_set.get()
+        manufacturer_id = owner_id(self.request)
+        if manufacturer_id is None:
+            raise PermissionDenied
+        form.instance.manufacturer_id = manufacturer_id
         car = form.save()
-        assign_perm("view_car", self.request.user, car)
-        assign_perm("change_car", self.request.user, car)
+        assign_object_perm("view_car", self.request.user, car)
+        assign_object_perm("change_car", self.request.user, car)
         return super().form_valid(form)
 
 
-class BlueprintDetailView(PermissionRequiredMixin, DetailView):
+class BlueprintDetailView(CachedPermissionRequiredMixin, ConditionalGetMixin, DetailView):
     """ Detail view for Blueprint. """
 
     model = Car
+    version_models = (Car, Manufacturer)
     template_name = "blueprint-detail.html"
     context_object_name = "blueprint"
     permission_required = "change_car"
     raise_exception = True
 
-class BlueprintUpdateView(PermissionRequiredMixin, UpdateView):
+class BlueprintUpdateView(CachedPermissionRequiredMixin, UpdateView):
     """ Update view for Blueprint. """
 
     model = Car
@@ -56,10 +62,10 @@ class BlueprintListView(UserIsManufacturer, ListView):
     context_object_name = "blueprints"
 
     def get_queryset(self):
-        return Car.objects.filter(manufacturer__admin=self.request.user)
+        return Car.objects.owned_by(affiliation_id(self.request)).for_listing()
 
 
-class BluePrintDeleteView(PermissionRequiredMixin, DeleteView):
+class BluePrintDeleteView(CachedPermissionRequiredMixin, DeleteView):
     """ Delete view for Blueprint. """
 
     model = Car
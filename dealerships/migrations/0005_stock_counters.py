@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dealerships', '0004_auto_20200502_0418'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dealership',
+            name='cars_in_stock',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='dealership',
+            name='pending_deal_value',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='dealership',
+            name='stock_value',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+    ]
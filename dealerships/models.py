@@ -2,9 +2,7 @@ from django.db import models
 from django.core.validators import MinValueValidator
 
 
-import json
-with open("countries-django.json") as file:
-    countries = json.loads(file.read())
+from CarSupply.countries import get_countries
 from users.models import User
 
 # Create your models here.
@@ -12,9 +10,14 @@ class Dealership(models.Model):
     """Model definition for Dealership. """
 
     name = models.CharField(max_length=30)
-    country = models.CharField(max_length=3,choices=countries)
+    country = models.CharField(max_length=3,choices=get_countries())
     balance = models.PositiveIntegerField(default=0,validators=[MinValueValidator(1)])
     admin = models.ForeignKey(User, on_delete=models.CASCADE,null=True)
 
+    # Maintained by inventory.counters
+    cars_in_stock = models.BigIntegerField(default=0, editable=False)
+    stock_value = models.BigIntegerField(default=0, editable=False)
+    pending_deal_value = models.BigIntegerField(default=0, editable=False)
+
     def __str__(self):
         return self.name
\ No newline at end of file
@@ -0,0 +1,214 @@
+"""
+Streaming exports of deals, inventory and manufacturing orders as CSV or
+JSON Lines, for the finance team.
+
+Rows are read with QuerySet.iterator() as tuples of plain values and
+written out chunk by chunk, so memory use does not grow with the size of
+the table. The same exports are served by deals.views.ExportView and the
+command
+
+    python manage.py export_data wholesale-deals --format csv --since 2020-05-01
+
+Deals and manufacturing orders can be filtered by creation date and
+status; the inventory tables have neither.
+"""
+
+import csv
+import datetime
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from inventory.models import RetailCar, WholesaleCar
+from manufacturers.models import ManufacturingOrder
+
+from .models import RetailDeal, WholesaleDeal
+
+
+# Rows fetched per query and written per chunk
+CHUNK_SIZE = 2000
+
+CONTENT_TYPES = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+}
+
+
+class ExportError(Exception):
+    """ Raised for an unknown export or format, or invalid filters. """
+
+
+class Export:
+    """
+    An exportable table.
+
+    Parameters:
+        model (class): model to export, ordered by pk
+        columns (tuple): (header, lookup) pairs
+        date_field (str): datetime field the since/until filters apply to
+        status_field (str): choice field the status filter applies to
+    """
+
+    def __init__(self, model, columns, date_field=None, status_field=None):
+        self.model = model
+        self.columns = columns
+        self.date_field = date_field
+        self.status_field = status_field
+
+    @property
+    def headers(self):
+        return [header for header, _ in self.columns]
+
+    def queryset(self, since=None, until=None, status=None):
+        """
+        Returns the rows as tuples, created between since and until
+        (inclusive dates) and with the given status.
+        """
+
+        rows = self.model.objects.all()
+        if (since or until) and not self.date_field:
+            raise ExportError("This export cannot be filtered by date")
+        # Compare the column itself so that its index is used
+        if since:
+            rows = rows.filter(**{"%s__gte" % self.date_field: _midnight(since)})
+        if until:
+            rows = rows.filter(**{
+                "%s__lt" % self.date_field: _midnight(until + datetime.timedelta(days=1))})
+        if status:
+            if not self.status_field:
+                raise ExportError("This export cannot be filtered by status")
+            choices = dict(self.model._meta.get_field(self.status_field).choices)
+            if status not in choices:
+                raise ExportError("Unknown status, expected one of %s" % ", ".join(choices))
+            rows = rows.filter(**{self.status_field: status})
+        return rows.order_by("pk").values_list(*[lookup for _, lookup in self.columns])
+
+
+EXPORTS = {
+    "wholesale-deals": Export(WholesaleDeal, (
+        ("id", "pk"),
+        ("created_at", "created_at"),
+        ("status", "status"),
+        ("car_id", "car_id"),
+        ("car", "car__name"),
+        ("manufacturer", "car__manufacturer__name"),
+        ("dealership", "dealership__name"),
+        ("amount", "amount"),
+        ("asking_price", "asking_price"),
+    ), date_field="created_at", status_field="status"),
+    "retail-deals": Export(RetailDeal, (
+        ("id", "pk"),
+        ("created_at", "created_at"),
+        ("status", "status"),
+        ("car_id", "car_id"),
+        ("car", "car__name"),
+        ("dealership", "car__dealership__name"),
+        ("customer", "customer__username"),
+        ("amount", "amount"),
+        ("asking_price", "asking_price"),
+    ), date_field="created_at", status_field="status"),
+    "wholesale-cars": Export(WholesaleCar, (
+        ("id", "pk"),
+        ("name", "name"),
+        ("manufacturer", "manufacturer__name"),
+        ("cost_price", "cost_price"),
+        ("wholesale_price", "wholesale_price"),
+        ("amount", "amount"),
+    )),
+    "retail-cars": Export(RetailCar, (
+        ("id", "pk"),
+        ("name", "name"),
+        ("manufacturer", "manufacturer__name"),
+        ("dealership", "dealership__name"),
+        ("cost_price", "cost_price"),
+        ("retail_price", "retail_price"),
+        ("amount", "amount"),
+    )),
+    "manufacturing-orders": Export(ManufacturingOrder, (
+        ("id", "pk"),
+        ("created_at", "created_at"),
+        ("processed_at", "processed_at"),
+        ("status", "status"),
+        ("manufacturer", "manufacturer__name"),
+        ("car", "car__name"),
+        ("count", "count"),
+        ("price", "price"),
+    ), date_field="created_at", status_field="status"),
+}
+
+
+def _midnight(date):
+    return timezone.make_aware(datetime.datetime.combine(date, datetime.time.min))
+
+
+def parse_filters(params):
+    """
+    Returns the since, until and status filters in params (e.g.
+    request.GET, dates as YYYY-MM-DD) as keyword arguments for stream().
+    """
+
+    filters = {}
+    for name in ("since", "until"):
+        value = params.get(name)
+        if value:
+            try:
+                filters[name] = parse_date(value)
+            except ValueError:
+                filters[name] = None
+            if filters[name] is None:
+                raise ExportError("%s must be a date (YYYY-MM-DD)" % name)
+    if params.get("status"):
+        filters["status"] = params["status"]
+    return filters
+
+
+class _Echo:
+    """ File-like object returning what is written, for csv.writer. """
+
+    def write(self, value):
+        return value
+
+
+def _csv_lines(headers, rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(headers)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def _jsonl_lines(headers, rows):
+    encoder = DjangoJSONEncoder()
+    for row in rows:
+        yield encoder.encode(dict(zip(headers, row))) + "\n"
+
+
+def _chunks(lines):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk = []
+    if chunk:
+        yield "".join(chunk)
+
+
+def stream(name, format, since=None, until=None, status=None):
+    """
+    Returns an iterator over the text of an export, in chunks of
+    CHUNK_SIZE rows.
+
+    Raises ExportError for an unknown export or format or invalid filters.
+    The rows are only queried once the iterator is consumed.
+    """
+
+    export = EXPORTS.get(name)
+    if export is None:
+        raise ExportError("Unknown export, expected one of %s" % ", ".join(EXPORTS))
+    if format not in CONTENT_TYPES:
+        raise ExportError("Unknown format, expected one of %s" % ", ".join(CONTENT_TYPES))
+
+    rows = export.queryset(since, until, status).iterator(chunk_size=CHUNK_SIZE)
+    lines = _csv_lines if format == "csv" else _jsonl_lines
+    return _chunks(lines(export.headers, rows))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from deals import exports
+
+
+class Command(BaseCommand):
+    """
+    Streams a table (deals, inventory or manufacturing orders) as CSV or
+    JSON Lines to stdout or a file, with constant memory.
+    """
+
+    help = "Export deals, inventory or manufacturing orders as CSV or JSON Lines."
+
+    def add_arguments(self, parser):
+        parser.add_argument("name", choices=sorted(exports.EXPORTS))
+        parser.add_argument("--format", choices=sorted(exports.CONTENT_TYPES), default="csv")
+        parser.add_argument("--since", help="First creation date, YYYY-MM-DD.")
+        parser.add_argument("--until", help="Last creation date, YYYY-MM-DD.")
+        parser.add_argument("--status", help="Status code, e.g. PE.")
+        parser.add_argument("--output", help="File to write to instead of stdout.")
+
+    def handle(self, *args, **options):
+        try:
+            content = exports.stream(options["name"], options["format"],
+                                     **exports.parse_filters(options))
+        except exports.ExportError as error:
+            raise CommandError(error)
+
+        if options["output"]:
+            with open(options["output"], "w", newline="") as file:
+                for chunk in content:
+                    file.write(chunk)
+        else:
+            for chunk in content:
+                self.stdout.write(chunk, ending="")
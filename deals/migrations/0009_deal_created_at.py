@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('deals', '0008_auto_20200506_1209'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='retaildeal',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='wholesaledeal',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='retaildeal',
+            index=models.Index(fields=['created_at'], name='retaildeal_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='wholesaledeal',
+            index=models.Index(fields=['created_at'], name='wholesaledeal_created_idx'),
+        ),
+    ]
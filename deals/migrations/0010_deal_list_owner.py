@@ -0,0 +1,56 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:37
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def copy_car_owners(apps, schema_editor):
+    """ Fills in the manufacturer of wholesale deals and the dealership of retail deals. """
+
+    using = schema_editor.connection.alias
+    for deal_model, car_model, field in (('WholesaleDeal', 'WholesaleCar', 'manufacturer_id'),
+                                         ('RetailDeal', 'RetailCar', 'dealership_id')):
+        cars = apps.get_model('inventory', car_model).objects.using(using)
+        apps.get_model('deals', deal_model).objects.using(using).update(**{
+            field: Subquery(cars.filter(pk=OuterRef('car_id')).values(field)[:1])})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dealerships', '0005_stock_counters'),
+        ('manufacturers', '0011_manufacturingorder_queue'),
+        ('deals', '0009_deal_created_at'),
+        ('inventory', '0010_facetcount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='retaildeal',
+            name='dealership',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='dealerships.dealership'),
+        ),
+        migrations.AddField(
+            model_name='wholesaledeal',
+            name='manufacturer',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='manufacturers.manufacturer'),
+        ),
+        migrations.RunPython(copy_car_owners, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='retaildeal',
+            index=models.Index(fields=['status', 'customer', 'id'], name='retaildeal_customer_list_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='retaildeal',
+            index=models.Index(fields=['status', 'dealership', 'id'], name='retaildeal_dealer_list_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='wholesaledeal',
+            index=models.Index(fields=['status', 'dealership', 'id'], name='wholesaledeal_dealer_list_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='wholesaledeal',
+            index=models.Index(fields=['status', 'manufacturer', 'id'], name='wholesaledeal_mfr_list_idx'),
+        ),
+    ]
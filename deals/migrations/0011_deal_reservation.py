@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0011_reservations'),
+        ('deals', '0010_deal_list_owner'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='retaildeal',
+            name='reservation',
+            field=models.ForeignKey(blank=True, db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='inventory.retailreservation'),
+        ),
+        migrations.AddField(
+            model_name='wholesaledeal',
+            name='reservation',
+            field=models.ForeignKey(blank=True, db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='inventory.wholesalereservation'),
+        ),
+    ]
@@ -1,13 +1,37 @@
 from django.db import models
 from django.core.validators import MinValueValidator
 
-from inventory.models import WholesaleCar, RetailCar
+from inventory.models import (RetailCar, RetailReservation, WholesaleCar,
+                              WholesaleReservation)
 from dealerships.models import Dealership
+from manufacturers.models import Manufacturer
 from users.models import User
 
 
 # Create your models here.
 
+class WholesaleDealQuerySet(models.QuerySet):
+    """ QuerySet for wholesale deals. """
+
+    def for_listing(self):
+        """ Deals with the columns shown in the deal lists, parties joined in. """
+
+        return self.select_related("dealership", "manufacturer", "car").only(
+            "status", "amount", "asking_price", "car__name", "dealership__name",
+            "manufacturer__name")
+
+
+class RetailDealQuerySet(models.QuerySet):
+    """ QuerySet for retail deals. """
+
+    def for_listing(self):
+        """ Deals with the columns shown in the deal lists, parties joined in. """
+
+        return self.select_related("customer", "dealership", "car__manufacturer").only(
+            "status", "amount", "asking_price", "car__name", "car__manufacturer__name",
+            "customer__username", "dealership__name")
+
+
 class WholesaleDeal(models.Model):
     """ Model definition for Wholesale deal. """
 
@@ -25,6 +49,35 @@ class WholesaleDeal(models.Model):
     asking_price = models.PositiveIntegerField(default=0)
     amount = models.PositiveIntegerField(default=1, validators=[MinValueValidator(1)])
     dealership = models.ForeignKey(Dealership, on_delete=models.CASCADE, null=True)
+    # The car's manufacturer, copied so that its deal list is one index range
+    manufacturer = models.ForeignKey(Manufacturer, on_delete=models.CASCADE, null=True,
+                                     related_name="+")
+    # The cars held for the deal while it is pending (inventory.reservations).
+    # No constraint, as expired reservations are deleted without touching
+    # their deals; deals made before reservations have none.
+    reservation = models.ForeignKey(WholesaleReservation, on_delete=models.DO_NOTHING,
+                                    null=True, blank=True, db_constraint=False,
+                                    db_index=False, related_name="+")
+    # Unknown for deals made before it was added
+    created_at = models.DateTimeField(auto_now_add=True, null=True)
+
+    objects = WholesaleDealQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Exports by date
+            models.Index(fields=["created_at"], name="wholesaledeal_created_idx"),
+            # Deal lists: one status of one party's deals, newest first
+            models.Index(fields=["status", "dealership", "id"],
+                         name="wholesaledeal_dealer_list_idx"),
+            models.Index(fields=["status", "manufacturer", "id"],
+                         name="wholesaledeal_mfr_list_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.manufacturer_id is None:
+            self.manufacturer_id = self.car.manufacturer_id
+        super().save(*args, **kwargs)
 
     def get_absolute_url(self):
         from django.urls import reverse
@@ -49,6 +102,33 @@ class RetailDeal(models.Model):
     asking_price = models.PositiveIntegerField(default=0)
     amount = models.PositiveIntegerField(default=1, validators=[MinValueValidator(1)])
     customer = models.ForeignKey(User, on_delete=models.CASCADE, null=True)
+    # The car's dealership, copied so that its deal list is one index range
+    dealership = models.ForeignKey(Dealership, on_delete=models.CASCADE, null=True,
+                                   related_name="+")
+    # See WholesaleDeal.reservation
+    reservation = models.ForeignKey(RetailReservation, on_delete=models.DO_NOTHING,
+                                    null=True, blank=True, db_constraint=False,
+                                    db_index=False, related_name="+")
+    # Unknown for deals made before it was added
+    created_at = models.DateTimeField(auto_now_add=True, null=True)
+
+    objects = RetailDealQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Exports by date
+            models.Index(fields=["created_at"], name="retaildeal_created_idx"),
+            # Deal lists: one status of one party's deals, newest first
+            models.Index(fields=["status", "customer", "id"],
+                         name="retaildeal_customer_list_idx"),
+            models.Index(fields=["status", "dealership", "id"],
+                         name="retaildeal_dealer_list_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.dealership_id is None:
+            self.dealership_id = self.car.dealership_id
+        super().save(*args, **kwargs)
 
     def get_absolute_url(self):
         from django.urls import reverse
@@ -0,0 +1,482 @@
+"""
+Settlement of accepted deals.
+
+Accepting a deal moves money between two accounts and stock between two
+inventories. Every balance and stock change is applied with a conditional
+UPDATE (e.g. UPDATE ... SET balance = balance - x WHERE balance >= x), so
+the check and the write happen atomically in the database and concurrent
+settlements can neither overdraw an account nor oversell stock.
+
+The stock counters of the manufacturer and dealership involved (see
+inventory.counters) are changed in the same UPDATE as their balance, and
+the catalogue facet counts (see inventory.facets) in the same transaction.
+The cached catalogue pages (see inventory.page_cache) are invalidated
+explicitly, since queryset updates do not send post_save. Every balance
+change is also appended to the ledger (see ledger.balances) after the
+UPDATE that makes it.
+
+The cars of a deal come out of its stock reservation (see
+inventory.reservations) while that still holds them, and otherwise out of
+the cars not reserved for other deals. Rejecting a deal releases its
+reservation.
+
+Rows are always locked in the same order to keep concurrent settlements
+(and manufacturing orders) from deadlocking each other:
+
+    deal, User, Dealership, Manufacturer, reservations, WholesaleCar, RetailCar,
+    FacetCount
+"""
+
+from collections import defaultdict
+
+from django.db import connection, transaction
+from django.db.models import F
+
+from dealerships.models import Dealership
+from inventory import counters, facets, page_cache, reservations
+from inventory.lookups import candidates
+from inventory.models import FacetCount, RetailCar, WholesaleCar
+from ledger import balances
+from ledger.models import Entry
+from manufacturers.models import Manufacturer
+from users import user_cache
+from users.models import User
+
+from .models import RetailDeal, WholesaleDeal
+
+
+class SettlementError(Exception):
+    """ Raised when a deal cannot be settled. Nothing is written. """
+
+
+class DealNotFound(SettlementError):
+    pass
+
+
+class DealNotPending(SettlementError):
+    pass
+
+
+class InsufficientBalance(SettlementError):
+    pass
+
+
+class InsufficientStock(SettlementError):
+    pass
+
+
+class Settlement:
+    """
+    Result of a settled deal.
+
+    Attributes:
+        deal (obj): the settled deal
+        queries (int): number of SQL statements the settlement executed
+    """
+
+    def __init__(self, deal, queries):
+        self.deal = deal
+        self.queries = queries
+
+
+class BatchSettlement:
+    """
+    Result of settling or rejecting several deals at once.
+
+    Attributes:
+        outcomes (dict): maps each deal pk to None if it went through or
+            to the SettlementError explaining why it did not
+        queries (int): number of SQL statements the batch executed
+    """
+
+    def __init__(self, outcomes, queries):
+        self.outcomes = outcomes
+        self.queries = queries
+
+    @property
+    def succeeded(self):
+        return [pk for pk, error in self.outcomes.items() if error is None]
+
+    @property
+    def failed(self):
+        return {pk: error for pk, error in self.outcomes.items() if error is not None}
+
+
+class QueryCounter:
+    """ Execute wrapper counting the statements run on a connection. """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def _debit(queryset, amount, error, **changes):
+    """
+    Subtracts amount from balance if the balance covers it, applying the
+    other changes in the same UPDATE.
+    """
+
+    if not queryset.filter(balance__gte=amount).update(
+            balance=F('balance') - amount, **changes):
+        raise error
+
+
+def _credit(queryset, amount, **changes):
+    queryset.update(balance=F('balance') + amount, **changes)
+
+
+def _take_stock(model, deal):
+    """ Takes the deal's cars out of stock if there are enough of them. """
+
+    if not reservations.take(model, deal.car_id, deal.amount, deal.reservation_id):
+        raise InsufficientStock("There are not enough cars in stock")
+
+
+def _received(car, dealership, amount):
+    """ Returns the facet entry of wholesale cars arriving in a dealership's retail stock. """
+
+    return (FacetCount.RETAIL, car.manufacturer_id, dealership.country if dealership else None,
+            car.wholesale_price, amount)
+
+
+def settle_wholesale_deal(pk):
+    """
+    Settles a pending wholesale deal.
+
+    Deducts the asking price from the dealership balance and adds it to the
+    manufacturer's balance, moves the cars from the manufacturer's wholesale
+    inventory into the dealership's retail inventory and marks the deal as
+    accepted.
+
+    Parameters:
+        pk (int): primary key of wholesale deal
+
+    Returns a Settlement.
+    Raises a SettlementError if the deal is not pending, the dealership
+    balance is too low or the manufacturer is out of stock.
+    """
+
+    counter = QueryCounter()
+    with connection.execute_wrapper(counter), transaction.atomic():
+        deal = WholesaleDeal.objects.select_for_update(of=("self",)).select_related(
+            "car__manufacturer", "dealership").get(pk=pk)
+        if deal.status != WholesaleDeal.PENDING:
+            raise DealNotPending("This deal is no longer pending")
+
+        car = deal.car
+        total_cost = deal.asking_price
+
+        _debit(Dealership.objects.filter(pk=deal.dealership_id), total_cost,
+               InsufficientBalance("The dealership balance is too low"),
+               **counters.changes(cars=deal.amount, value=deal.amount * car.wholesale_price))
+        _credit(Manufacturer.objects.filter(pk=car.manufacturer_id), total_cost,
+                **counters.changes(cars=-deal.amount, value=-deal.amount * car.cost_price,
+                                   pending=-total_cost))
+        balances.record(
+            balances.entry(Dealership, deal.dealership_id, -total_cost, Entry.WHOLESALE_DEAL, pk),
+            balances.entry(Manufacturer, car.manufacturer_id, total_cost, Entry.WHOLESALE_DEAL,
+                           pk))
+        _take_stock(WholesaleCar, deal)
+
+        retail_cars = RetailCar.objects.filter(
+            name=car.name,
+            cost_price=car.wholesale_price,
+            retail_price=car.wholesale_price,
+            manufacturer_id=car.manufacturer_id,
+            dealership_id=deal.dealership_id,
+        )
+        if not retail_cars.update(amount=F('amount') + deal.amount):
+            # A concurrent settlement may create the same row first, in which
+            # case unique_retail_car turns this insert into a no-op.
+            RetailCar.objects.bulk_create([RetailCar(
+                name=car.name,
+                cost_price=car.wholesale_price,
+                retail_price=car.wholesale_price,
+                manufacturer_id=car.manufacturer_id,
+                dealership_id=deal.dealership_id,
+                amount=0,
+            )], ignore_conflicts=True)
+            retail_cars.update(amount=F('amount') + deal.amount)
+
+        facets.add(facets.entry(FacetCount.WHOLESALE, car, -deal.amount),
+                   _received(car, deal.dealership, deal.amount))
+        page_cache.invalidate(FacetCount.WHOLESALE, FacetCount.RETAIL)
+
+        WholesaleDeal.objects.filter(pk=pk).update(status=WholesaleDeal.ACCEPTED)
+        deal.status = WholesaleDeal.ACCEPTED
+
+    return Settlement(deal, counter.count)
+
+
+def settle_retail_deal(pk):
+    """
+    Settles a pending retail deal.
+
+    Deducts the asking price from the customer balance and adds it to the
+    dealership's balance, removes the cars from the dealership's retail
+    inventory and marks the deal as accepted.
+
+    Parameters:
+        pk (int): primary key of retail deal
+
+    Returns a Settlement.
+    Raises a SettlementError if the deal is not pending, the customer
+    balance is too low or the dealership is out of stock.
+    """
+
+    counter = QueryCounter()
+    with connection.execute_wrapper(counter), transaction.atomic():
+        deal = RetailDeal.objects.select_for_update(of=("self",)).select_related(
+            "car__dealership").get(pk=pk)
+        if deal.status != RetailDeal.PENDING:
+            raise DealNotPending("This deal is no longer pending")
+
+        total_cost = deal.asking_price
+
+        _debit(User.objects.filter(pk=deal.customer_id), total_cost,
+               InsufficientBalance("The customer balance is too low"))
+        user_cache.invalidate(deal.customer_id)
+        _credit(Dealership.objects.filter(pk=deal.car.dealership_id), total_cost,
+                **counters.changes(cars=-deal.amount, value=-deal.amount * deal.car.cost_price,
+                                   pending=-total_cost))
+        balances.record(
+            balances.entry(User, deal.customer_id, -total_cost, Entry.RETAIL_DEAL, pk),
+            balances.entry(Dealership, deal.car.dealership_id, total_cost, Entry.RETAIL_DEAL, pk))
+        _take_stock(RetailCar, deal)
+        facets.add(facets.entry(FacetCount.RETAIL, deal.car, -deal.amount))
+        page_cache.invalidate(FacetCount.RETAIL)
+
+        RetailDeal.objects.filter(pk=pk).update(status=RetailDeal.ACCEPTED)
+        deal.status = RetailDeal.ACCEPTED
+
+    return Settlement(deal, counter.count)
+
+
+def _reject(model, pk, owner_model, owner_lookup, car_model):
+    with transaction.atomic():
+        try:
+            asking_price, owner_id, car_id, amount, reservation_id = model.objects.values_list(
+                "asking_price", owner_lookup, "car_id", "amount", "reservation_id").get(pk=pk)
+        except model.DoesNotExist:
+            raise DealNotFound("This deal does not exist")
+        if not model.objects.filter(pk=pk, status=model.PENDING).update(status=model.REJECTED):
+            raise DealNotPending("This deal is no longer pending")
+        counters.add(owner_model, owner_id, pending=-asking_price)
+        reservations.release(car_model, car_id, amount, reservation_id)
+
+
+def reject_wholesale_deal(pk):
+    """
+    Rejects a pending wholesale deal and releases its cars.
+
+    Raises a SettlementError if the deal is not pending.
+    """
+
+    _reject(WholesaleDeal, pk, Manufacturer, "car__manufacturer_id", WholesaleCar)
+
+
+def reject_retail_deal(pk):
+    """
+    Rejects a pending retail deal and releases its car.
+
+    Raises a SettlementError if the deal is not pending.
+    """
+
+    _reject(RetailDeal, pk, Dealership, "car__dealership_id", RetailCar)
+
+
+def _batch_pks(pks):
+    return sorted(set(int(pk) for pk in pks))
+
+
+def settle_wholesale_deals(pks, manufacturer_id):
+    """
+    Settles several pending wholesale deals made to one manufacturer in a
+    single transaction.
+
+    The deals, dealerships, reservations and wholesale cars involved are
+    locked up front, deals are then accepted in pk order for as long as each
+    dealership's balance and each deal's reservation or car's available
+    stock cover them, and the resulting balance and stock changes are
+    written with one UPDATE per table. The number of statements does not
+    depend on the number of deals.
+
+    Parameters:
+        pks (list): primary keys of wholesale deals
+        manufacturer_id (int): primary key of the manufacturer settling the
+            deals. Deals made to other manufacturers are reported as not
+            found.
+
+    Returns a BatchSettlement.
+    """
+
+    counter = QueryCounter()
+    pks = _batch_pks(pks)
+    outcomes = {pk: DealNotFound("This deal does not exist") for pk in pks}
+
+    with connection.execute_wrapper(counter), transaction.atomic():
+        deals = list(WholesaleDeal.objects.select_for_update(of=("self",)).select_related(
+            "car__manufacturer", "dealership").filter(
+            pk__in=pks, car__manufacturer_id=manufacturer_id).order_by("pk"))
+
+        pending = []
+        for deal in deals:
+            if deal.status == WholesaleDeal.PENDING:
+                pending.append(deal)
+            else:
+                outcomes[deal.pk] = DealNotPending("This deal is no longer pending")
+        if not pending:
+            return BatchSettlement(outcomes, counter.count)
+
+        funds = dict(Dealership.objects.select_for_update().filter(
+            pk__in={deal.dealership_id for deal in pending}).order_by("pk").values_list(
+            "pk", "balance"))
+        held = reservations.lock(WholesaleCar, [deal.reservation_id for deal in pending])
+        stock = {pk: amount - reserved for pk, amount, reserved in
+                 WholesaleCar.objects.select_for_update().filter(
+                     pk__in={deal.car_id for deal in pending}).order_by("pk").values_list(
+                     "pk", "amount", "reserved")}
+
+        debits = defaultdict(int)
+        credits = defaultdict(int)
+        bought = defaultdict(int)
+        bought_value = defaultdict(int)
+        sold = defaultdict(int)
+        sold_value = defaultdict(int)
+        taken = defaultdict(int)
+        consumed = []
+        released = defaultdict(int)
+        received = defaultdict(int)
+        facet_entries = []
+        ledger_entries = []
+        accepted = []
+        for deal in pending:
+            car = deal.car
+            if funds.get(deal.dealership_id, 0) < deal.asking_price:
+                outcomes[deal.pk] = InsufficientBalance("The dealership balance is too low")
+                continue
+            reserved = deal.reservation_id in held
+            if not reserved and stock[car.pk] < deal.amount:
+                outcomes[deal.pk] = InsufficientStock("There are not enough cars in stock")
+                continue
+
+            funds[deal.dealership_id] -= deal.asking_price
+            if reserved:
+                consumed.append(deal.reservation_id)
+                released[car.pk] += deal.amount
+            else:
+                stock[car.pk] -= deal.amount
+            debits[deal.dealership_id] -= deal.asking_price
+            credits[car.manufacturer_id] += deal.asking_price
+            bought[deal.dealership_id] += deal.amount
+            bought_value[deal.dealership_id] += deal.amount * car.wholesale_price
+            sold[car.manufacturer_id] -= deal.amount
+            sold_value[car.manufacturer_id] -= deal.amount * car.cost_price
+            taken[car.pk] -= deal.amount
+            key = (car.name, car.wholesale_price, car.manufacturer_id, deal.dealership_id)
+            received[key] += deal.amount
+            facet_entries += [facets.entry(FacetCount.WHOLESALE, car, -deal.amount),
+                              _received(car, deal.dealership, deal.amount)]
+            ledger_entries += [
+                balances.entry(Dealership, deal.dealership_id, -deal.asking_price,
+                               Entry.WHOLESALE_DEAL, deal.pk),
+                balances.entry(Manufacturer, car.manufacturer_id, deal.asking_price,
+                               Entry.WHOLESALE_DEAL, deal.pk),
+            ]
+            accepted.append(deal.pk)
+            outcomes[deal.pk] = None
+
+        if not accepted:
+            return BatchSettlement(outcomes, counter.count)
+
+        counters.add_many(Dealership, balance=debits, cars_in_stock=bought,
+                          stock_value=bought_value)
+        counters.add_many(Manufacturer, balance=credits, cars_in_stock=sold,
+                          stock_value=sold_value,
+                          pending_deal_value={pk: -value for pk, value in credits.items()})
+        balances.record(*ledger_entries)
+        reservations.release_many(WholesaleCar, consumed, released, amount=taken)
+
+        # Create the missing retail cars empty first so that every row can
+        # be locked and topped up below. unique_retail_car skips the ones
+        # that already exist, including any a concurrent settlement just
+        # created. Rows with NULLs are not covered by the constraint.
+        RetailCar.objects.bulk_create([
+            RetailCar(name=name, cost_price=price, retail_price=price, amount=0,
+                      manufacturer_id=manufacturer_id, dealership_id=dealership_id)
+            for name, price, manufacturer_id, dealership_id in received
+            if name is not None and manufacturer_id is not None
+        ], ignore_conflicts=True)
+
+        existing = {}
+        for retail in candidates(
+                RetailCar.objects.select_for_update(),
+                ("name", "cost_price", "manufacturer_id", "dealership_id"),
+                received).order_by("pk"):
+            key = (retail.name, retail.cost_price, retail.manufacturer_id, retail.dealership_id)
+            if key in received and retail.retail_price == retail.cost_price:
+                existing.setdefault(key, retail.pk)
+
+        counters.add_many(RetailCar, amount={
+            existing[key]: amount for key, amount in received.items() if key in existing})
+        RetailCar.objects.bulk_create([
+            RetailCar(name=name, cost_price=price, retail_price=price, amount=amount,
+                      manufacturer_id=manufacturer_id, dealership_id=dealership_id)
+            for (name, price, manufacturer_id, dealership_id), amount in received.items()
+            if (name, price, manufacturer_id, dealership_id) not in existing
+        ])
+        facets.add(*facet_entries)
+        page_cache.invalidate(FacetCount.WHOLESALE, FacetCount.RETAIL)
+
+        WholesaleDeal.objects.filter(pk__in=accepted).update(status=WholesaleDeal.ACCEPTED)
+
+    return BatchSettlement(outcomes, counter.count)
+
+
+def reject_wholesale_deals(pks, manufacturer_id):
+    """
+    Rejects several pending wholesale deals made to one manufacturer.
+
+    Parameters:
+        pks (list): primary keys of wholesale deals
+        manufacturer_id (int): primary key of the manufacturer rejecting
+            the deals
+
+    Returns a BatchSettlement.
+    """
+
+    counter = QueryCounter()
+    pks = _batch_pks(pks)
+    outcomes = {pk: DealNotFound("This deal does not exist") for pk in pks}
+
+    with connection.execute_wrapper(counter), transaction.atomic():
+        deals = WholesaleDeal.objects.select_for_update(of=("self",)).filter(
+            pk__in=pks, car__manufacturer_id=manufacturer_id).order_by("pk").values_list(
+            "pk", "status", "asking_price", "car__manufacturer_id", "car_id", "amount",
+            "reservation_id")
+        rejected = []
+        pending = defaultdict(int)
+        reserved = {}
+        for pk, status, asking_price, manufacturer_id, car_id, amount, reservation_id in deals:
+            if status == WholesaleDeal.PENDING:
+                outcomes[pk] = None
+                rejected.append(pk)
+                pending[manufacturer_id] -= asking_price
+                if reservation_id is not None:
+                    reserved[reservation_id] = (car_id, amount)
+            else:
+                outcomes[pk] = DealNotPending("This deal is no longer pending")
+        if rejected:
+            WholesaleDeal.objects.filter(pk__in=rejected).update(status=WholesaleDeal.REJECTED)
+            counters.add_many(Manufacturer, pending_deal_value=pending)
+            held = reservations.lock(WholesaleCar, reserved)
+            released = defaultdict(int)
+            for reservation_id in held:
+                car_id, amount = reserved[reservation_id]
+                released[car_id] += amount
+            reservations.release_many(WholesaleCar, held, released)
+
+    return BatchSettlement(outcomes, counter.count)
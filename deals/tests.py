@@ -1,13 +1,28 @@
-from django.test import TestCase
+import csv
+import datetime
+import io
+import json
+import threading
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import TestCase, TransactionTestCase
 from django.urls import reverse
+from django.utils import timezone
 from guardian.shortcuts import assign_perm
 
 from dealerships.models import Dealership
 from inventory.models import RetailCar, WholesaleCar
+from inventory.pagination import encode_cursor
 from manufacturers.models import Manufacturer
 from users.models import User
 
 from .models import RetailDeal, WholesaleDeal
+from .settlement import (DealNotFound, DealNotPending, SettlementError,
+                         InsufficientBalance, InsufficientStock,
+                         reject_wholesale_deals, settle_retail_deal,
+                         settle_wholesale_deal, settle_wholesale_deals)
 
 # Create your tests here.
 
@@ -87,6 +102,17 @@ class WholesaleDealTestCase(TestCase):
         new_response = self.client.get(reverse("user:profile"))
         self.assertContains(new_response, "Balance: $15,000")
 
+    def test_other_manufacturer_accept_wholesale_deal(self):
+        wd = WholesaleDeal.objects.create(car=self.w_car, asking_price=5000, amount=5,
+                                          dealership=self.dealership)
+        assign_perm("change_wholesaledeal", self.manu_admin, wd)
+        other_admin = User.objects.create(username="other_admin", user_type=User.MANUFACTURER)
+        self.client.force_login(other_admin)
+        response = self.client.get(
+            reverse("deals:wholesale_deal_accept", kwargs={"pk": wd.pk}))
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(WholesaleDeal.objects.get(pk=wd.pk).status, WholesaleDeal.PENDING)
+
     def test_reject_wholesale_deal(self):
         wd = WholesaleDeal.objects.create(car=self.w_car, asking_price=5000, amount=5,
                                           dealership=self.dealership)
@@ -118,6 +144,17 @@ class WholesaleDealTestCase(TestCase):
             reverse("deals:wholesale_deal_create", kwargs={"pk": self.w_car.pk}))
         self.assertEqual(post_response.status_code, 403)
 
+    def test_wholesale_deal_list_query_count(self):
+        self.client.force_login(self.manu_admin)
+        for _ in range(2):
+            for i in range(10):
+                dealership = Dealership.objects.create(name="Dealership %d" % i)
+                WholesaleDeal.objects.create(car=self.w_car, asking_price=5000, amount=1,
+                                             dealership=dealership)
+            # session, user, deals, user and group object permissions
+            with self.assertNumQueries(5):
+                self.client.get(reverse("deals:from_dealerships"))
+
     def test_others_wholesale_deal_detail(self):
         wd = WholesaleDeal.objects.create(car=self.w_car, asking_price=5000, amount=5,
                                           dealership=self.dealership)
@@ -255,3 +292,403 @@ class RetailCarTestCase(TestCase):
         response = self.client.get(
             reverse("deals:retail_deal_detail", kwargs={"pk": rd.pk}))
         self.assertEqual(response.status_code, 403)
+
+
+
+####################################################
+
+
+class SettlementTestCase(TestCase):
+    def setUp(self):
+        self.manufacturer = Manufacturer.objects.create(name="Test Manufacturer", balance=0)
+        self.dealership = Dealership.objects.create(name="Test Dealership", balance=20000)
+        self.customer = User.objects.create(
+            username="customer", user_type=User.CUSTOMER, balance=30000)
+        self.w_car = WholesaleCar.objects.create(
+            name="Model-100", amount=10, manufacturer=self.manufacturer, wholesale_price=2000)
+        self.r_car = RetailCar.objects.create(
+            name="Model-100", amount=2, dealership=self.dealership,
+            manufacturer=self.manufacturer, retail_price=2000)
+
+    def test_settle_wholesale_deal(self):
+        wd = WholesaleDeal.objects.create(car=self.w_car, asking_price=5000, amount=4,
+                                          dealership=self.dealership)
+        settlement = settle_wholesale_deal(wd.pk)
+        self.assertEqual(settlement.deal.status, WholesaleDeal.ACCEPTED)
+        self.assertLessEqual(settlement.queries, 13)
+
+        self.dealership.refresh_from_db()
+        self.manufacturer.refresh_from_db()
+        self.w_car.refresh_from_db()
+        self.assertEqual(self.dealership.balance, 15000)
+        self.assertEqual(self.manufacturer.balance, 5000)
+        self.assertEqual(self.w_car.amount, 6)
+        retail = RetailCar.objects.get(dealership=self.dealership, cost_price=2000)
+        self.assertEqual(retail.amount, 4)
+
+        # A second acceptance is refused
+        with self.assertRaises(DealNotPending):
+            settle_wholesale_deal(wd.pk)
+
+    def test_settle_wholesale_deal_out_of_stock(self):
+        wd = WholesaleDeal.objects.create(car=self.w_car, asking_price=5000, amount=11,
+                                          dealership=self.dealership)
+        with self.assertRaises(InsufficientStock):
+            settle_wholesale_deal(wd.pk)
+        # Nothing is written when the settlement fails
+        self.dealership.refresh_from_db()
+        self.manufacturer.refresh_from_db()
+        self.assertEqual(self.dealership.balance, 20000)
+        self.assertEqual(self.manufacturer.balance, 0)
+        self.assertEqual(WholesaleDeal.objects.get(pk=wd.pk).status, WholesaleDeal.PENDING)
+
+    def test_settle_wholesale_deal_low_balance(self):
+        wd = WholesaleDeal.objects.create(car=self.w_car, asking_price=50000, amount=1,
+                                          dealership=self.dealership)
+        with self.assertRaises(InsufficientBalance):
+            settle_wholesale_deal(wd.pk)
+        self.w_car.refresh_from_db()
+        self.assertEqual(self.w_car.amount, 10)
+
+    def test_settle_retail_deal(self):
+        rd = RetailDeal.objects.create(car=self.r_car, asking_price=5000, amount=2,
+                                       customer=self.customer)
+        settle_retail_deal(rd.pk)
+        self.customer.refresh_from_db()
+        self.dealership.refresh_from_db()
+        self.r_car.refresh_from_db()
+        self.assertEqual(self.customer.balance, 25000)
+        self.assertEqual(self.dealership.balance, 25000)
+        self.assertEqual(self.r_car.amount, 0)
+
+        rd = RetailDeal.objects.create(car=self.r_car, asking_price=5000, amount=1,
+                                       customer=self.customer)
+        with self.assertRaises(InsufficientStock):
+            settle_retail_deal(rd.pk)
+
+
+class BulkSettlementTestCase(TestCase):
+    def setUp(self):
+        self.manu_admin = User.objects.create(
+            username="manu_admin", user_type=User.MANUFACTURER)
+        self.manufacturer = Manufacturer.objects.create(
+            name="Test Manufacturer", balance=0, admin=self.manu_admin)
+        self.other_manufacturer = Manufacturer.objects.create(name="Other Manufacturer")
+        self.w_car = WholesaleCar.objects.create(
+            name="Model-100", amount=100, manufacturer=self.manufacturer, wholesale_price=2000)
+
+    def create_deals(self, count, **kwargs):
+        dealership = Dealership.objects.create(name="Test Dealership", balance=10000 * count)
+        return [
+            WholesaleDeal.objects.create(car=self.w_car, asking_price=1000, amount=1,
+                                         dealership=dealership, **kwargs)
+            for _ in range(count)
+        ]
+
+    def test_settle_wholesale_deals(self):
+        deals = self.create_deals(3)
+        poor = Dealership.objects.create(name="Poor Dealership", balance=500)
+        poor_deal = WholesaleDeal.objects.create(car=self.w_car, asking_price=1000, amount=1,
+                                                 dealership=poor)
+        greedy_deal = WholesaleDeal.objects.create(car=self.w_car, asking_price=1000, amount=101,
+                                                   dealership=deals[0].dealership)
+        other_car = WholesaleCar.objects.create(
+            name="Model-200", amount=100, manufacturer=self.other_manufacturer)
+        other_deal = WholesaleDeal.objects.create(car=other_car, asking_price=1000, amount=1,
+                                                  dealership=poor)
+
+        result = settle_wholesale_deals(
+            [deal.pk for deal in deals] + [poor_deal.pk, greedy_deal.pk, other_deal.pk],
+            self.manufacturer.pk)
+
+        self.assertEqual(result.succeeded, [deal.pk for deal in deals])
+        self.assertIsInstance(result.outcomes[poor_deal.pk], InsufficientBalance)
+        self.assertIsInstance(result.outcomes[greedy_deal.pk], InsufficientStock)
+        self.assertIsInstance(result.outcomes[other_deal.pk], DealNotFound)
+
+        self.manufacturer.refresh_from_db()
+        self.w_car.refresh_from_db()
+        dealership = Dealership.objects.get(pk=deals[0].dealership_id)
+        self.assertEqual(self.manufacturer.balance, 3000)
+        self.assertEqual(self.w_car.amount, 97)
+        self.assertEqual(dealership.balance, 27000)
+        self.assertEqual(RetailCar.objects.get(dealership=dealership).amount, 3)
+        self.assertEqual(
+            WholesaleDeal.objects.filter(status=WholesaleDeal.ACCEPTED).count(), 3)
+
+        # Settling again reports the deals as no longer pending
+        result = settle_wholesale_deals([deals[0].pk], self.manufacturer.pk)
+        self.assertIsInstance(result.outcomes[deals[0].pk], DealNotPending)
+
+    def test_settle_wholesale_deals_query_count(self):
+        small = settle_wholesale_deals(
+            [deal.pk for deal in self.create_deals(2)], self.manufacturer.pk)
+        large = settle_wholesale_deals(
+            [deal.pk for deal in self.create_deals(40)], self.manufacturer.pk)
+        self.assertEqual(len(large.succeeded), 40)
+        self.assertEqual(small.queries, large.queries)
+
+    def test_settle_wholesale_deals_of_many_cars(self):
+        # One retail car per wholesale car; more than SQLite nests in an expression
+        dealership = Dealership.objects.create(name="Test Dealership", balance=10 ** 7)
+        WholesaleCar.objects.bulk_create([
+            WholesaleCar(name="Model-%d" % i, amount=1, manufacturer=self.manufacturer,
+                         wholesale_price=1000)
+            for i in range(1100)
+        ])
+        WholesaleDeal.objects.bulk_create([
+            WholesaleDeal(car=car, asking_price=1000, amount=1, dealership=dealership,
+                          manufacturer=self.manufacturer)
+            for car in WholesaleCar.objects.filter(name__startswith="Model-", amount=1)
+        ])
+        RetailCar.objects.create(name="Model-0", cost_price=1000, retail_price=1000, amount=2,
+                                 manufacturer=self.manufacturer, dealership=dealership)
+
+        result = settle_wholesale_deals(
+            WholesaleDeal.objects.values_list("pk", flat=True), self.manufacturer.pk)
+        self.assertEqual(len(result.succeeded), 1100)
+        self.assertEqual(RetailCar.objects.filter(dealership=dealership).count(), 1100)
+        self.assertEqual(RetailCar.objects.get(name="Model-0").amount, 3)
+
+    def test_reject_wholesale_deals(self):
+        deals = self.create_deals(3)
+        WholesaleDeal.objects.filter(pk=deals[0].pk).update(status=WholesaleDeal.ACCEPTED)
+        result = reject_wholesale_deals([deal.pk for deal in deals], self.manufacturer.pk)
+        self.assertEqual(result.succeeded, [deals[1].pk, deals[2].pk])
+        self.assertIsInstance(result.outcomes[deals[0].pk], DealNotPending)
+        self.assertEqual(
+            WholesaleDeal.objects.filter(status=WholesaleDeal.REJECTED).count(), 2)
+
+    def test_bulk_wholesale_deal_view(self):
+        deals = self.create_deals(2)
+        self.client.force_login(self.manu_admin)
+        response = self.client.post(reverse("deals:wholesale_deal_bulk"), data={
+            "deals": [deal.pk for deal in deals],
+            "action": "accept",
+        }, follow=True)
+        self.assertRedirects(response, reverse("deals:from_dealerships"))
+        self.assertContains(response, "2 deals accepted")
+
+        response = self.client.post(reverse("deals:wholesale_deal_bulk"), data={
+            "deals": [deals[0].pk],
+            "action": "reject",
+        }, follow=True)
+        self.assertContains(response, "Deal %d: This deal is no longer pending" % deals[0].pk)
+
+    def test_bulk_wholesale_deal_view_of_affiliation(self):
+        # Only deals made to the manufacturer the admin acts for are settled
+        Manufacturer.objects.filter(pk=self.other_manufacturer.pk).update(admin=self.manu_admin)
+        other_car = WholesaleCar.objects.create(
+            name="Model-200", amount=100, manufacturer=self.other_manufacturer)
+        other_deal = WholesaleDeal.objects.create(
+            car=other_car, asking_price=1000, amount=1,
+            dealership=Dealership.objects.create(name="Test Dealership", balance=10000))
+        self.client.force_login(self.manu_admin)
+        response = self.client.post(reverse("deals:wholesale_deal_bulk"), data={
+            "deals": [other_deal.pk],
+            "action": "accept",
+        }, follow=True)
+        self.assertContains(response, "Deal %d: This deal does not exist" % other_deal.pk)
+        other_deal.refresh_from_db()
+        self.assertEqual(other_deal.status, WholesaleDeal.PENDING)
+
+    def test_others_bulk_wholesale_deal_view(self):
+        deals = self.create_deals(1)
+        dealer_admin = User.objects.create(username="dealer_admin", user_type=User.DEALERSHIP)
+        self.client.force_login(dealer_admin)
+        response = self.client.post(reverse("deals:wholesale_deal_bulk"), data={
+            "deals": [deals[0].pk],
+            "action": "accept",
+        })
+        self.assertEqual(response.status_code, 403)
+
+
+class SettlementConcurrencyTestCase(TransactionTestCase):
+    def setUp(self):
+        self.manufacturer = Manufacturer.objects.create(name="Test Manufacturer", balance=0)
+        self.dealership = Dealership.objects.create(name="Test Dealership", balance=1000000)
+        self.w_car = WholesaleCar.objects.create(
+            name="Model-100", amount=10, manufacturer=self.manufacturer, wholesale_price=2000)
+
+    def test_concurrent_wholesale_settlements_do_not_oversell(self):
+        deals = [
+            WholesaleDeal.objects.create(car=self.w_car, asking_price=1000, amount=3,
+                                         dealership=self.dealership)
+            for _ in range(6)
+        ]
+        barrier = threading.Barrier(len(deals))
+
+        def accept(pk):
+            barrier.wait()
+            try:
+                settle_wholesale_deal(pk)
+            except (SettlementError, OperationalError):
+                # SQLite reports write contention as OperationalError
+                pass
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=accept, args=(deal.pk,)) for deal in deals]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        accepted = WholesaleDeal.objects.filter(status=WholesaleDeal.ACCEPTED).count()
+        self.w_car.refresh_from_db()
+        self.dealership.refresh_from_db()
+        self.manufacturer.refresh_from_db()
+        self.assertLessEqual(accepted, 3)
+        self.assertEqual(self.w_car.amount, 10 - 3 * accepted)
+        self.assertEqual(self.dealership.balance, 1000000 - 1000 * accepted)
+        self.assertEqual(self.manufacturer.balance, 1000 * accepted)
+
+
+class ExportTestCase(TestCase):
+    """
+    Tests to ascertain that deals, inventory and manufacturing orders are
+    streamed to staff as CSV and JSON Lines, with date and status filters
+    """
+    def setUp(self):
+        self.staff = User.objects.create(username="finance", is_staff=True)
+        self.dealer_admin = User.objects.create(
+            username="dealer_admin", user_type=User.DEALERSHIP)
+        self.manufacturer = Manufacturer.objects.create(name="Naija", balance=1000)
+        self.dealership = Dealership.objects.create(name="Lagos Motors", balance=1000)
+        self.car = WholesaleCar.objects.create(
+            name="Model-100", amount=10, manufacturer=self.manufacturer, wholesale_price=2000)
+        self.deals = [WholesaleDeal.objects.create(
+            car=self.car, asking_price=price, amount=1, dealership=self.dealership)
+            for price in (1000, 2000, 3000)]
+        WholesaleDeal.objects.filter(pk=self.deals[0].pk).update(
+            status=WholesaleDeal.ACCEPTED,
+            created_at=timezone.make_aware(datetime.datetime(2020, 5, 1, 12)))
+        self.client.force_login(self.staff)
+
+    def export(self, name, format, **params):
+        return self.client.get(reverse("deals:export", kwargs={"name": name, "format": format}),
+                               data=params)
+
+    def content(self, response):
+        return b"".join(response.streaming_content).decode()
+
+    def test_csv(self):
+        response = self.export("wholesale-deals", "csv")
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertIn('filename="wholesale-deals.csv"', response["Content-Disposition"])
+        rows = list(csv.reader(io.StringIO(self.content(response))))
+        self.assertEqual(rows[0][:3], ["id", "created_at", "status"])
+        self.assertEqual([row[0] for row in rows[1:]], [str(deal.pk) for deal in self.deals])
+        self.assertEqual(rows[1][4:], ["Model-100", "Naija", "Lagos Motors", "1", "1000"])
+
+    def test_jsonl_filters(self):
+        response = self.export("wholesale-deals", "jsonl", since="2020-05-01",
+                               until="2020-05-01")
+        rows = [json.loads(line) for line in self.content(response).splitlines()]
+        self.assertEqual([row["id"] for row in rows], [self.deals[0].pk])
+        self.assertEqual(rows[0]["created_at"], "2020-05-01T11:00:00Z")
+
+        response = self.export("wholesale-deals", "jsonl", status="PE")
+        rows = [json.loads(line) for line in self.content(response).splitlines()]
+        self.assertEqual([row["asking_price"] for row in rows], [2000, 3000])
+
+        response = self.export("wholesale-cars", "jsonl")
+        self.assertEqual(json.loads(self.content(response))["amount"], 10)
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.export("wholesale-deals", "csv", since="May").status_code, 400)
+        self.assertEqual(self.export("wholesale-deals", "csv", status="XX").status_code, 400)
+        self.assertEqual(self.export("wholesale-cars", "csv", status="PE").status_code, 400)
+        self.assertEqual(self.export("wholesale-deals", "xml").status_code, 400)
+        self.assertEqual(self.export("users", "csv").status_code, 404)
+
+        self.client.force_login(self.dealer_admin)
+        self.assertEqual(self.export("wholesale-deals", "csv").status_code, 403)
+
+    def test_export_data_command(self):
+        out = io.StringIO()
+        call_command("export_data", "wholesale-deals", format="jsonl", status="AC", stdout=out)
+        self.assertEqual([json.loads(line)["id"] for line in out.getvalue().splitlines()],
+                         [self.deals[0].pk])
+
+
+class DealListTestCase(TestCase):
+    """
+    Tests to ascertain that the deal lists show one status at a time,
+    newest first, in pages
+    """
+    def setUp(self):
+        self.manu_admin = User.objects.create(username="manu_admin",user_type=User.MANUFACTURER)
+        self.dealer_admin = User.objects.create(username="dealer_admin",user_type=User.DEALERSHIP)
+        self.customer = User.objects.create(username="customer",user_type=User.CUSTOMER)
+        self.manufacturer = Manufacturer.objects.create(name="Test Manufacturer",
+            admin=self.manu_admin)
+        self.dealership = Dealership.objects.create(name="Test Dealership",
+            admin=self.dealer_admin)
+        self.w_car = WholesaleCar.objects.create(name="Model-100", amount=30,
+            manufacturer=self.manufacturer, wholesale_price=2000)
+        self.r_car = RetailCar.objects.create(name="Model-200", amount=30,
+            dealership=self.dealership, manufacturer=self.manufacturer, retail_price=2000)
+        other = Manufacturer.objects.create(name="Other Manufacturer")
+        other_car = WholesaleCar.objects.create(name="Model-300", manufacturer=other)
+
+        self.wholesale_deals = [WholesaleDeal.objects.create(car=self.w_car, amount=1,
+            dealership=self.dealership) for _ in range(30)]
+        self.retail_deals = [RetailDeal.objects.create(car=self.r_car, amount=1,
+            customer=self.customer) for _ in range(3)]
+        WholesaleDeal.objects.create(car=other_car, dealership=self.dealership)
+        WholesaleDeal.objects.filter(pk=self.wholesale_deals[0].pk).update(
+            status=WholesaleDeal.ACCEPTED)
+
+    def ids(self, response):
+        return [deal.pk for deal in response.context_data["deals"]]
+
+    def test_parties_are_copied_from_the_car(self):
+        self.assertEqual(self.wholesale_deals[0].manufacturer_id, self.manufacturer.pk)
+        self.assertEqual(self.retail_deals[0].dealership_id, self.dealership.pk)
+
+    def test_pages_of_pending_deals(self):
+        self.client.force_login(self.manu_admin)
+        pending = [deal.pk for deal in reversed(self.wholesale_deals[1:])]
+
+        response = self.client.get(reverse("deals:from_dealerships"))
+        self.assertEqual(self.ids(response), pending[:25])
+        self.assertContains(response, 'name="deals"', count=25)
+        cursor = response.context_data["page_obj"].next_cursor
+        self.assertContains(response, "?status=PE&amp;after=%s" % cursor)
+
+        response = self.client.get(reverse("deals:from_dealerships"),
+            data={"status": "PE", "after": cursor})
+        self.assertEqual(self.ids(response), pending[25:])
+        self.assertFalse(response.context_data["page_obj"].has_next())
+
+        response = self.client.get(reverse("deals:from_dealerships"), data={"status": "AC"})
+        self.assertEqual(self.ids(response), [self.wholesale_deals[0].pk])
+        self.assertNotContains(response, "Accept Selected")
+
+    def test_outgoing_deals(self):
+        self.client.force_login(self.dealer_admin)
+        response = self.client.get(reverse("deals:to_manufacturers"))
+        self.assertContains(response, "Manufacturer: <b>Other Manufacturer</b>")
+        self.assertEqual(len(response.context_data["deals"]), 25)
+
+        self.client.force_login(self.customer)
+        response = self.client.get(reverse("deals:to_dealerships"), data={"status": "??"})
+        self.assertEqual(self.ids(response), [deal.pk for deal in reversed(self.retail_deals)])
+        self.assertContains(response, "Dealership: <b>Test Dealership</b>")
+        self.assertContains(response, "Car: Test Manufacturer Model-200")
+
+        for values in ([{"a": 1}], [[1, 2]], ["abc"]):
+            response = self.client.get(reverse("deals:to_dealerships"),
+                data={"after": encode_cursor(values)})
+            self.assertEqual(response.status_code, 404, values)
+
+    def test_query_count(self):
+        self.client.force_login(self.dealer_admin)
+        # session, user, deals
+        with self.assertNumQueries(3):
+            self.client.get(reverse("deals:to_manufacturers"))
+        # and the content type, user and group object permissions
+        ContentType.objects.clear_cache()
+        with self.assertNumQueries(6):
+            self.client.get(reverse("deals:from_customers"))
@@ -1,12 +1,13 @@
 from django.urls import path
 from .views import (WholesaleDealCreateView, WholesaleDealDetailView, WholesaleDealListView, 
-acceptWholesaleDeal, rejectWholesaleDeal, RetailDealCreateView, RetailDealDetailView, RetailDealListView,
-acceptRetailDeal, rejectRetailDeal, ToDealershipsListView, ToManufacturersListView)
+acceptWholesaleDeal, rejectWholesaleDeal, bulkWholesaleDeal, RetailDealCreateView, RetailDealDetailView, RetailDealListView,
+acceptRetailDeal, rejectRetailDeal, ToDealershipsListView, ToManufacturersListView, ExportView)
 
 app_name = "deals"
 urlpatterns = [
     path('create-wholesale-deal/<pk>/', WholesaleDealCreateView.as_view(), name='wholesale_deal_create'),
     path('from-dealerships/', WholesaleDealListView.as_view(), name='from_dealerships'),
+    path('from-dealerships/bulk/', bulkWholesaleDeal, name='wholesale_deal_bulk'),
     path('from-dealerships/<pk>/accept/', acceptWholesaleDeal, name='wholesale_deal_accept'),
     path('from-dealerships/<pk>/reject/', rejectWholesaleDeal, name='wholesale_deal_reject'),
     path('wholesale-deal-<pk>/', WholesaleDealDetailView.as_view(), name='wholesale_deal_detail'),
@@ -18,4 +19,6 @@ urlpatterns = [
 
     path('to-dealerships/', ToDealershipsListView.as_view(), name='to_dealerships'),
     path('to-manufacturers/', ToManufacturersListView.as_view(), name='to_manufacturers'),
+
+    path('export/<slug:name>.<slug:format>', ExportView.as_view(), name='export'),
 ]
\ No newline at end of file
@@ -1,21 +1,34 @@
 from django import forms
+from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import PermissionDenied
 from django.db import transaction
-from django.db.models import F
+from django.http import Http404, HttpResponseBadRequest, StreamingHttpResponse
 from django.shortcuts import redirect, render
-from django.views.generic import CreateView, DetailView, ListView
+from django.views.decorators.http import require_POST
+from django.views.generic import CreateView, DetailView, ListView, View
 
+from dealerships.models import Dealership
+from inventory import counters, reservations
 from inventory.models import RetailCar, WholesaleCar
-from users.permissions import (UserIsCustomer, UserIsDealership,
-							   UserIsManufacturer, UserIsNotCustomer,
-							   UserIsNotManufacturer)
-
+from inventory.pagination import KeysetPaginationMixin
+from manufacturers.models import Manufacturer
+from users.affiliation import affiliation_id, owner_id
+from users.permissions import (CachedPermissionRequiredMixin,
+							   PrefetchPermissionsMixin, UserIsCustomer,
+							   UserIsDealership, UserIsManufacturer,
+							   UserIsNotCustomer, UserIsNotManufacturer, UserIsStaff,
+							   assign_object_perm, get_permission_cache,
+							   user_is_manufacturer)
+
+from . import exports
 from .models import RetailDeal, WholesaleDeal
+from .settlement import (SettlementError, reject_retail_deal,
+						 reject_wholesale_deal, reject_wholesale_deals,
+						 settle_retail_deal, settle_wholesale_deal,
+						 settle_wholesale_deals)
 
 # Create your views here.
-from guardian.shortcuts import assign_perm
-from guardian.mixins import PermissionRequiredMixin
 
 class WholesaleDealForm(forms.ModelForm):
 	"""Form definition for WholesaleDeal.
@@ -40,7 +53,7 @@ class WholesaleDealForm(forms.ModelForm):
 		Sets the car field queryset to show only the car involved in the deal
 		Sets the initial asking price to the car selling price (to encourage higher prices).
 		Sets the amount field widget attributes:
-			maximum value: to total number of wholesale cars in stock
+			maximum value: to the number of wholesale cars available
 			minimum: to 1
 
 		"""
@@ -51,7 +64,7 @@ class WholesaleDealForm(forms.ModelForm):
 		self.initial['asking_price'] = car_queryset[0].wholesale_price
 		self.fields['car'].queryset = car_queryset
 		self.fields['amount'].widget.attrs.update({
-			"max": car_queryset[0].amount,
+			"max": car_queryset[0].available,
 			"min": 1
 		})
 
@@ -73,26 +86,39 @@ class WholesaleDealCreateView(UserIsDealership, CreateView):
 		return WholesaleDealForm(car_pk, **self.get_form_kwargs())
 
 	def form_valid(self, form):
-		""" Creates the deals or displays an error if dealership balance is low. """
+		"""
+		Creates the deal, reserving its cars, or displays an error if the
+		dealership balance is low or too few cars are available.
+		"""
 
 		total_cost = form.instance.asking_price
-		form.instance.dealership = self.request.user.dealership_set.get()
+		if not self.request.affiliation:
+			raise PermissionDenied
+		form.instance.dealership = self.request.affiliation
 
 		if form.instance.dealership.balance < total_cost:
 			form.add_error(field=None, error="Your balance is too low")
 			return self.form_invalid(form)
 
-		deal = form.save()
+		try:
+			with transaction.atomic():
+				counters.add(Manufacturer, form.instance.car.manufacturer_id, pending=total_cost)
+				form.instance.reservation = reservations.reserve(
+					WholesaleCar, form.instance.car_id, form.instance.amount)
+				deal = form.save()
+		except reservations.NotAvailable as error:
+			form.add_error(field=None, error=str(error))
+			return self.form_invalid(form)
 
 		manufacturer_admin = form.instance.car.manufacturer.admin
-		assign_perm("view_wholesaledeal", self.request.user, deal)
-		assign_perm("view_wholesaledeal", manufacturer_admin, deal)
-		assign_perm("change_wholesaledeal", manufacturer_admin, deal)
+		assign_object_perm("view_wholesaledeal", self.request.user, deal)
+		assign_object_perm("view_wholesaledeal", manufacturer_admin, deal)
+		assign_object_perm("change_wholesaledeal", manufacturer_admin, deal)
 
 		return super().form_valid(form)
 
 
-class WholesaleDealDetailView(PermissionRequiredMixin, DetailView):
+class WholesaleDealDetailView(CachedPermissionRequiredMixin, DetailView):
 	""" Detail view for wholesale deals. """
 
 	model = WholesaleDeal
@@ -103,28 +129,64 @@ class WholesaleDealDetailView(PermissionRequiredMixin, DetailView):
 	raise_exception = True
 
 
-class WholesaleDealListView(UserIsManufacturer, ListView):
-	""" List view showing all deals made to a manufacturer by dealership admins."""
+class DealListMixin(KeysetPaginationMixin):
+	"""
+	ListView mixin showing one status of a deal list at a time (?status=,
+	pending deals by default), newest first, a page at a time.
+
+	Each list is a range of one of the (status, party, id) indexes of the
+	deal models, so every page costs the same whatever the number of deals.
+	"""
+
+	paginate_by = 25
+	cursor_fields = ("-pk",)
+
+	def get_status(self):
+		status = self.request.GET.get("status")
+		if status not in dict(WholesaleDeal.STATUS):
+			return WholesaleDeal.PENDING
+		return status
+
+	def get_affiliation_id(self):
+		""" The pk of the manufacturer or dealership of the user. """
+
+		pk = affiliation_id(self.request)
+		if pk is None:
+			raise PermissionDenied
+		return pk
+
+	def get_context_data(self, **kwargs):
+		context = super().get_context_data(**kwargs)
+		context["status"] = self.get_status()
+		context["statuses"] = WholesaleDeal.STATUS
+		return context
+
+
+class WholesaleDealListView(UserIsManufacturer, PrefetchPermissionsMixin, DealListMixin, ListView):
+	""" List view showing the deals made to a manufacturer by dealership admins."""
 
 	template_name = "wholesale_deal_list.html"
 	context_object_name = "deals"
 
 	def get_queryset(self):
-		return WholesaleDeal.objects.filter(car__manufacturer__admin=self.request.user)
+		return WholesaleDeal.objects.filter(
+			status=self.get_status(),
+			manufacturer_id=self.get_affiliation_id()).for_listing()
 
 
-class RetailDealListView(UserIsDealership, ListView):
-	""" List view showing all deals made to a dealership by customers. """
+class RetailDealListView(UserIsDealership, PrefetchPermissionsMixin, DealListMixin, ListView):
+	""" List view showing the deals made to a dealership by customers. """
 
 	template_name = "retail_deal_list.html"
 	context_object_name = "deals"
 
 	def get_queryset(self):
-		return RetailDeal.objects.filter(car__dealership__admin=self.request.user)
+		return RetailDeal.objects.filter(
+			status=self.get_status(),
+			dealership_id=self.get_affiliation_id()).for_listing()
 
 
 @login_required
-@transaction.atomic
 def acceptWholesaleDeal(request, pk):
 	""" View to accept a wholesale deal
 
@@ -143,63 +205,76 @@ def acceptWholesaleDeal(request, pk):
 	"""
 
 	deal = WholesaleDeal.objects.get(pk=pk)
-	manufacturer = deal.car.manufacturer
 
-	if not manufacturer.admin.has_perm("change_wholesaledeal", deal):	
+	if not get_permission_cache(request).has_perm("change_wholesaledeal", deal):
 		raise PermissionDenied
 
-	total_cost = deal.asking_price
-	dealership_balance = deal.dealership.balance
-	if deal.status == WholesaleDeal.PENDING and dealership_balance >= total_cost:
-
-		deal.dealership.balance = F('balance') - total_cost
-		deal.dealership.save()
-
-		manufacturer.balance = F('balance') + total_cost
-		manufacturer.save()
-
-		retail, _ = RetailCar.objects.update_or_create(
-			name=deal.car.name,
-			cost_price=deal.car.wholesale_price,
-			retail_price=deal.car.wholesale_price,
-			manufacturer=deal.car.manufacturer,
-			dealership=deal.dealership
-		)
-		retail.amount = F('amount') + deal.amount
-		retail.save()
+	try:
+		settle_wholesale_deal(pk)
+	except SettlementError as error:
+		messages.error(request, str(error))
 
-		deal.car.amount = F('amount') - deal.amount
-		deal.car.save()
-
-		deal.status = WholesaleDeal.ACCEPTED
-		deal.save()
-
-		return redirect("deals:wholesale_deal_detail", pk)
-	else:
-		return redirect("deals:wholesale_deal_detail", pk)
+	return redirect("deals:wholesale_deal_detail", pk)
 
 
 @login_required
 def rejectWholesaleDeal(request, pk):
 	""" View to reject a wholesale deal.
 
-	This view sets the deal status to REJECTED.
+	This view sets the deal status to REJECTED and releases the cars
+	reserved for it.
 	Redirects to the wholesale deal detail view.
 	"""
 
 	deal = WholesaleDeal.objects.get(pk=pk)
-	manufacturer = deal.car.manufacturer
 
-	if not manufacturer.admin.has_perm("change_wholesaledeal", deal):	
+	if not get_permission_cache(request).has_perm("change_wholesaledeal", deal):
 		raise PermissionDenied
 
-	if deal.status == WholesaleDeal.PENDING:
-		deal.status = WholesaleDeal.REJECTED
-		deal.save()
+	try:
+		reject_wholesale_deal(pk)
+	except SettlementError as error:
+		messages.error(request, str(error))
 
 	return redirect("deals:wholesale_deal_detail", pk)
 
 
+@login_required
+@require_POST
+def bulkWholesaleDeal(request):
+	""" View to accept or reject several wholesale deals at once.
+
+	Expects the primary keys of the deals in the "deals" POST field and
+	"accept" or "reject" in the "action" field. All deals are settled in a
+	single transaction; deals that could not be settled are reported
+	one by one as messages.
+
+	Redirects to the wholesale deal list view
+	"""
+
+	manufacturer_id = owner_id(request)
+	if not user_is_manufacturer(request.user) or manufacturer_id is None:
+		raise PermissionDenied
+
+	pks = [pk for pk in request.POST.getlist("deals") if pk.isdigit()]
+	action = request.POST.get("action")
+	if action == "accept":
+		result = settle_wholesale_deals(pks, manufacturer_id)
+		done = "accepted"
+	elif action == "reject":
+		result = reject_wholesale_deals(pks, manufacturer_id)
+		done = "rejected"
+	else:
+		return HttpResponseBadRequest("Unknown action")
+
+	if result.succeeded:
+		messages.success(request, "%d deals %s" % (len(result.succeeded), done))
+	for pk, error in result.failed.items():
+		messages.error(request, "Deal %d: %s" % (pk, error))
+
+	return redirect("deals:from_dealerships")
+
+
 class RetailDealForm(forms.ModelForm):
 	"""Form definition for RetailDeal.
 
@@ -241,23 +316,34 @@ class RetailDealCreateView(UserIsCustomer, CreateView):
 		return RetailDealForm(car_pk, **self.get_form_kwargs())
 
 	def form_valid(self, form):
-		""" Creates the deal or displays an error if customer balance is low. """
+		"""
+		Creates the deal, reserving its car, or displays an error if the
+		customer balance is low or the car is no longer available.
+		"""
 		total_cost = form.instance.asking_price
 		if self.request.user.balance < total_cost:
 			form.add_error(field=None, error="Your balance is too low")
 			return self.form_invalid(form)
 		form.instance.customer = self.request.user
-		deal = form.save()
+		try:
+			with transaction.atomic():
+				counters.add(Dealership, form.instance.car.dealership_id, pending=total_cost)
+				form.instance.reservation = reservations.reserve(
+					RetailCar, form.instance.car_id, form.instance.amount)
+				deal = form.save()
+		except reservations.NotAvailable as error:
+			form.add_error(field=None, error=str(error))
+			return self.form_invalid(form)
 
 		dealership_admin = form.instance.car.dealership.admin
-		assign_perm("view_retaildeal", self.request.user, deal)
-		assign_perm("view_retaildeal", dealership_admin, deal)
-		assign_perm("change_retaildeal", dealership_admin, deal)
+		assign_object_perm("view_retaildeal", self.request.user, deal)
+		assign_object_perm("view_retaildeal", dealership_admin, deal)
+		assign_object_perm("change_retaildeal", dealership_admin, deal)
 
 		return super().form_valid(form)
 
 
-class RetailDealDetailView(PermissionRequiredMixin, DetailView):
+class RetailDealDetailView(CachedPermissionRequiredMixin, DetailView):
 	""" Detail view for Retail deals. """
 	model = RetailDeal
 	template_name = "retail_deal_detail.html"
@@ -268,7 +354,6 @@ class RetailDealDetailView(PermissionRequiredMixin, DetailView):
 
 
 @login_required
-@transaction.atomic
 def acceptRetailDeal(request, pk):
 	""" View to accept a retail deal
 
@@ -286,29 +371,16 @@ def acceptRetailDeal(request, pk):
 	"""
 
 	deal = RetailDeal.objects.get(pk=pk)
-	dealership = deal.car.dealership
 
-	if not dealership.admin.has_perm("change_retaildeal", deal):
+	if not get_permission_cache(request).has_perm("change_retaildeal", deal):
 		raise PermissionDenied
-	total_cost = deal.asking_price
-	customer_balance = deal.customer.balance
-	if deal.status == RetailDeal.PENDING and customer_balance >= total_cost:
-
-		deal.customer.balance = F('balance') - total_cost
-		deal.customer.save()
-
-		dealership.balance = F('balance') + total_cost
-		dealership.save()
-
-		deal.car.amount = F('amount') - deal.amount
-		deal.car.save()
 
-		deal.status = RetailDeal.ACCEPTED
-		deal.save()
+	try:
+		settle_retail_deal(pk)
+	except SettlementError as error:
+		messages.error(request, str(error))
 
-		return redirect("deals:retail_deal_detail", pk)
-	else:
-		return redirect("deals:retail_deal_detail", pk)
+	return redirect("deals:retail_deal_detail", pk)
 
 
 @login_required
@@ -320,37 +392,66 @@ def rejectRetailDeal(request, pk):
 		pk (int): primary key of retail deal
 
 
-	This view sets the deal status to REJECTED.
+	This view sets the deal status to REJECTED and releases the cars
+	reserved for it.
 	Redirects to the retail deal detail view.
 	"""
 
 	deal = RetailDeal.objects.get(pk=pk)
-	dealership = deal.car.dealership
-	
-	if not dealership.admin.has_perm("change_retaildeal", deal):
+
+	if not get_permission_cache(request).has_perm("change_retaildeal", deal):
 		raise PermissionDenied
-	
-	if deal.status == RetailDeal.PENDING:
-		deal.status = RetailDeal.REJECTED
-		deal.save()
+
+	try:
+		reject_retail_deal(pk)
+	except SettlementError as error:
+		messages.error(request, str(error))
 
 	return redirect("deals:retail_deal_detail", pk)
 
 
 
 
-class ToManufacturersListView(UserIsDealership,ListView):
+class ToManufacturersListView(UserIsDealership, DealListMixin, ListView):
+	""" List view showing the deals a dealership has made to manufacturers. """
+
 	model = WholesaleDeal
 	template_name = "to_manufacturers.html"
 	context_object_name = "deals"
 
 	def get_queryset(self):
-		return WholesaleDeal.objects.filter(dealership__admin=self.request.user)
+		return WholesaleDeal.objects.filter(
+			status=self.get_status(),
+			dealership_id=self.get_affiliation_id()).for_listing()
+
+class ToDealershipsListView(UserIsCustomer, DealListMixin, ListView):
+	""" List view showing the deals a customer has made to dealerships. """
 
-class ToDealershipsListView(UserIsCustomer,ListView):
 	model = RetailDeal
 	template_name = "to_dealerships.html"
 	context_object_name = "deals"
 
 	def get_queryset(self):
-		return RetailDeal.objects.filter(customer=self.request.user)
\ No newline at end of file
+		return RetailDeal.objects.filter(
+			status=self.get_status(), customer=self.request.user).for_listing()
+
+
+class ExportView(UserIsStaff, View):
+	"""
+	Streams a table as CSV or JSON Lines to staff users (see deals.exports).
+
+	Deals and manufacturing orders can be filtered with
+	?since=YYYY-MM-DD&until=YYYY-MM-DD&status=<code>.
+	"""
+
+	def get(self, request, name, format):
+		if name not in exports.EXPORTS:
+			raise Http404("Unknown export")
+		try:
+			content = exports.stream(name, format, **exports.parse_filters(request.GET))
+		except exports.ExportError as error:
+			return HttpResponseBadRequest(str(error))
+
+		response = StreamingHttpResponse(content, content_type=exports.CONTENT_TYPES[format])
+		response["Content-Disposition"] = 'attachment; filename="%s.%s"' % (name, format)
+		return response
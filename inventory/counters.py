@@ -0,0 +1,145 @@
+"""
+Stock counters kept on Manufacturer and Dealership.
+
+Each manufacturer and dealership stores the number of cars it has in
+stock, the value of that stock at cost price and the total asking price
+of the pending deals made to it, so profile and inventory pages do not
+have to aggregate over every car and deal.
+
+The counters are changed with F() expressions in the same UPDATE
+statement (and transaction) as the balance or stock change that causes
+them; see manufacturers.fulfilment, deals.settlement, inventory.imports
+and deals.views, which adds new deals to the pending deal value.
+Changes made elsewhere, e.g. in the admin site, are picked up by
+
+    python manage.py reconcile_counters
+"""
+
+from django.db.models import (BigIntegerField, Case, ExpressionWrapper, F, OuterRef,
+                              Subquery, Sum, Value, When)
+from django.db.models.functions import Coalesce
+
+from dealerships.models import Dealership
+from deals.models import RetailDeal, WholesaleDeal
+from manufacturers.models import Manufacturer
+
+from .models import RetailCar, WholesaleCar
+
+
+COUNTERS = ("cars_in_stock", "stock_value", "pending_deal_value")
+
+# model: (car model, car lookup to the owner, deal model, deal lookup to the owner)
+SOURCES = {
+    Manufacturer: (WholesaleCar, "manufacturer", WholesaleDeal, "car__manufacturer"),
+    Dealership: (RetailCar, "dealership", RetailDeal, "car__dealership"),
+}
+
+
+def changes(cars=0, value=0, pending=0):
+    """ Returns the update() keyword arguments adding the deltas to the counters. """
+
+    fields = {}
+    for field, delta in zip(COUNTERS, (cars, value, pending)):
+        if delta:
+            fields[field] = F(field) + delta
+    return fields
+
+
+def add(model, pk, cars=0, value=0, pending=0):
+    """ Adds the deltas to the counters of one manufacturer or dealership. """
+
+    fields = changes(cars, value, pending)
+    if fields and pk is not None:
+        model.objects.filter(pk=pk).update(**fields)
+
+
+def add_many(model, **deltas):
+    """
+    Adds deltas to several rows with one UPDATE.
+
+    Each keyword maps a field to a dict of {pk: delta}.
+    """
+
+    deltas = {field: values for field, values in deltas.items() if values}
+    pks = set().union(*deltas.values()) if deltas else set()
+    pks.discard(None)
+    if not pks:
+        return
+    fields = {
+        field: F(field) + Case(
+            *[When(pk=pk, then=Value(delta)) for pk, delta in values.items()],
+            default=Value(0), output_field=BigIntegerField())
+        for field, values in deltas.items()
+    }
+    model.objects.filter(pk__in=pks).update(**fields)
+
+
+def remove_car(car):
+    """
+    Takes a wholesale or retail car that is about to be deleted, along with
+    its pending deals, out of its owner's counters.
+    """
+
+    if isinstance(car, WholesaleCar):
+        model, owner_id, deals = Manufacturer, car.manufacturer_id, car.wholesaledeal_set
+    else:
+        model, owner_id, deals = Dealership, car.dealership_id, car.retaildeal_set
+    pending = deals.filter(status=deals.model.PENDING).aggregate(
+        total=Sum("asking_price"))["total"] or 0
+    add(model, owner_id, cars=-car.amount, value=-car.amount * car.cost_price,
+        pending=-pending)
+
+
+def _total(queryset, lookup, expression):
+    return Coalesce(Subquery(
+        queryset.values(lookup).annotate(total=Sum(expression)).values("total")[:1]),
+        Value(0), output_field=BigIntegerField())
+
+
+def with_actual_counters(model):
+    """
+    Returns the manufacturers or dealerships annotated with their counters
+    recomputed from the cars and deals (actual_cars_in_stock, ...).
+    """
+
+    car_model, car_lookup, deal_model, deal_lookup = SOURCES[model]
+    cars = car_model.objects.filter(**{car_lookup: OuterRef("pk")})
+    deals = deal_model.objects.filter(**{deal_lookup: OuterRef("pk")},
+                                      status=deal_model.PENDING)
+    value = ExpressionWrapper(F("amount") * F("cost_price"), output_field=BigIntegerField())
+    return model.objects.annotate(
+        actual_cars_in_stock=_total(cars, car_lookup, "amount"),
+        actual_stock_value=_total(cars, car_lookup, value),
+        actual_pending_deal_value=_total(deals, deal_lookup, "asking_price"),
+    )
+
+
+def reconcile(model, fix=True, batch_size=1000):
+    """
+    Recomputes the counters of every manufacturer or dealership in batches.
+
+    Drift is corrected by adding the difference rather than overwriting the
+    counter, so changes committed while the command runs are kept.
+
+    Returns a list of (obj, field, stored, actual) for every drifted counter.
+    """
+
+    drift = []
+    rows = with_actual_counters(model).order_by("pk")
+    last_pk = 0
+    while True:
+        batch = list(rows.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+
+        deltas = {field: {} for field in COUNTERS}
+        for obj in batch:
+            for field in COUNTERS:
+                stored, actual = getattr(obj, field), getattr(obj, "actual_" + field)
+                if stored != actual:
+                    drift.append((obj, field, stored, actual))
+                    deltas[field][obj.pk] = actual - stored
+        if fix:
+            add_many(model, **deltas)
+    return drift
@@ -0,0 +1,269 @@
+"""
+Facet counts for the wholesale and retail catalogues.
+
+The catalogues can be filtered by manufacturer, country (the manufacturer's
+for wholesale cars, the dealership's for retail cars) and price band, and
+show how many cars are in stock for each value. Grouping the whole table on
+every request is too slow, so the counts are kept in FacetCount rows and
+adjusted with F() expressions in the same transaction as the stock change
+that causes them; see manufacturers.views, inventory.views and
+deals.settlement.
+
+Counts are numbers of cars (the sum of amount), so every stock change maps
+to an exact delta. Changes made elsewhere, e.g. in the admin site, are
+picked up by throwing the counts away and recomputing them:
+
+    python manage.py rebuild_facets
+"""
+
+from collections import defaultdict
+from urllib.parse import urlencode
+
+from django.apps import apps as django_apps
+from django.db import transaction
+from django.db.models import (BigIntegerField, Case, CharField, F, OuterRef, Q,
+                              Subquery, Sum, Value, When)
+from django.db.models.functions import Cast
+
+from CarSupply.countries import get_countries
+from manufacturers.models import Manufacturer
+
+from .models import FacetCount
+
+
+# Lower bounds of the price bands
+PRICE_BANDS = (0, 10000, 20000, 30000, 50000, 75000, 100000)
+
+# catalogue: (car model, price field, country lookup)
+SOURCES = {
+    FacetCount.WHOLESALE: ("WholesaleCar", "wholesale_price", "manufacturer__country"),
+    FacetCount.RETAIL: ("RetailCar", "retail_price", "dealership__country"),
+}
+
+
+def price_band(price):
+    """ Returns the lower bound of the band price falls in. """
+
+    return max(band for band in PRICE_BANDS if band <= price)
+
+
+def price_range(band):
+    """ Returns the (lowest, highest) price of a band; highest is None for the last one. """
+
+    index = PRICE_BANDS.index(band)
+    if index + 1 == len(PRICE_BANDS):
+        return band, None
+    return band, PRICE_BANDS[index + 1] - 1
+
+
+def entry(catalogue, car, amount, price=None):
+    """
+    Returns the add() entry for amount cars (negative when removed) of a
+    wholesale or retail car, at price if given or else at the car's price.
+    Reads car.manufacturer or car.dealership for the country.
+    """
+
+    price_field = SOURCES[catalogue][1]
+    owner = car.manufacturer if catalogue == FacetCount.WHOLESALE else car.dealership
+    if price is None:
+        price = getattr(car, price_field)
+    return (catalogue, car.manufacturer_id, owner.country if owner else None, price, amount)
+
+
+def add(*entries):
+    """
+    Adds cars to the facet counts with two queries.
+
+    Each entry is (catalogue, manufacturer_id, country, price, amount), with
+    a negative amount for cars leaving the catalogue.
+    """
+
+    deltas = defaultdict(int)
+    for catalogue, manufacturer_id, country, price, amount in entries:
+        values = [(FacetCount.PRICE, str(price_band(price)))]
+        if manufacturer_id is not None:
+            values.append((FacetCount.MANUFACTURER, str(manufacturer_id)))
+        if country:
+            values.append((FacetCount.COUNTRY, country))
+        for facet, value in values:
+            deltas[catalogue, facet, value] += amount
+    deltas = {key: delta for key, delta in sorted(deltas.items()) if delta}
+    if not deltas:
+        return
+
+    # unique_facet_value turns the inserts of existing rows into no-ops
+    FacetCount.objects.bulk_create([
+        FacetCount(catalogue=catalogue, facet=facet, value=value)
+        for catalogue, facet, value in deltas
+    ], ignore_conflicts=True)
+
+    lookup = Q()
+    whens = []
+    for (catalogue, facet, value), delta in deltas.items():
+        condition = Q(catalogue=catalogue, facet=facet, value=value)
+        lookup |= condition
+        whens.append(When(condition, then=Value(delta)))
+    FacetCount.objects.filter(lookup).update(cars=F("cars") + Case(
+        *whens, default=Value(0), output_field=BigIntegerField()))
+
+
+def _band_expression(price_field):
+    whens = [When(**{"%s__gte" % price_field: band}, then=Value(str(band)))
+             for band in reversed(PRICE_BANDS[1:])]
+    return Case(*whens, default=Value(str(PRICE_BANDS[0])), output_field=CharField())
+
+
+def rebuild(apps=django_apps, using="default"):
+    """
+    Recomputes every facet count from the cars in stock, replacing the
+    stored counts in one transaction.
+
+    Migrations pass their historical apps registry.
+    """
+
+    facet_model = apps.get_model("inventory", "FacetCount")
+    rows = []
+    with transaction.atomic(using=using):
+        facet_model.objects.using(using).all().delete()
+        for catalogue, (model_name, price_field, country_lookup) in SOURCES.items():
+            cars = apps.get_model("inventory", model_name).objects.using(using).filter(
+                amount__gt=0)
+            facets = (
+                (FacetCount.MANUFACTURER, Cast("manufacturer_id", CharField())),
+                (FacetCount.COUNTRY, F(country_lookup)),
+                (FacetCount.PRICE, _band_expression(price_field)),
+            )
+            for facet, expression in facets:
+                totals = cars.annotate(key=expression).exclude(key=None).values(
+                    "key").annotate(total=Sum("amount")).order_by()
+                rows += [facet_model(catalogue=catalogue, facet=facet, value=row["key"],
+                                     cars=row["total"])
+                         for row in totals if row["key"] != ""]
+        facet_model.objects.using(using).bulk_create(rows)
+    return len(rows)
+
+
+def _label(facet, value, manufacturer_name, countries):
+    if facet == FacetCount.MANUFACTURER:
+        return manufacturer_name
+    if facet == FacetCount.COUNTRY:
+        return countries.get(value, value)
+    lowest, highest = price_range(int(value))
+    if highest is None:
+        return "${:,} and over".format(lowest)
+    return "${:,} - ${:,}".format(lowest, highest)
+
+
+def counts(catalogue):
+    """
+    Returns {facet: [(value, label, cars), ...]} for the values with cars in
+    stock, with one query. Manufacturers and countries are sorted by label,
+    price bands by price.
+    """
+
+    names = Manufacturer.objects.annotate(key=Cast("pk", CharField())).filter(
+        key=OuterRef("value")).values("name")[:1]
+    rows = FacetCount.objects.filter(catalogue=catalogue, cars__gt=0).annotate(
+        manufacturer_name=Case(When(facet=FacetCount.MANUFACTURER, then=Subquery(names)),
+                               output_field=CharField())).values_list(
+        "facet", "value", "cars", "manufacturer_name")
+
+    countries = dict(get_countries())
+    result = {facet: [] for facet, _ in FacetCount.FACETS}
+    for facet, value, cars, manufacturer_name in rows:
+        if facet == FacetCount.MANUFACTURER and manufacturer_name is None:
+            continue
+        result[facet].append((value, _label(facet, value, manufacturer_name, countries), cars))
+    for facet, options in result.items():
+        if facet == FacetCount.PRICE:
+            options.sort(key=lambda option: int(option[0]))
+        else:
+            options.sort(key=lambda option: option[1])
+    return result
+
+
+def selected(params):
+    """
+    Returns the valid facet filters in params (e.g. request.GET) as
+    {facet: value}; anything else is ignored.
+    """
+
+    filters = {}
+    manufacturer = params.get(FacetCount.MANUFACTURER, "")
+    if manufacturer.isdigit():
+        filters[FacetCount.MANUFACTURER] = manufacturer
+    country = params.get(FacetCount.COUNTRY, "")
+    if country in dict(get_countries()):
+        filters[FacetCount.COUNTRY] = country
+    price = params.get(FacetCount.PRICE, "")
+    if price.isdigit() and int(price) in PRICE_BANDS:
+        filters[FacetCount.PRICE] = price
+    return filters
+
+
+def filter_cars(queryset, catalogue, filters):
+    """ Narrows a wholesale or retail car queryset down to the selected facet values. """
+
+    _, price_field, country_lookup = SOURCES[catalogue]
+    if FacetCount.MANUFACTURER in filters:
+        queryset = queryset.filter(manufacturer_id=int(filters[FacetCount.MANUFACTURER]))
+    if FacetCount.COUNTRY in filters:
+        queryset = queryset.filter(**{country_lookup: filters[FacetCount.COUNTRY]})
+    if FacetCount.PRICE in filters:
+        lowest, highest = price_range(int(filters[FacetCount.PRICE]))
+        queryset = queryset.filter(**{"%s__gte" % price_field: lowest})
+        if highest is not None:
+            queryset = queryset.filter(**{"%s__lte" % price_field: highest})
+    return queryset
+
+
+class FacetFilterMixin:
+    """
+    ListView mixin filtering a catalogue by the facet values in the query
+    string (?manufacturer=<pk>&country=<code>&price=<band>) and adding the
+    facet counts to the context.
+
+    Views call filter_by_facets() on their queryset and set facet_catalogue.
+    """
+
+    facet_catalogue = None
+
+    def get_facet_filters(self):
+        if not hasattr(self, "_facet_filters"):
+            self._facet_filters = selected(self.request.GET)
+        return self._facet_filters
+
+    def filter_by_facets(self, queryset):
+        return filter_cars(queryset, self.facet_catalogue, self.get_facet_filters())
+
+    def get_approximate_count(self, queryset):
+        # The facet options carry their own counts; filtered pages would
+        # otherwise each be counted and cached on their own
+        if self.get_facet_filters():
+            return None
+        return super().get_approximate_count(queryset)
+
+    def get_context_data(self, **kwargs):
+        """
+        Adds facets, a list of (facet, label, options) where each option is
+        (label, cars, query string toggling it, selected), and facet_query,
+        the query string of the current filters.
+        """
+
+        context = super().get_context_data(**kwargs)
+        filters = self.get_facet_filters()
+        facets = []
+        for facet, options in counts(self.facet_catalogue).items():
+            rows = []
+            for value, label, cars in options:
+                toggled = dict(filters)
+                is_selected = toggled.get(facet) == value
+                if is_selected:
+                    del toggled[facet]
+                else:
+                    toggled[facet] = value
+                rows.append((label, cars, urlencode(sorted(toggled.items())), is_selected))
+            facets.append((facet, dict(FacetCount.FACETS)[facet], rows))
+        context["facets"] = facets
+        context["facet_query"] = urlencode(sorted(filters.items()))
+        return context
@@ -0,0 +1,508 @@
+"""
+Bulk import of inventory from CSV, JSON Lines or JSON files.
+
+Manufacturers import blueprints and, optionally, the stock of the matching
+wholesale cars; dealerships import retail cars. Files are read row by row
+(JSON arrays item by item), so they never have to fit in memory, and rows
+are validated and written in batches. Each batch is one transaction with
+a fixed number of statements:
+
+- blueprints are matched on manufacturer and name; existing ones get the
+  new price with one CASE UPDATE and new ones are bulk inserted, as Car has
+  no unique key for bulk_create(update_conflicts=True) to target,
+- cars are upserted like in manufacturers.fulfilment: missing rows are
+  inserted empty (the unique constraints skip rows created concurrently),
+  every row is locked, and the amounts are set with one CASE UPDATE,
+- the stock counters, facet counts and catalogue cache follow the change
+  in stock, and guardian rows for new objects are bulk inserted.
+
+An amount sets the stock of a car rather than adding to it, so importing
+the same file twice leaves the inventory unchanged.
+
+JSON files may also be shaped like car-models.json, a list of
+{"brand": ..., "models": [...]} where each model is a name or an object
+with the row fields. Rows that fail validation are reported with their
+number and skipped; the rest are imported.
+
+    python manage.py import_inventory car-models.json --price 20000
+"""
+
+import codecs
+import csv
+import json
+import os
+import time
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+
+from blueprints.models import Car
+from dealerships.models import Dealership
+from manufacturers.models import Manufacturer
+from users.permissions import assign_object_perms
+
+from . import counters, facets, page_cache, versions
+from .lookups import candidates
+from .models import FacetCount, RetailCar, WholesaleCar
+
+
+BATCH_SIZE = 1000
+
+# Errors kept for the report; later ones are only counted
+MAX_ERRORS = 1000
+
+FORMATS = ("csv", "json", "jsonl")
+
+# Characters read from the file at a time
+READ_SIZE = 64 * 1024
+
+
+class ImportFileError(Exception):
+    """ Raised when a file cannot be read at all. """
+
+
+class RowError(Exception):
+    """ Raised for a row that cannot be imported. """
+
+
+class ImportReport:
+    """
+    Result of an import.
+
+    Attributes:
+        rows (int): rows read
+        created (int): rows that created a blueprint or car
+        updated (int): rows that updated an existing one
+        errors (list): (row number, message) of the first MAX_ERRORS
+            rows that were skipped
+        error_count (int): number of rows skipped
+        seconds (float): wall-clock time
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.created = 0
+        self.updated = 0
+        self.errors = []
+        self.error_count = 0
+        self.seconds = 0
+
+    def add_error(self, number, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((number, str(message)))
+
+    @property
+    def imported(self):
+        return self.created + self.updated
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0
+
+    def lines(self):
+        for number, message in self.errors:
+            yield "Row %d: %s" % (number, message)
+        if self.error_count > len(self.errors):
+            yield "... and %d more errors" % (self.error_count - len(self.errors))
+        yield ("%d rows: %d created, %d updated, %d skipped in %.2fs (%s rows/sec)" % (
+            self.rows, self.created, self.updated, self.error_count, self.seconds,
+            "{:,.0f}".format(self.rows_per_second)))
+
+
+def detect_format(filename):
+    """ Returns the format of a file from its extension. """
+
+    extension = os.path.splitext(filename)[1].lower().lstrip(".")
+    if extension not in FORMATS:
+        raise ImportFileError("Unsupported file type, expected %s" % ", ".join(
+            ".%s" % format for format in FORMATS))
+    return extension
+
+
+def _text(file):
+    """ Returns file as text, decoding uploaded (binary) files as UTF-8. """
+
+    if isinstance(file.read(0), bytes):
+        return codecs.getreader("utf-8-sig")(file)
+    return file
+
+
+def _json_items(text):
+    """ Yields the items of the JSON list in text one at a time. """
+
+    decoder = json.JSONDecoder()
+    buffer = ""
+    while not buffer:
+        buffer = text.read(READ_SIZE)
+        if not buffer:
+            break
+        buffer = buffer.lstrip()
+    if not buffer.startswith("["):
+        raise ImportFileError("A JSON file must hold a list")
+    position = 1
+    while True:
+        # Skip to the next item, reading more of the file as needed
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer):
+                break
+            buffer, position = text.read(READ_SIZE), 0
+            if not buffer:
+                raise ImportFileError("The JSON list is not closed")
+        if buffer[position] == "]":
+            return
+
+        while True:
+            more = ""
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError as error:
+                more = text.read(READ_SIZE)
+                if not more:
+                    raise ImportFileError("Invalid JSON: %s" % error)
+            else:
+                # A number may continue in the next read
+                if end < len(buffer) and buffer[end] in " \t\r\n,]":
+                    break
+                more = text.read(READ_SIZE)
+                if not more:
+                    break
+            buffer, position = buffer[position:] + more, 0
+        buffer, position = buffer[end:], 0
+        yield item
+
+
+def _catalogue_rows(item):
+    """ Expands a car-models.json entry into rows; returns other items as they are. """
+
+    if not isinstance(item, dict) or "models" not in item:
+        return [item]
+    if not isinstance(item["models"], list):
+        return [RowError("models must be a list")]
+    brand = {key: value for key, value in item.items() if key != "models"}
+    return [
+        dict(brand, name=model) if isinstance(model, str)
+        else dict(brand, **model) if isinstance(model, dict)
+        else RowError("Each model must be a name or an object")
+        for model in item["models"]
+    ]
+
+
+def read_rows(file, format):
+    """
+    Yields the rows of a file as dicts, or as RowErrors for rows that
+    cannot be parsed.
+
+    Raises ImportFileError if the file cannot be read at all.
+    """
+
+    text = _text(file)
+    try:
+        if format == "csv":
+            yield from csv.DictReader(text)
+        elif format == "jsonl":
+            for line in text:
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                except ValueError as error:
+                    yield RowError("Invalid JSON: %s" % error)
+                else:
+                    yield from _catalogue_rows(item)
+        else:
+            for item in _json_items(text):
+                yield from _catalogue_rows(item)
+    except (UnicodeDecodeError, csv.Error) as error:
+        raise ImportFileError("The file could not be read: %s" % error)
+
+
+def _string(row, field, max_length, required=True):
+    value = row.get(field)
+    value = "" if value is None else str(value).strip()
+    if not value:
+        if required:
+            raise RowError("%s is required" % field)
+        return None
+    if len(value) > max_length:
+        raise RowError("%s must be at most %d characters" % (field, max_length))
+    return value
+
+
+def _amount(row, field, required=True, default=None):
+    value = row.get(field)
+    if value is None or value == "":
+        if default is not None:
+            return default
+        if required:
+            raise RowError("%s is required" % field)
+        return None
+    if isinstance(value, bool):
+        raise RowError("%s must be a whole number" % field)
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise RowError("%s must be a whole number" % field)
+    if number != float(value) or number < 0:
+        raise RowError("%s must be a whole number of at least 0" % field)
+    if number > 2147483647:
+        raise RowError("%s is too large" % field)
+    return number
+
+
+# catalogue: (car model, key fields, owner model, owner field, permission)
+STOCK = {
+    FacetCount.WHOLESALE: (WholesaleCar, ("manufacturer_id", "name", "cost_price",
+                                          "wholesale_price"),
+                           Manufacturer, "manufacturer_id", "change_wholesalecar"),
+    FacetCount.RETAIL: (RetailCar, ("dealership_id", "manufacturer_id", "name", "cost_price",
+                                    "retail_price"),
+                        Dealership, "dealership_id", "change_retailcar"),
+}
+
+
+def _set_stock(catalogue, stock, owners):
+    """
+    Sets the amount of each car in stock ({key: amount}, keys in the
+    catalogue's STOCK fields) to the given value, creating missing cars.
+    owners maps the owner pks to the manufacturers or dealerships. Amounts
+    never go below the cars reserved for pending deals.
+
+    Returns the keys of the cars created.
+    """
+
+    model, fields, owner_model, owner_field, perm = STOCK[catalogue]
+    owner_index = fields.index(owner_field)
+
+    def locked(keys):
+        cars = {}
+        for car in candidates(model.objects.select_for_update(), fields, keys).order_by("pk"):
+            key = tuple(getattr(car, field) for field in fields)
+            if key in keys:
+                cars[key] = car
+        return cars
+
+    list(owner_model.objects.select_for_update().filter(pk__in=owners).order_by(
+        "pk").values_list("pk", flat=True))
+    cars = locked(stock)
+    missing = {key for key in stock if key not in cars}
+    created = {}
+    if missing:
+        model.objects.bulk_create([
+            model(amount=0, **dict(zip(fields, key))) for key in missing
+        ], ignore_conflicts=True)
+        created = locked(missing)
+        assign_object_perms(perm, model, [
+            (owners[key[owner_index]].admin_id, car.pk) for key, car in created.items()
+            if owners[key[owner_index]].admin_id is not None])
+        cars.update(created)
+
+    amounts = {}
+    cars_in_stock = defaultdict(int)
+    stock_value = defaultdict(int)
+    facet_entries = []
+    for key, amount in stock.items():
+        car = cars[key]
+        delta = max(amount, car.reserved) - car.amount
+        if not delta:
+            continue
+        owner = owners[key[owner_index]]
+        amounts[car.pk] = delta
+        cars_in_stock[owner.pk] += delta
+        stock_value[owner.pk] += delta * car.cost_price
+        facet_entries.append((catalogue, car.manufacturer_id, owner.country, key[-1], delta))
+    counters.add_many(model, amount=amounts)
+    counters.add_many(owner_model, cars_in_stock=cars_in_stock, stock_value=stock_value)
+    facets.add(*facet_entries)
+    if amounts or created:
+        page_cache.invalidate(catalogue)
+    return set(created)
+
+
+class WholesaleImport:
+    """
+    Imports blueprints and wholesale stock.
+
+    Row fields:
+        name: blueprint and car name
+        price: blueprint price, also the cost and wholesale price of the car
+        amount: cars in stock at that price (optional; without it only the
+            blueprint is imported)
+        brand: manufacturer name, required unless the import is for one
+            manufacturer, in which case it must match if given
+
+    Parameters:
+        manufacturer (obj): the manufacturer importing, or None to use
+            each row's brand
+        default_price (int): price of rows without one
+    """
+
+    catalogue = FacetCount.WHOLESALE
+
+    def __init__(self, manufacturer=None, default_price=None):
+        self.manufacturer = manufacturer
+        self.default_price = default_price
+        self.manufacturers = {}
+        if manufacturer is not None:
+            self.manufacturers[manufacturer.name] = manufacturer
+
+    def clean(self, row):
+        brand = _string(row, "brand", 30, required=self.manufacturer is None)
+        if self.manufacturer is not None:
+            if brand is not None and brand != self.manufacturer.name:
+                raise RowError("brand must be %s" % self.manufacturer.name)
+            brand = self.manufacturer.name
+        return {
+            "brand": brand,
+            "name": _string(row, "name", 30),
+            "price": _amount(row, "price", default=self.default_price),
+            "amount": _amount(row, "amount", required=False),
+        }
+
+    def resolve(self, brands):
+        """ Looks up the manufacturers of brands not seen yet. """
+
+        unknown = set(brands) - set(self.manufacturers)
+        if unknown:
+            # The oldest manufacturer of a name wins
+            for manufacturer in Manufacturer.objects.filter(name__in=unknown).order_by("-pk"):
+                self.manufacturers[manufacturer.name] = manufacturer
+
+    def write(self, rows, report):
+        self.resolve(row["brand"] for _, row in rows)
+        blueprints = {}
+        stock = {}
+        for number, row in rows:
+            manufacturer = self.manufacturers.get(row["brand"])
+            if manufacturer is None:
+                report.add_error(number, "Unknown manufacturer %s" % row["brand"])
+                continue
+            blueprints[manufacturer.pk, row["name"]] = row["price"]
+            if row["amount"] is not None:
+                stock[manufacturer.pk, row["name"], row["price"], row["price"]] = row["amount"]
+        if not blueprints:
+            return
+
+        owners = {manufacturer.pk: manufacturer for manufacturer in self.manufacturers.values()}
+        fields = ("manufacturer_id", "name")
+        existing = {key for key in candidates(Car.objects, fields, blueprints).values_list(
+            *fields).distinct() if key in blueprints}
+        if existing:
+            # Every blueprint of a name gets the price
+            Car.objects.filter(manufacturer_id__in={key[0] for key in existing},
+                               name__in={key[1] for key in existing}).update(price=Case(
+                *[When(manufacturer_id=manufacturer_id, name=name, then=Value(blueprints[
+                    manufacturer_id, name])) for manufacturer_id, name in existing],
+                default=F("price"), output_field=IntegerField()))
+            versions.touch(Car)
+        new = {key for key in blueprints if key not in existing}
+        if new:
+            Car.objects.bulk_create([
+                Car(manufacturer_id=manufacturer_id, name=name,
+                    price=blueprints[manufacturer_id, name])
+                for manufacturer_id, name in new
+            ])
+            created = [(owners[manufacturer_id].admin_id, pk)
+                       for pk, manufacturer_id, name in candidates(
+                           Car.objects, fields, new).values_list("pk", *fields)
+                       if (manufacturer_id, name) in new
+                       and owners[manufacturer_id].admin_id is not None]
+            assign_object_perms("view_car", Car, created)
+            assign_object_perms("change_car", Car, created)
+
+        if stock:
+            _set_stock(self.catalogue, stock, owners)
+        report.created += len(new)
+        report.updated += len(blueprints) - len(new)
+
+
+class RetailImport:
+    """
+    Imports a dealership's retail stock.
+
+    Row fields:
+        name: car name
+        brand: manufacturer name
+        price: retail price
+        cost_price: price the dealership paid (optional, defaults to price)
+        amount: cars in stock at those prices
+
+    Parameters:
+        dealership (obj): the dealership importing
+    """
+
+    catalogue = FacetCount.RETAIL
+
+    def __init__(self, dealership):
+        self.dealership = dealership
+        self.manufacturers = {}
+
+    def clean(self, row):
+        price = _amount(row, "price")
+        return {
+            "brand": _string(row, "brand", 30),
+            "name": _string(row, "name", 50),
+            "price": price,
+            "cost_price": _amount(row, "cost_price", default=price),
+            "amount": _amount(row, "amount"),
+        }
+
+    resolve = WholesaleImport.resolve
+
+    def write(self, rows, report):
+        self.resolve(row["brand"] for _, row in rows)
+        stock = {}
+        for number, row in rows:
+            manufacturer = self.manufacturers.get(row["brand"])
+            if manufacturer is None:
+                report.add_error(number, "Unknown manufacturer %s" % row["brand"])
+                continue
+            key = (self.dealership.pk, manufacturer.pk, row["name"], row["cost_price"],
+                   row["price"])
+            stock[key] = row["amount"]
+        if not stock:
+            return
+
+        created = _set_stock(self.catalogue, stock, {self.dealership.pk: self.dealership})
+        report.created += len(created)
+        report.updated += len(stock) - len(created)
+
+
+def run(importer, file, format, batch_size=BATCH_SIZE):
+    """
+    Imports a file with a WholesaleImport or RetailImport.
+
+    Returns an ImportReport.
+    Raises ImportFileError if the file cannot be read at all; the batches
+    before the error stay imported.
+    """
+
+    report = ImportReport()
+    start = time.perf_counter()
+    batch = []
+
+    def flush():
+        with transaction.atomic():
+            importer.write(batch, report)
+        batch.clear()
+
+    for row in read_rows(file, format):
+        report.rows += 1
+        try:
+            if isinstance(row, RowError):
+                raise row
+            if not isinstance(row, dict):
+                raise RowError("Each row must be an object")
+            batch.append((report.rows, importer.clean(row)))
+        except RowError as error:
+            report.add_error(report.rows, error)
+        if len(batch) == batch_size:
+            flush()
+    if batch:
+        flush()
+
+    report.seconds = time.perf_counter() - start
+    return report
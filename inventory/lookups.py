@@ -0,0 +1,23 @@
+"""
+Lookups of batches of rows by keys made of several fields, e.g. the cars of
+an import or a bulk settlement by (manufacturer, name, price).
+"""
+
+from django.db.models import Q
+
+
+def candidates(queryset, fields, keys):
+    """
+    Filters queryset to the rows that may have one of keys, with an IN per
+    field rather than an OR per key (which SQLite cannot nest 1000 deep);
+    callers match the keys exactly. None in a key matches NULL.
+    """
+
+    condition = Q()
+    for index, field in enumerate(fields):
+        values = {key[index] for key in keys}
+        term = Q(**{"%s__in" % field: values - {None}})
+        if None in values:
+            term |= Q(**{"%s__isnull" % field: True})
+        condition &= term
+    return queryset.filter(condition)
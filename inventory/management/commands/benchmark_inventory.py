@@ -0,0 +1,109 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory import search
+from inventory.models import RetailCar, WholesaleCar
+
+
+class Command(BaseCommand):
+    """
+    Times the inventory queries behind the catalogues, the inventory pages,
+    the retail search and the manufacturing order / deal settlement lookups
+    against the current database, and prints the query plan of each.
+
+    Seed a large database first, e.g. python manage.py seed --cars 1000000
+    """
+
+    help = "Time the hot inventory queries and print their query plans."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=200,
+                            help="Number of times each query is run.")
+        parser.add_argument("--page-size", type=int, default=52)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--no-explain", action="store_true")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        wholesale = self.sample(WholesaleCar, rng, options["repeat"])
+        if not wholesale:
+            raise CommandError("There are no wholesale cars, seed the database first.")
+        retail = self.sample(RetailCar, rng, options["repeat"])
+
+        self.stdout.write("%d wholesale cars, %d retail cars" % (
+            WholesaleCar.objects.count(), RetailCar.objects.count()))
+
+        size = options["page_size"] + 1
+        queries = [
+            ("wholesale catalogue, first page",
+             lambda car: WholesaleCar.objects.for_catalogue()[:size], wholesale),
+            ("wholesale catalogue, page after car",
+             lambda car: WholesaleCar.objects.for_catalogue().filter(pk__gt=car.pk)[:size],
+             wholesale),
+            ("manufacturer inventory",
+             lambda car: WholesaleCar.objects.filter(
+                 manufacturer_id=car.manufacturer_id).for_catalogue()[:size], wholesale),
+            ("wholesale car lookup",
+             lambda car: WholesaleCar.objects.filter(
+                 name=car.name, cost_price=car.cost_price,
+                 wholesale_price=car.wholesale_price,
+                 manufacturer_id=car.manufacturer_id), wholesale),
+        ]
+        if retail:
+            queries += [
+                ("retail catalogue, first page",
+                 lambda car: RetailCar.objects.for_catalogue()[:size], retail),
+                ("retail catalogue, page after car",
+                 lambda car: RetailCar.objects.for_catalogue().filter(pk__gt=car.pk)[:size],
+                 retail),
+                ("dealership inventory",
+                 lambda car: RetailCar.objects.filter(
+                     dealership_id=car.dealership_id).for_catalogue()[:size], retail),
+                ("retail car lookup",
+                 lambda car: RetailCar.objects.filter(
+                     name=car.name, cost_price=car.cost_price, retail_price=car.retail_price,
+                     manufacturer_id=car.manufacturer_id, dealership_id=car.dealership_id),
+                 retail),
+            ]
+
+        for name, query, cars in queries:
+            self.time(name, lambda car: list(query(car)), cars)
+            if not options["no_explain"]:
+                for line in query(cars[0]).explain().splitlines():
+                    self.stdout.write("    " + line)
+
+        if retail:
+            searches = [
+                ("retail search, car name", lambda car: car.name),
+                ("retail search, manufacturer", lambda car: car.manufacturer.name),
+                ("retail search, manufacturer and car",
+                 lambda car: "%s %s" % (car.manufacturer.name, car.name)),
+                ("retail search, next page", lambda car: car.manufacturer.name),
+            ]
+            for name, words in searches:
+                offset = options["page_size"] if name.endswith("next page") else 0
+                self.time(name, lambda car: search.ranked_ids(words(car), size, offset), retail)
+
+    def time(self, name, run, cars):
+        timings = []
+        for car in cars:
+            start = time.perf_counter()
+            run(car)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        self.stdout.write("%-36s mean %8.3f ms   p95 %8.3f ms" % (
+            name, sum(timings) / len(timings) * 1000,
+            timings[int(len(timings) * 0.95)] * 1000))
+
+    def sample(self, model, rng, count):
+        """ Picks count random rows by primary key. """
+
+        last = model.objects.order_by("-pk").values_list("pk", flat=True).first()
+        if last is None:
+            return []
+        pks = [rng.randint(1, last) for _ in range(count)]
+        cars = {car.pk: car for car in model.objects.filter(pk__in=pks).select_related(
+            "manufacturer")}
+        return [cars[pk] for pk in pks if pk in cars]
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from dealerships.models import Dealership
+from inventory import imports
+from manufacturers.models import Manufacturer
+
+
+class Command(BaseCommand):
+    """
+    Imports blueprints and wholesale cars, or with --dealership retail
+    cars, from a CSV, JSON or JSON Lines file in batches, and reports the
+    rows skipped and the import rate.
+    """
+
+    help = "Import inventory from a CSV, JSON or JSON Lines file."
+
+    def add_arguments(self, parser):
+        parser.add_argument("file")
+        owner = parser.add_mutually_exclusive_group()
+        owner.add_argument("--manufacturer", type=int,
+                           help="Manufacturer pk; by default each row's brand is used.")
+        owner.add_argument("--dealership", type=int,
+                           help="Dealership pk, to import retail cars.")
+        parser.add_argument("--format", choices=imports.FORMATS,
+                            help="File format; by default taken from the file extension.")
+        parser.add_argument("--price", type=int,
+                            help="Price of blueprints listed without one.")
+        parser.add_argument("--batch-size", type=int, default=imports.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            if options["dealership"] is not None:
+                importer = imports.RetailImport(
+                    Dealership.objects.get(pk=options["dealership"]))
+            else:
+                manufacturer = None
+                if options["manufacturer"] is not None:
+                    manufacturer = Manufacturer.objects.get(pk=options["manufacturer"])
+                importer = imports.WholesaleImport(manufacturer, options["price"])
+        except (Dealership.DoesNotExist, Manufacturer.DoesNotExist) as error:
+            raise CommandError(error)
+
+        try:
+            format = options["format"] or imports.detect_format(options["file"])
+            with open(options["file"], encoding="utf-8-sig", newline="") as file:
+                report = imports.run(importer, file, format, options["batch_size"])
+        except (OSError, imports.ImportFileError) as error:
+            raise CommandError(error)
+
+        for line in report.lines():
+            self.stdout.write(line)
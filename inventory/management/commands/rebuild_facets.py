@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from inventory import facets
+
+
+class Command(BaseCommand):
+    """
+    Throws away the catalogue facet counts and recomputes them from the
+    cars in stock, e.g. after cars were changed in the admin site.
+    """
+
+    help = "Recompute the catalogue facet counts."
+
+    def handle(self, *args, **options):
+        rows = facets.rebuild()
+        self.stdout.write("Rebuilt %d facet counts" % rows)
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from inventory import search
+
+
+class Command(BaseCommand):
+    """
+    Recreates the retail catalogue search index and its triggers and fills
+    it from the current retail cars, e.g. after a migration rebuilt the
+    inventory_retailcar table on SQLite.
+    """
+
+    help = "Recreate and repopulate the retail catalogue search index."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        connection = connections[options["database"]]
+        with transaction.atomic(using=options["database"]):
+            search.uninstall(connection)
+            search.install(connection)
+        self.stdout.write("Rebuilt the search index on %s" % connection.vendor)
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from dealerships.models import Dealership
+from inventory import counters
+from manufacturers.models import Manufacturer
+
+
+class Command(BaseCommand):
+    """
+    Recomputes the stock counters of every manufacturer and dealership from
+    their cars and pending deals, reports the counters that drifted and
+    corrects them.
+    """
+
+    help = "Recompute the manufacturer and dealership stock counters and report drift."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Report drift without correcting it.")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        for model in (Manufacturer, Dealership):
+            drift = counters.reconcile(
+                model, fix=not options["dry_run"], batch_size=options["batch_size"])
+            for obj, field, stored, actual in drift:
+                self.stdout.write("%s %d (%s): %s is %d, should be %d" % (
+                    model._meta.label, obj.pk, obj, field, stored, actual))
+            verb = "would be corrected" if options["dry_run"] else "corrected"
+            self.stdout.write("%s: %d rows checked, %d counters %s" % (
+                model._meta.label, model.objects.count(), len(drift), verb))
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from inventory import reservations
+
+
+class Command(BaseCommand):
+    """
+    Sweeper releasing the expired stock reservations of pending deals in
+    batches, so that their cars can be reserved by new deals. Runs until
+    stopped, or with --once until none are left. Several sweepers can run
+    at once on databases supporting SKIP LOCKED (PostgreSQL).
+    """
+
+    help = "Release expired stock reservations."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--interval", type=float, default=60.0,
+                            help="Seconds to wait when no reservation has expired.")
+        parser.add_argument("--once", action="store_true",
+                            help="Exit once no reservation has expired.")
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            released = 0
+            for car_model in reservations.RESERVATIONS:
+                count = reservations.release_expired(car_model, options["batch_size"])
+                if count:
+                    self.stdout.write("Released %d %s reservations" % (
+                        count, car_model._meta.verbose_name))
+                released += count
+            if released:
+                continue
+            if options["once"]:
+                break
+            time.sleep(options["interval"])
@@ -0,0 +1,70 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:47
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicates(model, fields, deal_model):
+    """
+    Merges rows that would violate the new unique constraint into the
+    oldest one, adding up their amounts and moving their deals over.
+    """
+
+    not_null = {"%s__isnull" % field: False for field in fields}
+    duplicates = model.objects.filter(**not_null).values(*fields).annotate(
+        rows=Count("pk"), keep=Min("pk"), total=Sum("amount")).filter(rows__gt=1)
+
+    for row in duplicates:
+        keep, total = row.pop("keep"), row.pop("total")
+        row.pop("rows")
+        others = model.objects.filter(**row).exclude(pk=keep)
+        deal_model.objects.filter(car__in=others).update(car=keep)
+        others.delete()
+        model.objects.filter(pk=keep).update(amount=total)
+
+
+def merge_duplicate_cars(apps, schema_editor):
+    merge_duplicates(
+        apps.get_model("inventory", "WholesaleCar"),
+        ["manufacturer", "name", "cost_price", "wholesale_price"],
+        apps.get_model("deals", "WholesaleDeal"))
+    merge_duplicates(
+        apps.get_model("inventory", "RetailCar"),
+        ["dealership", "manufacturer", "name", "cost_price", "retail_price"],
+        apps.get_model("deals", "RetailDeal"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('deals', '0008_auto_20200506_1209'),
+        ('inventory', '0006_auto_20200508_1816'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_cars, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='retailcar',
+            index=models.Index(condition=models.Q(amount__gt=0), fields=['dealership', 'id'], name='retailcar_dealer_stock_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='retailcar',
+            index=models.Index(condition=models.Q(amount__gt=0), fields=['id'], name='retailcar_stock_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='wholesalecar',
+            index=models.Index(condition=models.Q(amount__gt=0), fields=['manufacturer', 'id'], name='wholesalecar_mfr_stock_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='wholesalecar',
+            index=models.Index(condition=models.Q(amount__gt=0), fields=['id'], name='wholesalecar_stock_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='retailcar',
+            constraint=models.UniqueConstraint(fields=('dealership', 'manufacturer', 'name', 'cost_price', 'retail_price'), name='unique_retail_car'),
+        ),
+        migrations.AddConstraint(
+            model_name='wholesalecar',
+            constraint=models.UniqueConstraint(fields=('manufacturer', 'name', 'cost_price', 'wholesale_price'), name='unique_wholesale_car'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:05
+
+from django.db import migrations
+from django.db.models import BigIntegerField, ExpressionWrapper, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def total(queryset, lookup, expression):
+    return Coalesce(Subquery(
+        queryset.values(lookup).annotate(total=Sum(expression)).values("total")[:1]),
+        Value(0), output_field=BigIntegerField())
+
+
+def backfill(model, cars, car_lookup, deals, deal_lookup):
+    cars = cars.objects.filter(**{car_lookup: OuterRef("pk")})
+    deals = deals.objects.filter(**{deal_lookup: OuterRef("pk")}, status="PE")
+    value = ExpressionWrapper(F("amount") * F("cost_price"), output_field=BigIntegerField())
+    model.objects.update(
+        cars_in_stock=total(cars, car_lookup, "amount"),
+        stock_value=total(cars, car_lookup, value),
+        pending_deal_value=total(deals, deal_lookup, "asking_price"),
+    )
+
+
+def backfill_stock_counters(apps, schema_editor):
+    backfill(apps.get_model("manufacturers", "Manufacturer"),
+             apps.get_model("inventory", "WholesaleCar"), "manufacturer",
+             apps.get_model("deals", "WholesaleDeal"), "car__manufacturer")
+    backfill(apps.get_model("dealerships", "Dealership"),
+             apps.get_model("inventory", "RetailCar"), "dealership",
+             apps.get_model("deals", "RetailDeal"), "car__dealership")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dealerships', '0005_stock_counters'),
+        ('manufacturers', '0010_stock_counters'),
+        ('inventory', '0007_inventory_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_stock_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:55
+
+from django.db import migrations
+
+
+def install(apps, schema_editor):
+    from inventory import search
+    search.install(schema_editor.connection)
+
+
+def uninstall(apps, schema_editor):
+    from inventory import search
+    search.uninstall(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dealerships', '0005_stock_counters'),
+        ('manufacturers', '0010_stock_counters'),
+        ('inventory', '0008_backfill_stock_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(install, uninstall),
+    ]
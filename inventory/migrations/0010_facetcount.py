@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:02
+
+from django.db import migrations, models
+
+
+def backfill(apps, schema_editor):
+    from inventory import facets
+    facets.rebuild(apps, using=schema_editor.connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0009_retailcar_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacetCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('catalogue', models.CharField(choices=[('wholesale', 'Wholesale'), ('retail', 'Retail')], max_length=9)),
+                ('facet', models.CharField(choices=[('manufacturer', 'Manufacturer'), ('country', 'Country'), ('price', 'Price')], max_length=12)),
+                ('value', models.CharField(max_length=20)),
+                ('cars', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='facetcount',
+            constraint=models.UniqueConstraint(fields=('catalogue', 'facet', 'value'), name='unique_facet_value'),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,86 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# SQLite rebuilds inventory_retailcar to add the column and constraint,
+# which its search triggers would not survive. Other databases alter the
+# table in place and keep their search index as it is.
+
+def install_search(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    from inventory import search
+    search.install(schema_editor.connection)
+
+
+def uninstall_search(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    from inventory import search
+    search.uninstall(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0010_facetcount'),
+    ]
+
+    operations = [
+        migrations.RunPython(uninstall_search, install_search),
+        migrations.CreateModel(
+            name='RetailReservation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.PositiveIntegerField()),
+                ('expires_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='WholesaleReservation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.PositiveIntegerField()),
+                ('expires_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='retailcar',
+            name='reserved',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='wholesalecar',
+            name='reserved',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddConstraint(
+            model_name='retailcar',
+            constraint=models.CheckConstraint(check=models.Q(('reserved__lte', models.F('amount'))), name='retailcar_reserved_in_stock'),
+        ),
+        migrations.AddConstraint(
+            model_name='wholesalecar',
+            constraint=models.CheckConstraint(check=models.Q(('reserved__lte', models.F('amount'))), name='wholesalecar_reserved_in_stock'),
+        ),
+        migrations.AddField(
+            model_name='wholesalereservation',
+            name='car',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='inventory.wholesalecar'),
+        ),
+        migrations.AddField(
+            model_name='retailreservation',
+            name='car',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='inventory.retailcar'),
+        ),
+        migrations.AddIndex(
+            model_name='wholesalereservation',
+            index=models.Index(fields=['expires_at'], name='wholesalereservation_exp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='retailreservation',
+            index=models.Index(fields=['expires_at'], name='retailreservation_exp_idx'),
+        ),
+        migrations.RunPython(install_search, uninstall_search),
+    ]
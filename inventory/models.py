@@ -7,16 +7,85 @@ from manufacturers.models import Manufacturer
 # Create your models here.
 
 
+class WholesaleCarQuerySet(models.QuerySet):
+    """ QuerySet for wholesale cars. """
+
+    def in_stock(self):
+        return self.filter(amount__gt=0)
+
+    def owned_by(self, manufacturer_id):
+        """ Cars of a manufacturer, none if manufacturer_id is None. """
+
+        if manufacturer_id is None:
+            return self.none()
+        return self.filter(manufacturer_id=manufacturer_id)
+
+    def for_catalogue(self):
+        """ Cars in stock with the manufacturer joined in for rendering lists. """
+
+        return self.in_stock().select_related("manufacturer").only(
+            "name", "cost_price", "wholesale_price", "amount", "reserved",
+            "manufacturer__name").order_by("pk")
+
+
+class RetailCarQuerySet(models.QuerySet):
+    """ QuerySet for retail cars. """
+
+    def in_stock(self):
+        return self.filter(amount__gt=0)
+
+    def owned_by(self, dealership_id):
+        """ Cars of a dealership, none if dealership_id is None. """
+
+        if dealership_id is None:
+            return self.none()
+        return self.filter(dealership_id=dealership_id)
+
+    def for_catalogue(self):
+        """
+        Cars in stock with the manufacturer and dealership joined in
+        for rendering lists.
+        """
+
+        return self.in_stock().select_related("manufacturer", "dealership").only(
+            "name", "cost_price", "retail_price", "amount", "reserved",
+            "manufacturer__name", "dealership__name").order_by("pk")
+
 
 class WholesaleCar(models.Model):
-    """ Model definition for wholesale car.""" 
-    
+    """ Model definition for wholesale car."""
+
     name = models.CharField(max_length=50, null=True)
     cost_price = models.PositiveIntegerField(default=0)
     wholesale_price = models.PositiveIntegerField(default=0)
     amount = models.PositiveIntegerField(default=0)
+    # Part of amount held for pending deals; see inventory.reservations
+    reserved = models.PositiveIntegerField(default=0)
     manufacturer = models.ForeignKey(Manufacturer, on_delete=models.CASCADE,null=True)
 
+    objects = WholesaleCarQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Catalogue pages: in_stock() ordered by pk, per manufacturer or overall
+            models.Index(fields=["manufacturer", "id"], condition=models.Q(amount__gt=0),
+                         name="wholesalecar_mfr_stock_idx"),
+            models.Index(fields=["id"], condition=models.Q(amount__gt=0),
+                         name="wholesalecar_stock_idx"),
+        ]
+        constraints = [
+            # Manufacturing orders and settlements add to the matching row
+            models.UniqueConstraint(
+                fields=["manufacturer", "name", "cost_price", "wholesale_price"],
+                name="unique_wholesale_car"),
+            models.CheckConstraint(check=models.Q(reserved__lte=models.F("amount")),
+                                   name="wholesalecar_reserved_in_stock"),
+        ]
+
+    @property
+    def available(self):
+        """ Cars in stock not reserved for pending deals. """
+        return self.amount - self.reserved
 
     def get_absolute_url(self):
         from django.urls import reverse
@@ -33,12 +102,108 @@ class RetailCar(models.Model):
     cost_price = models.PositiveIntegerField(default=0)
     retail_price = models.PositiveIntegerField(default=0)
     amount = models.PositiveIntegerField(default=0)
+    # Part of amount held for pending deals; see inventory.reservations
+    reserved = models.PositiveIntegerField(default=0)
     dealership = models.ForeignKey(Dealership, on_delete=models.CASCADE,null=True)
     manufacturer = models.ForeignKey(Manufacturer, on_delete=models.DO_NOTHING, null=True)
 
+    objects = RetailCarQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["dealership", "id"], condition=models.Q(amount__gt=0),
+                         name="retailcar_dealer_stock_idx"),
+            models.Index(fields=["id"], condition=models.Q(amount__gt=0),
+                         name="retailcar_stock_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["dealership", "manufacturer", "name", "cost_price", "retail_price"],
+                name="unique_retail_car"),
+            models.CheckConstraint(check=models.Q(reserved__lte=models.F("amount")),
+                                   name="retailcar_reserved_in_stock"),
+        ]
+
+    @property
+    def available(self):
+        """ Cars in stock not reserved for pending deals. """
+        return self.amount - self.reserved
+
     def get_absolute_url(self):
         from django.urls import reverse
         return reverse('inventory:retail_detail', kwargs={'pk': self.pk})
 
     def __str__(self):
         return "%s %s" % (self.manufacturer,self.name)
+
+
+class Reservation(models.Model):
+    """
+    Cars of a car held for one pending deal until the deal is settled or
+    rejected, or until expires_at. Maintained by inventory.reservations.
+    """
+
+    amount = models.PositiveIntegerField()
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        abstract = True
+
+    def __str__(self):
+        return "%d x %s until %s" % (self.amount, self.car, self.expires_at)
+
+
+class WholesaleReservation(Reservation):
+    car = models.ForeignKey(WholesaleCar, on_delete=models.CASCADE, related_name="reservations")
+
+    class Meta:
+        indexes = [
+            # release_reservations: the expired ones
+            models.Index(fields=["expires_at"], name="wholesalereservation_exp_idx"),
+        ]
+
+
+class RetailReservation(Reservation):
+    car = models.ForeignKey(RetailCar, on_delete=models.CASCADE, related_name="reservations")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["expires_at"], name="retailreservation_exp_idx"),
+        ]
+
+
+class FacetCount(models.Model):
+    """
+    Number of cars in stock in a catalogue for one facet value, e.g. the
+    retail cars made by one manufacturer. Maintained by inventory.facets.
+    """
+
+    WHOLESALE = "wholesale"
+    RETAIL = "retail"
+    CATALOGUES = (
+        (WHOLESALE, "Wholesale"),
+        (RETAIL, "Retail"),
+    )
+
+    MANUFACTURER = "manufacturer"
+    COUNTRY = "country"
+    PRICE = "price"
+    FACETS = (
+        (MANUFACTURER, "Manufacturer"),
+        (COUNTRY, "Country"),
+        (PRICE, "Price"),
+    )
+
+    catalogue = models.CharField(max_length=9, choices=CATALOGUES)
+    facet = models.CharField(max_length=12, choices=FACETS)
+    value = models.CharField(max_length=20)
+    cars = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["catalogue", "facet", "value"],
+                                    name="unique_facet_value"),
+        ]
+
+    def __str__(self):
+        return "%s %s=%s: %d" % (self.catalogue, self.facet, self.value, self.cars)
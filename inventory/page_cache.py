@@ -0,0 +1,120 @@
+"""
+Read-through cache for the wholesale and retail catalogue pages.
+
+The car list, facets and pagination of a catalogue page are the same for
+every user, so they are rendered once per page and filter combination and
+kept in the "catalogue" cache (see CACHES in settings.py); only the
+surrounding base template is rendered per request.
+
+Cache keys hold the version stamps (see inventory.versions) of the models
+shown on the catalogue's pages, and a catalogue is invalidated by renewing
+a stamp rather than by deleting keys, which works on every cache backend.
+Stamps are renewed when a car, manufacturer or dealership is saved or
+deleted and by the code paths that change stock without sending signals,
+which call invalidate().
+"""
+
+import hashlib
+import threading
+from collections import Counter
+from urllib.parse import urlencode
+
+from django.core.cache import caches
+from django.template.loader import render_to_string
+
+from dealerships.models import Dealership
+from manufacturers.models import Manufacturer
+
+from . import versions
+from .models import FacetCount, RetailCar, WholesaleCar
+
+
+CACHE_ALIAS = "catalogue"
+
+# Models shown on the pages of each catalogue, its cars first
+MODELS = {
+    FacetCount.WHOLESALE: (WholesaleCar, Manufacturer),
+    FacetCount.RETAIL: (RetailCar, Manufacturer, Dealership),
+}
+
+HIT = "hit"
+MISS = "miss"
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def get_cache():
+    return caches[CACHE_ALIAS]
+
+
+def stats():
+    """ Returns this process's {(catalogue, "hit" or "miss"): count}. """
+
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _record(catalogue, outcome):
+    with _stats_lock:
+        _stats[catalogue, outcome] += 1
+
+
+def version(catalogue):
+    """ Returns the current version of a catalogue's cached pages. """
+
+    return "-".join(str(stamp) for stamp in versions.versions(*MODELS[catalogue]))
+
+
+def invalidate(*catalogues):
+    """
+    Drops the cached pages of the given catalogues, by renewing the version
+    stamps of their cars.
+    """
+
+    versions.touch(*[MODELS[catalogue][0] for catalogue in catalogues])
+
+
+class CachedCatalogueMixin:
+    """
+    ListView mixin serving the catalogue part of the page from the cache.
+
+    fragment_template_name renders the cars, facets and pagination and is
+    cached per catalogue version, cursor and facet filters; template_name
+    is rendered around it on every request with the fragment as
+    `catalogue` (and, on a miss, the usual ListView context).
+    Requires FacetFilterMixin and KeysetPaginationMixin.
+
+    Responses carry an X-Cache: HIT or MISS header.
+    """
+
+    fragment_template_name = None
+
+    def get_page_key(self):
+        catalogue = self.facet_catalogue
+        params = sorted(self.get_facet_filters().items())
+        params.append((self.cursor_kwarg, self.request.GET.get(self.cursor_kwarg) or ""))
+        digest = hashlib.md5(urlencode(params).encode()).hexdigest()
+        return "catalogue-page:%s:%s:%s" % (catalogue, version(catalogue), digest)
+
+    def get(self, request, *args, **kwargs):
+        cache = get_cache()
+        key = self.get_page_key()
+        fragment = cache.get(key)
+        if fragment is None:
+            outcome = MISS
+            self.object_list = self.get_queryset()
+            context = self.get_context_data()
+            context["catalogue"] = render_to_string(
+                self.fragment_template_name, context, request)
+            cache.set(key, context["catalogue"])
+        else:
+            outcome = HIT
+            # Read by ListView.get_template_names()
+            self.object_list = None
+            context = {"view": self, "catalogue": fragment}
+        _record(self.facet_catalogue, outcome)
+
+        response = self.render_to_response(context)
+        response["X-Cache"] = outcome.upper()
+        return response
@@ -0,0 +1,178 @@
+"""
+Keyset (cursor) pagination for list views.
+
+Offset pagination runs a COUNT(*) and an OFFSET scan on every page, so deep
+pages get slower as the table grows. Keyset pagination instead filters on the
+ordering key of the last row shown (?after=<cursor>), so every page costs the
+same index range scan as the first one.
+"""
+
+import base64
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.db.models import Q
+from django.http import Http404
+
+
+def encode_cursor(values):
+    """ Encodes a list of ordering key values into an opaque url-safe token. """
+
+    data = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_cursor(token, length):
+    """
+    Decodes a token created by encode_cursor.
+
+    Raises ValueError if the token is malformed or holds the wrong number of values.
+    """
+
+    padded = token + "=" * (-len(token) % 4)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def clean_cursor(model, fields, values):
+    """
+    Converts decoded cursor values to the types of their ordering fields.
+
+    Raises ValueError if a value is null or not valid for its field.
+    """
+
+    cleaned = []
+    for field, value in zip(fields, values):
+        name = field.lstrip("-")
+        model_field = model._meta.pk if name == "pk" else model._meta.get_field(name)
+        if value is None:
+            raise ValueError("Invalid cursor")
+        try:
+            cleaned.append(model_field.get_prep_value(model_field.to_python(value)))
+        except (TypeError, ValueError, ValidationError):
+            raise ValueError("Invalid cursor")
+    return cleaned
+
+
+def keyset_filter(fields, values):
+    """
+    Builds the Q object selecting rows strictly after values in the
+    ordering given by fields, where "-field" is descending.
+
+    (a, b) > (x, y) is expanded to a > x OR (a = x AND b > y) so that it
+    works on every database backend and can use a composite index.
+    """
+
+    condition = Q()
+    for i, field in enumerate(fields):
+        name = field.lstrip("-")
+        lookup = "lt" if field.startswith("-") else "gt"
+        term = Q(**{"%s__%s" % (name, lookup): values[i]})
+        for prev_field, prev_value in zip(fields[:i], values[:i]):
+            term &= Q(**{prev_field.lstrip("-"): prev_value})
+        condition |= term
+    return condition
+
+
+class KeysetPage:
+    """
+    A page of results from keyset pagination.
+
+    Exposes the parts of Django's Page interface that make sense without
+    an offset (has_next, has_previous, object_list) plus the cursor for
+    the next page and an optional approximate total count.
+    """
+
+    def __init__(self, object_list, cursor, next_cursor, approximate_count=None):
+        self.object_list = object_list
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+        self.approximate_count = approximate_count
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginationMixin:
+    """
+    ListView mixin paginating on an opaque ?after= cursor instead of ?page=.
+
+    The queryset is ordered by cursor_fields (which should end in a unique
+    field, usually pk, and may be "-pk" for newest first) and each page fetches paginate_by + 1 rows to know
+    whether there is a next page, so no COUNT(*) is needed.
+
+    Set approximate_count to show an estimated total of the queryset: on
+    PostgreSQL it is the planner's row estimate, elsewhere the exact count
+    is cached for approximate_count_timeout seconds.
+    """
+
+    paginate_by = 52
+    cursor_fields = ("pk",)
+    cursor_kwarg = "after"
+    approximate_count = False
+    approximate_count_timeout = 60
+
+    def get_cursor_values(self, obj):
+        return [getattr(obj, field.lstrip("-")) for field in self.cursor_fields]
+
+    def get_approximate_count(self, queryset):
+        connection = connections[queryset.db]
+        if connection.vendor == "postgresql":
+            sql, params = queryset.order_by().query.get_compiler(queryset.db).as_sql()
+            with connection.cursor() as cursor:
+                cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+                plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return int(plan[0]["Plan"]["Plan Rows"])
+
+        key = "keyset-count:%s" % hashlib.md5(
+            str(queryset.query).encode()).hexdigest()
+        return cache.get_or_set(key, queryset.count, self.approximate_count_timeout)
+
+    def paginate_queryset(self, queryset, page_size):
+        fields = list(self.cursor_fields)
+        queryset = queryset.order_by(*fields)
+
+        cursor = self.request.GET.get(self.cursor_kwarg) or None
+        page_queryset = queryset
+        if cursor is not None:
+            try:
+                values = clean_cursor(queryset.model, fields,
+                                      decode_cursor(cursor, len(fields)))
+            except ValueError:
+                raise Http404("Invalid cursor")
+            page_queryset = queryset.filter(keyset_filter(fields, values))
+
+        object_list = list(page_queryset[:page_size + 1])
+        next_cursor = None
+        if len(object_list) > page_size:
+            object_list = object_list[:page_size]
+            next_cursor = encode_cursor(self.get_cursor_values(object_list[-1]))
+
+        approximate_count = None
+        if self.approximate_count:
+            approximate_count = self.get_approximate_count(queryset)
+
+        page = KeysetPage(object_list, cursor, next_cursor, approximate_count)
+        return (None, page, object_list, page.has_other_pages())
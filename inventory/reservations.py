@@ -0,0 +1,170 @@
+"""
+Stock reservations.
+
+Making a deal reserves the cars it is for, so that they cannot be promised
+to another deal while it is pending. Besides amount (the cars in stock),
+every wholesale and retail car row keeps reserved, the part of amount held
+by reservations, so the cars still available are amount - reserved, read
+from the car's own row. reserve() takes them with one conditional UPDATE
+of that row:
+
+    UPDATE ... SET reserved = reserved + n WHERE id = ... AND amount >= reserved + n
+
+which makes the check and the write atomic, so concurrent deals cannot
+reserve the same cars, and a CHECK constraint keeps reserved <= amount.
+
+Each reservation is also a row (WholesaleReservation, RetailReservation)
+with its amount and expiry, RESERVATION_TTL seconds after the deal was
+made, and the deal points at it. Settling the deal takes the cars out of
+amount and reserved together (take()), rejecting it gives them back
+(release()); both delete the row. Expired reservations are released in
+batches by
+
+    python manage.py release_reservations
+
+and those of a car at once when a new reservation for it does not fit
+otherwise. A deal whose reservation expired stays pending, and can still
+be settled if enough cars are available by then.
+
+The catalogues show the cars available, so every change of reserved
+invalidates the catalogue's cached pages (inventory.page_cache).
+
+Reservation rows are locked after the manufacturers and dealerships and
+before the cars; see deals.settlement.
+"""
+
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import counters, page_cache
+from .models import FacetCount, RetailCar, RetailReservation, WholesaleCar, WholesaleReservation
+
+
+RESERVATIONS = {
+    WholesaleCar: WholesaleReservation,
+    RetailCar: RetailReservation,
+}
+
+CATALOGUES = {
+    WholesaleCar: FacetCount.WHOLESALE,
+    RetailCar: FacetCount.RETAIL,
+}
+
+
+class NotAvailable(Exception):
+    """ Raised when fewer cars are available than a reservation asks for. """
+
+
+def ttl():
+    return timedelta(seconds=getattr(settings, "RESERVATION_TTL", 7 * 24 * 3600))
+
+
+def _hold(car_model, pk, amount):
+    return car_model.objects.filter(pk=pk, amount__gte=F("reserved") + amount).update(
+        reserved=F("reserved") + amount)
+
+
+def reserve(car_model, pk, amount):
+    """
+    Reserves amount cars of the wholesale or retail car with the given pk
+    for RESERVATION_TTL seconds. Call it in the transaction saving the deal.
+
+    Returns the reservation.
+    Raises NotAvailable if fewer cars are available.
+    """
+
+    # The car's expired reservations are released first when the cars
+    # available look short, so that they are locked before the car is
+    available = car_model.objects.filter(pk=pk).values_list(
+        F("amount") - F("reserved"), flat=True).first()
+    if available is not None and available < amount:
+        release_expired(car_model, car_id=pk)
+    if not _hold(car_model, pk, amount):
+        raise NotAvailable("There are not enough cars available")
+    page_cache.invalidate(CATALOGUES[car_model])
+    return RESERVATIONS[car_model].objects.create(
+        car_id=pk, amount=amount, expires_at=timezone.now() + ttl())
+
+
+def _forget(car_model, reservation_ids):
+    """ Deletes reservations, returning how many still existed. """
+
+    if not reservation_ids:
+        return 0
+    return RESERVATIONS[car_model].objects.filter(pk__in=reservation_ids).delete()[0]
+
+
+def take(car_model, pk, amount, reservation_id=None):
+    """
+    Takes amount cars of a car out of stock for a settled deal: out of its
+    reservation while that still holds them, out of the available cars
+    otherwise.
+
+    Returns False, changing nothing, if there are not enough cars.
+    """
+
+    cars = car_model.objects.filter(pk=pk)
+    if reservation_id is not None and _forget(car_model, [reservation_id]):
+        return bool(cars.update(amount=F("amount") - amount, reserved=F("reserved") - amount))
+    return bool(cars.filter(amount__gte=F("reserved") + amount).update(
+        amount=F("amount") - amount))
+
+
+def release(car_model, pk, amount, reservation_id):
+    """ Gives the cars of a rejected deal's reservation back, if it still holds them. """
+
+    if reservation_id is not None and _forget(car_model, [reservation_id]):
+        car_model.objects.filter(pk=pk).update(reserved=F("reserved") - amount)
+        page_cache.invalidate(CATALOGUES[car_model])
+
+
+def lock(car_model, reservation_ids):
+    """ Locks the reservations among reservation_ids that still exist and returns their pks. """
+
+    reservation_ids = [pk for pk in reservation_ids if pk is not None]
+    if not reservation_ids:
+        return set()
+    return set(RESERVATIONS[car_model].objects.select_for_update().filter(
+        pk__in=reservation_ids).order_by("pk").values_list("pk", flat=True))
+
+
+def release_many(car_model, reservation_ids, released, **deltas):
+    """
+    Deletes the locked reservations of several settled or rejected deals
+    and takes their cars ({car pk: amount}) out of reserved, with one
+    statement each. deltas are added to the cars in the same UPDATE (see
+    inventory.counters.add_many).
+    """
+
+    _forget(car_model, reservation_ids)
+    counters.add_many(car_model, reserved={pk: -amount for pk, amount in released.items()},
+                      **deltas)
+    if released:
+        page_cache.invalidate(CATALOGUES[car_model])
+
+
+def release_expired(car_model, batch_size=1000, car_id=None, now=None):
+    """
+    Releases up to batch_size expired reservations of wholesale or retail
+    cars, or only those of the car with car_id, in one transaction.
+
+    Returns the number released.
+    """
+
+    expired = RESERVATIONS[car_model].objects.filter(expires_at__lte=now or timezone.now())
+    if car_id is not None:
+        expired = expired.filter(car_id=car_id)
+
+    with transaction.atomic():
+        rows = list(expired.select_for_update(skip_locked=True).order_by(
+            "expires_at").values_list("pk", "car_id", "amount")[:batch_size])
+        released = defaultdict(int)
+        for pk, car, amount in rows:
+            released[car] += amount
+        release_many(car_model, [pk for pk, car, amount in rows], released)
+    return len(rows)
@@ -0,0 +1,361 @@
+"""
+Ranked search over the retail catalogue.
+
+Retail cars are matched on their name, their manufacturer's name and their
+dealership's country (by code or by country name) through a full-text
+index kept up to date by database triggers, so bulk_create() and raw
+updates are indexed too:
+
+- PostgreSQL: a weighted tsvector column on inventory_retailcar with a GIN
+  index, plus a pg_trgm index on the name so misspelt names still match.
+- SQLite: FTS5 tables over all three fields and over the name alone,
+  ranked by the fields that matched (see sqlite_tiers()).
+
+Other backends fall back to unindexed icontains filters ordered by pk.
+
+The index is created by inventory/migrations/0009_retailcar_search.py.
+SQLite drops the triggers whenever a migration rebuilds inventory_retailcar
+(e.g. AlterField), so such migrations must call install() again; the
+rebuild_search_index command reinstalls and repopulates the index by hand.
+"""
+
+import re
+
+from django.db import connections
+from django.db.models import Q
+
+from CarSupply.countries import get_countries
+
+from .models import RetailCar
+
+
+# Longer queries are cut down to their first MAX_TERMS words, and shorter
+# words than MIN_LENGTH are ignored (the prefix indexes start at 2 letters)
+MAX_TERMS = 8
+MIN_LENGTH = 2
+
+SQLITE_INSTALL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS inventory_retailcar_fts USING fts5(
+        name, manufacturer, country, prefix='2 3',
+        tokenize='unicode61 remove_diacritics 2')
+    """,
+    # Column filters read a word's whole doclist, so name-only matches get
+    # their own table to stay cheap for words common in manufacturer names
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS inventory_retailcar_name_fts USING fts5(
+        name, prefix='2 3', tokenize='unicode61 remove_diacritics 2')
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS inventory_retailcar_fts_insert
+    AFTER INSERT ON inventory_retailcar BEGIN
+        INSERT INTO inventory_retailcar_name_fts(rowid, name) VALUES (new.id, new.name);
+        INSERT INTO inventory_retailcar_fts(rowid, name, manufacturer, country)
+        SELECT new.id, new.name,
+               (SELECT name FROM manufacturers_manufacturer WHERE id = new.manufacturer_id),
+               (SELECT country FROM dealerships_dealership WHERE id = new.dealership_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS inventory_retailcar_fts_update
+    AFTER UPDATE OF name, manufacturer_id, dealership_id ON inventory_retailcar BEGIN
+        DELETE FROM inventory_retailcar_name_fts WHERE rowid = old.id;
+        DELETE FROM inventory_retailcar_fts WHERE rowid = old.id;
+        INSERT INTO inventory_retailcar_name_fts(rowid, name) VALUES (new.id, new.name);
+        INSERT INTO inventory_retailcar_fts(rowid, name, manufacturer, country)
+        SELECT new.id, new.name,
+               (SELECT name FROM manufacturers_manufacturer WHERE id = new.manufacturer_id),
+               (SELECT country FROM dealerships_dealership WHERE id = new.dealership_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS inventory_retailcar_fts_delete
+    AFTER DELETE ON inventory_retailcar BEGIN
+        DELETE FROM inventory_retailcar_name_fts WHERE rowid = old.id;
+        DELETE FROM inventory_retailcar_fts WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS inventory_retailcar_fts_manufacturer
+    AFTER UPDATE OF name ON manufacturers_manufacturer BEGIN
+        UPDATE inventory_retailcar_fts SET manufacturer = new.name
+        WHERE rowid IN (SELECT id FROM inventory_retailcar WHERE manufacturer_id = new.id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS inventory_retailcar_fts_dealership
+    AFTER UPDATE OF country ON dealerships_dealership BEGIN
+        UPDATE inventory_retailcar_fts SET country = new.country
+        WHERE rowid IN (SELECT id FROM inventory_retailcar WHERE dealership_id = new.id);
+    END
+    """,
+]
+
+SQLITE_POPULATE = [
+    "DELETE FROM inventory_retailcar_name_fts",
+    "INSERT INTO inventory_retailcar_name_fts(rowid, name) SELECT id, name FROM inventory_retailcar",
+    "DELETE FROM inventory_retailcar_fts",
+    """
+    INSERT INTO inventory_retailcar_fts(rowid, name, manufacturer, country)
+    SELECT car.id, car.name, manufacturer.name, dealership.country
+    FROM inventory_retailcar car
+    LEFT JOIN manufacturers_manufacturer manufacturer ON manufacturer.id = car.manufacturer_id
+    LEFT JOIN dealerships_dealership dealership ON dealership.id = car.dealership_id
+    """,
+]
+
+SQLITE_UNINSTALL = [
+    "DROP TRIGGER IF EXISTS inventory_retailcar_fts_insert",
+    "DROP TRIGGER IF EXISTS inventory_retailcar_fts_update",
+    "DROP TRIGGER IF EXISTS inventory_retailcar_fts_delete",
+    "DROP TRIGGER IF EXISTS inventory_retailcar_fts_manufacturer",
+    "DROP TRIGGER IF EXISTS inventory_retailcar_fts_dealership",
+    "DROP TABLE IF EXISTS inventory_retailcar_name_fts",
+    "DROP TABLE IF EXISTS inventory_retailcar_fts",
+]
+
+POSTGRESQL_INSTALL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "ALTER TABLE inventory_retailcar ADD COLUMN IF NOT EXISTS search_vector tsvector",
+    """
+    CREATE OR REPLACE FUNCTION inventory_retailcar_search_vector() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector :=
+            setweight(to_tsvector('simple', coalesce(NEW.name, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(
+                (SELECT name FROM manufacturers_manufacturer
+                 WHERE id = NEW.manufacturer_id), '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce(
+                (SELECT country FROM dealerships_dealership
+                 WHERE id = NEW.dealership_id), '')), 'D');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS inventory_retailcar_search ON inventory_retailcar",
+    """
+    CREATE TRIGGER inventory_retailcar_search
+    BEFORE INSERT OR UPDATE OF name, manufacturer_id, dealership_id ON inventory_retailcar
+    FOR EACH ROW EXECUTE PROCEDURE inventory_retailcar_search_vector()
+    """,
+    # Renaming a manufacturer or moving a dealership re-runs the trigger above
+    """
+    CREATE OR REPLACE FUNCTION inventory_retailcar_search_owner() RETURNS trigger AS $$
+    BEGIN
+        IF TG_TABLE_NAME = 'manufacturers_manufacturer' THEN
+            UPDATE inventory_retailcar SET name = name WHERE manufacturer_id = NEW.id;
+        ELSE
+            UPDATE inventory_retailcar SET name = name WHERE dealership_id = NEW.id;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS inventory_retailcar_search ON manufacturers_manufacturer",
+    """
+    CREATE TRIGGER inventory_retailcar_search
+    AFTER UPDATE OF name ON manufacturers_manufacturer
+    FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+    EXECUTE PROCEDURE inventory_retailcar_search_owner()
+    """,
+    "DROP TRIGGER IF EXISTS inventory_retailcar_search ON dealerships_dealership",
+    """
+    CREATE TRIGGER inventory_retailcar_search
+    AFTER UPDATE OF country ON dealerships_dealership
+    FOR EACH ROW WHEN (OLD.country IS DISTINCT FROM NEW.country)
+    EXECUTE PROCEDURE inventory_retailcar_search_owner()
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS retailcar_search_idx
+    ON inventory_retailcar USING gin (search_vector)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS retailcar_name_trgm_idx
+    ON inventory_retailcar USING gin (name gin_trgm_ops)
+    """,
+]
+
+POSTGRESQL_POPULATE = [
+    "UPDATE inventory_retailcar SET name = name",
+]
+
+POSTGRESQL_UNINSTALL = [
+    "DROP TRIGGER IF EXISTS inventory_retailcar_search ON dealerships_dealership",
+    "DROP TRIGGER IF EXISTS inventory_retailcar_search ON manufacturers_manufacturer",
+    "DROP TRIGGER IF EXISTS inventory_retailcar_search ON inventory_retailcar",
+    "DROP FUNCTION IF EXISTS inventory_retailcar_search_owner()",
+    "DROP FUNCTION IF EXISTS inventory_retailcar_search_vector()",
+    "DROP INDEX IF EXISTS retailcar_name_trgm_idx",
+    "DROP INDEX IF EXISTS retailcar_search_idx",
+    "ALTER TABLE inventory_retailcar DROP COLUMN IF EXISTS search_vector",
+]
+
+# On SQLite cars are ranked in tiers: every word matches the name, every
+# word matches the name or manufacturer, the rest (country matches); by id
+# within a tier. Each tier is read in rowid order only as far as the page
+# needs, while bm25() has to load every matching row before sorting, which
+# took 30-750 ms for common words at 1M cars.
+SQLITE_NAME_SEARCH = """
+    SELECT fts.rowid FROM inventory_retailcar_name_fts fts
+    JOIN inventory_retailcar car ON car.id = fts.rowid
+    WHERE inventory_retailcar_name_fts MATCH %s AND car.amount > 0
+    ORDER BY fts.rowid
+    LIMIT %s
+"""
+
+SQLITE_SEARCH = """
+    SELECT fts.rowid FROM inventory_retailcar_fts fts
+    JOIN inventory_retailcar car ON car.id = fts.rowid
+    WHERE inventory_retailcar_fts MATCH %s AND car.amount > 0
+    ORDER BY fts.rowid
+    LIMIT %s
+"""
+
+# Returns (id,) rows ordered best first
+POSTGRESQL_SEARCH = """
+    SELECT car.id FROM inventory_retailcar car, to_tsquery('simple', %s) query
+    WHERE (car.search_vector @@ query OR car.name %% %s) AND car.amount > 0
+    ORDER BY ts_rank(car.search_vector, query) + similarity(car.name, %s) DESC, car.id
+    LIMIT %s OFFSET %s
+"""
+
+
+def _run(connection, statements):
+    with connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+
+def install(connection, populate=True):
+    """ Creates the search index and its triggers, and fills it if populate is set. """
+
+    if connection.vendor == "sqlite":
+        _run(connection, SQLITE_INSTALL + (SQLITE_POPULATE if populate else []))
+    elif connection.vendor == "postgresql":
+        _run(connection, POSTGRESQL_INSTALL + (POSTGRESQL_POPULATE if populate else []))
+
+
+def uninstall(connection):
+    """ Drops the search index and its triggers. """
+
+    if connection.vendor == "sqlite":
+        _run(connection, SQLITE_UNINSTALL)
+    elif connection.vendor == "postgresql":
+        _run(connection, POSTGRESQL_UNINSTALL)
+
+
+def parse(query):
+    """
+    Splits a query into lowercase words and pairs each with the codes of
+    the countries it could refer to ("united" -> AE, GB, US, ...).
+    """
+
+    terms = []
+    words = [word for word in re.findall(r"[^\W_]+", query.lower()) if len(word) >= MIN_LENGTH]
+    for word in words[:MAX_TERMS]:
+        codes = [code for code, name in get_countries()
+                 if code.lower() == word
+                 or any(part.startswith(word) for part in re.findall(r"[^\W_]+", name.lower()))]
+        terms.append((word, codes))
+    return terms
+
+
+def _fts5_all(terms, columns=None, with_country=False):
+    clauses = []
+    for word, codes in terms:
+        clause = '"%s"*' % word.replace('"', '""')
+        if columns:
+            clause = "%s : %s" % (columns, clause)
+        if with_country and codes:
+            clause += " OR country : (%s)" % " OR ".join('"%s"' % code for code in codes)
+        clauses.append("(%s)" % clause)
+    return " AND ".join(clauses)
+
+
+def sqlite_tiers(terms):
+    """
+    Returns the (sql, FTS5 query) of each ranking tier. Every word has to
+    prefix-match the name, the name or manufacturer, or (in the last tier,
+    only when a word names a country) also the dealership's country.
+    """
+
+    tiers = [
+        (SQLITE_NAME_SEARCH, _fts5_all(terms)),
+        (SQLITE_SEARCH, _fts5_all(terms, "{name manufacturer}")),
+    ]
+    if any(codes for _, codes in terms):
+        tiers.append((SQLITE_SEARCH, _fts5_all(terms, "{name manufacturer}", with_country=True)))
+    return tiers
+
+
+def sqlite_ranked_ids(cursor, terms, limit, offset):
+    """
+    Reads the tiers in order until the page is full. Each tier also matches
+    the cars of the tiers before it, which are all known by then and fewer
+    than offset + limit, so they are skipped here rather than in SQL.
+    """
+
+    wanted = offset + limit
+    ids, seen = [], set()
+    for sql, match in sqlite_tiers(terms):
+        cursor.execute(sql, [match, wanted + len(seen)])
+        for pk, in cursor.fetchall():
+            if pk not in seen:
+                seen.add(pk)
+                ids.append(pk)
+        if len(ids) >= wanted:
+            break
+    return ids[offset:wanted]
+
+
+def postgresql_tsquery(terms):
+    """
+    Builds the to_tsquery() equivalent of the last tier of sqlite_tiers();
+    ts_rank() weighs name (A) over manufacturer (B) over country (D) matches.
+    """
+
+    clauses = []
+    for word, codes in terms:
+        options = ["%s:*AB" % word] + ["%s:D" % code.lower() for code in codes]
+        clauses.append("(%s)" % " | ".join(options))
+    return " & ".join(clauses)
+
+
+def fallback_filter(terms):
+    condition = Q()
+    for word, codes in terms:
+        condition &= (Q(name__icontains=word) | Q(manufacturer__name__icontains=word)
+                      | Q(dealership__country__in=codes))
+    return condition
+
+
+def ranked_ids(query, limit, offset=0, using="default"):
+    """ Returns the ids of the in-stock retail cars matching query, best match first. """
+
+    terms = parse(query)
+    if not terms:
+        return []
+
+    connection = connections[using]
+    if connection.vendor not in ("sqlite", "postgresql"):
+        return list(RetailCar.objects.using(using).in_stock().filter(
+            fallback_filter(terms)).order_by("pk").values_list(
+                "pk", flat=True)[offset:offset + limit])
+
+    with connection.cursor() as cursor:
+        if connection.vendor == "sqlite":
+            return sqlite_ranked_ids(cursor, terms, limit, offset)
+        text = " ".join(word for word, _ in terms)
+        cursor.execute(POSTGRESQL_SEARCH, [postgresql_tsquery(terms), text, text, limit, offset])
+        return [pk for pk, in cursor.fetchall()]
+
+
+def search(query, limit, offset=0, using="default"):
+    """
+    Returns up to limit in-stock retail cars matching query, best match
+    first, loaded with RetailCar.objects.for_catalogue().
+    """
+
+    ids = ranked_ids(query, limit, offset, using)
+    cars = RetailCar.objects.using(using).for_catalogue().in_bulk(ids)
+    return [cars[pk] for pk in ids if pk in cars]
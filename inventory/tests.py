@@ -1,7 +1,27 @@
+import os
+import tempfile
+import time
+from io import StringIO
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from django.urls import reverse
 
-from .models import WholesaleCar, RetailCar
+from . import counters, facets, imports, page_cache, reservations, search, versions
+from .models import FacetCount, WholesaleCar, WholesaleReservation, RetailCar
+from .pagination import clean_cursor, decode_cursor, encode_cursor, keyset_filter
+from blueprints.models import Car
+from deals.models import RetailDeal, WholesaleDeal
+from deals.settlement import (InsufficientStock, reject_wholesale_deal,
+                              reject_wholesale_deals, settle_retail_deal, settle_wholesale_deal,
+                              settle_wholesale_deals)
+from manufacturers.fulfilment import fulfil_orders
 from manufacturers.models import Manufacturer
 from dealerships.models import Dealership
 from users.models import User
@@ -361,3 +381,843 @@ class OtherUserTypesRetailCarTest(TestCase):
         post_response = self.client.post(reverse("inventory:retail_delete", kwargs={"pk": self.car1.pk}))
         self.assertEqual(post_response.status_code, 403)
 
+
+
+###########################################
+
+
+class CatalogueQueryCountTest(TestCase):
+    """
+    Tests to ascertain that the catalogue pages run a constant number
+    of queries regardless of how many cars are on the page
+    """
+    def setUp(self):
+        self.manufacturer = Manufacturer.objects.create(name="first_manufacturer",balance=2000000)
+        self.dealership = Dealership.objects.create(name="first_dealership",balance=2000000)
+
+    def create_cars(self, count):
+        for i in range(count):
+            manufacturer = Manufacturer.objects.create(name="manufacturer%d" % i)
+            dealership = Dealership.objects.create(name="dealership%d" % i)
+            WholesaleCar.objects.create(
+                name="car%d" % i, wholesale_price=2000, amount=3, manufacturer=manufacturer)
+            RetailCar.objects.create(
+                name="car%d" % i, retail_price=2000, amount=3,
+                dealership=dealership, manufacturer=manufacturer)
+
+    def test_all_retail_car_list_query_count(self):
+        self.client.force_login(User.objects.create(username="customer",user_type=User.CUSTOMER))
+        for count in (1, 51):
+            self.create_cars(count)
+            cache.clear()
+            # Warm the approximate count cache.
+            self.client.get(reverse("inventory:dealership_inventory"))
+            page_cache.get_cache().clear()
+            # session, user, cars, facet counts
+            with self.assertNumQueries(4):
+                response = self.client.get(reverse("inventory:dealership_inventory"))
+            self.assertContains(response, "Car Dealership: dealership0")
+
+    def test_all_wholesale_car_list_query_count(self):
+        self.client.force_login(User.objects.create(username="dealer",user_type=User.DEALERSHIP))
+        for count in (1, 51):
+            self.create_cars(count)
+            cache.clear()
+            self.client.get(reverse("inventory:manufacturers_inventory"))
+            page_cache.get_cache().clear()
+            with self.assertNumQueries(4):
+                response = self.client.get(reverse("inventory:manufacturers_inventory"))
+            self.assertContains(response, "Car manufacturer: manufacturer0")
+
+    def test_inventory_list_query_count(self):
+        admin = User.objects.create(username="tester",user_type=User.DEALERSHIP)
+        self.dealership.admin = admin
+        self.dealership.save()
+        self.client.force_login(admin)
+        for count in (1, 30):
+            for i in range(count):
+                RetailCar.objects.create(
+                    name="car%d-%d" % (count, i), retail_price=2000, amount=3,
+                    dealership=self.dealership, manufacturer=self.manufacturer)
+            # session, user, cars, dealership
+            with self.assertNumQueries(4):
+                self.client.get(reverse("inventory:index"))
+
+
+class CataloguePaginationTest(TestCase):
+    """
+    Tests to ascertain that the catalogue pages are walked with a cursor
+    """
+    def setUp(self):
+        manufacturer = Manufacturer.objects.create(name="first_manufacturer",balance=2000000)
+        dealership = Dealership.objects.create(name="first_dealership",balance=2000000)
+        RetailCar.objects.bulk_create([
+            RetailCar(name="car%d" % i, retail_price=2000, amount=3,
+                dealership=dealership, manufacturer=manufacturer)
+            for i in range(60)
+        ])
+        cache.clear()
+        page_cache.get_cache().clear()
+        self.client.force_login(User.objects.create(username="customer",user_type=User.CUSTOMER))
+
+    def test_retail_car_list_cursor(self):
+        # Out of stock, so neither listed nor counted
+        sold = RetailCar.objects.create(name="sold", retail_price=2000, amount=0)
+        response = self.client.get(reverse("inventory:dealership_inventory"))
+        first_page = response.context_data["cars"]
+        self.assertEqual(len(first_page), 52)
+        self.assertContains(response, "About 60 cars.")
+        page_obj = response.context_data["page_obj"]
+        self.assertTrue(page_obj.has_next())
+        self.assertFalse(page_obj.has_previous())
+
+        response = self.client.get(reverse("inventory:dealership_inventory"),
+            data={"after": page_obj.next_cursor})
+        second_page = response.context_data["cars"]
+        self.assertEqual(len(second_page), 8)
+        self.assertFalse(response.context_data["page_obj"].has_next())
+        self.assertTrue(response.context_data["page_obj"].has_previous())
+        self.assertEqual(
+            set(car.pk for car in first_page) | set(car.pk for car in second_page),
+            set(RetailCar.objects.exclude(pk=sold.pk).values_list("pk", flat=True)))
+
+    def test_retail_car_list_invalid_cursor(self):
+        response = self.client.get(reverse("inventory:dealership_inventory"),
+            data={"after": "not-a-cursor"})
+        self.assertEqual(response.status_code, 404)
+        for values in ([{"a": 1}], [[1, 2]], ["abc"], [None]):
+            response = self.client.get(reverse("inventory:dealership_inventory"),
+                data={"after": encode_cursor(values)})
+            self.assertEqual(response.status_code, 404, values)
+
+    def test_composite_keyset_filter(self):
+        RetailCar.objects.filter(pk__in=RetailCar.objects.order_by("pk").values("pk")[:30]).update(retail_price=1000)
+        ordered = list(RetailCar.objects.order_by("retail_price", "pk"))
+        fields = ("retail_price", "pk")
+        values = decode_cursor(encode_cursor([ordered[20].retail_price, ordered[20].pk]), 2)
+        self.assertEqual(clean_cursor(RetailCar, fields, [str(value) for value in values]),
+            values)
+        after = RetailCar.objects.filter(keyset_filter(fields, values)).order_by(*fields)
+        self.assertEqual(list(after), ordered[21:])
+
+
+class InventoryConstraintTest(TestCase):
+    """
+    Tests to ascertain that a car is stored once per owner, name and price
+    """
+    def setUp(self):
+        self.manufacturer = Manufacturer.objects.create(name="first_manufacturer",balance=2000000)
+        self.dealership = Dealership.objects.create(name="first_dealership",balance=2000000)
+
+    def test_unique_wholesale_car(self):
+        WholesaleCar.objects.create(name="car", cost_price=2000, wholesale_price=2000,
+            amount=1, manufacturer=self.manufacturer)
+        WholesaleCar.objects.create(name="car", cost_price=2000, wholesale_price=3000,
+            amount=1, manufacturer=self.manufacturer)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            WholesaleCar.objects.create(name="car", cost_price=2000, wholesale_price=2000,
+                amount=5, manufacturer=self.manufacturer)
+
+    def test_unique_retail_car(self):
+        RetailCar.objects.create(name="car", cost_price=2000, retail_price=2000,
+            amount=1, dealership=self.dealership, manufacturer=self.manufacturer)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            RetailCar.objects.create(name="car", cost_price=2000, retail_price=2000,
+                amount=1, dealership=self.dealership, manufacturer=self.manufacturer)
+
+
+class StockCounterTest(TestCase):
+    """
+    Tests to ascertain that the manufacturer and dealership stock counters
+    follow manufacturing orders and deals, and that drift is reconciled
+    """
+    def setUp(self):
+        self.manu_admin = User.objects.create(username="manu_admin",user_type=User.MANUFACTURER)
+        self.dealer_admin = User.objects.create(username="dealer_admin",user_type=User.DEALERSHIP)
+        self.manufacturer = Manufacturer.objects.create(
+            name="first_manufacturer",balance=2000000,admin=self.manu_admin)
+        self.dealership = Dealership.objects.create(
+            name="first_dealership",balance=2000000,admin=self.dealer_admin)
+        self.blueprint = Car.objects.create(name="car", price=1000, manufacturer=self.manufacturer)
+
+    def assertCounters(self, obj, cars, value, pending):
+        obj.refresh_from_db()
+        self.assertEqual((obj.cars_in_stock, obj.stock_value, obj.pending_deal_value),
+            (cars, value, pending))
+
+    def test_counters(self):
+        self.client.force_login(self.manu_admin)
+        self.client.post(reverse("manufacturers:create"), data={"car": self.blueprint.pk, "count": 10})
+        fulfil_orders()
+        self.assertCounters(self.manufacturer, 10, 10000, 0)
+        car = WholesaleCar.objects.get(manufacturer=self.manufacturer)
+        WholesaleCar.objects.filter(pk=car.pk).update(wholesale_price=1500)
+
+        self.client.force_login(self.dealer_admin)
+        for asking_price in (6000, 3000):
+            self.client.post(reverse("deals:wholesale_deal_create", kwargs={"pk": car.pk}),
+                data={"car": car.pk, "amount": 4, "asking_price": asking_price})
+        self.assertCounters(self.manufacturer, 10, 10000, 9000)
+
+        accepted, rejected = WholesaleDeal.objects.order_by("pk")
+        settle_wholesale_deal(accepted.pk)
+        reject_wholesale_deal(rejected.pk)
+        self.assertCounters(self.manufacturer, 6, 6000, 0)
+        self.assertCounters(self.dealership, 4, 6000, 0)
+
+        retail_car = RetailCar.objects.get(dealership=self.dealership)
+        deal = RetailDeal.objects.create(car=retail_car, asking_price=2000, amount=1,
+            customer=User.objects.create(username="customer",user_type=User.CUSTOMER,balance=5000))
+        counters.add(Dealership, self.dealership.pk, pending=2000)
+        settle_retail_deal(deal.pk)
+        self.assertCounters(self.dealership, 3, 4500, 0)
+
+        self.client.force_login(self.dealer_admin)
+        response = self.client.get(reverse("inventory:index"))
+        self.assertContains(response, "3 cars in stock worth $4,500 at cost price.")
+
+        self.client.force_login(self.manu_admin)
+        self.client.post(reverse("inventory:wholesale_delete", kwargs={"pk": car.pk}))
+        self.assertCounters(self.manufacturer, 0, 0, 0)
+
+        self.assertEqual(counters.reconcile(Manufacturer), [])
+        self.assertEqual(counters.reconcile(Dealership), [])
+
+    def test_reconcile_counters_command(self):
+        WholesaleCar.objects.create(name="car", cost_price=1000, amount=3,
+            manufacturer=self.manufacturer)
+
+        out = StringIO()
+        call_command("reconcile_counters", dry_run=True, stdout=out)
+        self.assertIn("cars_in_stock is 0, should be 3", out.getvalue())
+        self.assertIn("manufacturers.Manufacturer: 1 rows checked, 2 counters would be corrected",
+            out.getvalue())
+        self.assertCounters(self.manufacturer, 0, 0, 0)
+
+        # Changes made after the counters were read are kept
+        counters.add(Manufacturer, self.manufacturer.pk, cars=1)
+        call_command("reconcile_counters", stdout=StringIO())
+        self.assertCounters(self.manufacturer, 3, 3000, 0)
+
+
+class RetailCarSearchTest(TestCase):
+    """
+    Tests to ascertain that the retail catalogue search matches car names,
+    manufacturer names and dealership countries, and ranks name matches first
+    """
+    def setUp(self):
+        toyota = Manufacturer.objects.create(name="Toyota", country="JP")
+        self.corolla_maker = Manufacturer.objects.create(name="Corolla Motors", country="US")
+        self.german = Dealership.objects.create(name="first_dealership", country="DE")
+        self.american = Dealership.objects.create(name="second_dealership", country="US")
+        self.corolla = RetailCar.objects.create(name="Corolla", retail_price=2000, amount=3,
+            dealership=self.german, manufacturer=toyota)
+        self.camry = RetailCar.objects.create(name="Camry", retail_price=2000, amount=3,
+            dealership=self.american, manufacturer=toyota)
+        self.sedan = RetailCar.objects.create(name="Sedan", retail_price=2000, amount=3,
+            dealership=self.american, manufacturer=self.corolla_maker)
+        RetailCar.objects.create(name="Corolla Sold Out", retail_price=2000, amount=0,
+            dealership=self.german, manufacturer=toyota)
+        self.client.force_login(User.objects.create(username="customer",user_type=User.CUSTOMER))
+
+    def search(self, query):
+        return [car.pk for car in search.search(query, 10)]
+
+    def test_ranking(self):
+        self.assertEqual(self.search("corolla"), [self.corolla.pk, self.sedan.pk])
+        self.assertEqual(self.search("toy"), [self.corolla.pk, self.camry.pk])
+        self.assertEqual(self.search("toyota camry"), [self.camry.pk])
+        self.assertEqual(self.search(""), [])
+        self.assertEqual(self.search('"*) OR ('), [])
+
+    def test_country(self):
+        self.assertEqual(self.search("germany"), [self.corolla.pk])
+        self.assertEqual(set(self.search("united states")), {self.camry.pk, self.sedan.pk})
+        self.assertEqual(self.search("toyota US"), [self.camry.pk])
+
+    def test_index_follows_changes(self):
+        RetailCar.objects.filter(pk=self.camry.pk).update(name="Prius")
+        Dealership.objects.filter(pk=self.german.pk).update(country="FR")
+        Manufacturer.objects.filter(pk=self.corolla_maker.pk).update(name="Ford")
+        self.assertEqual(self.search("prius"), [self.camry.pk])
+        self.assertEqual(self.search("france"), [self.corolla.pk])
+        self.assertEqual(self.search("ford"), [self.sedan.pk])
+        self.assertEqual(self.search("corolla"), [self.corolla.pk])
+        self.sedan.delete()
+        self.assertEqual(self.search("ford"), [])
+
+    def test_search_view(self):
+        RetailCar.objects.bulk_create([
+            RetailCar(name="Corolla %d" % i, retail_price=2000, amount=1,
+                dealership=self.german, manufacturer=self.corolla.manufacturer)
+            for i in range(60)
+        ])
+        # session, user, ranked ids, cars
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse("inventory:retail_search"), data={"q": "corolla"})
+        self.assertEqual(len(response.context_data["cars"]), 52)
+        self.assertEqual(response.context_data["cars"][0], self.corolla)
+        page_obj = response.context_data["page_obj"]
+        self.assertContains(response, "q=corolla&amp;after=%s" % page_obj.next_cursor)
+
+        response = self.client.get(reverse("inventory:retail_search"),
+            data={"q": "corolla", "after": page_obj.next_cursor})
+        self.assertEqual(len(response.context_data["cars"]), 10)
+        self.assertFalse(response.context_data["page_obj"].has_next())
+
+        response = self.client.get(reverse("inventory:retail_search"), data={"q": "nothing"})
+        self.assertContains(response, "No cars match")
+        response = self.client.get(reverse("inventory:retail_search"),
+            data={"q": "corolla", "after": "not-a-cursor"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_rebuild_search_index_command(self):
+        call_command("rebuild_search_index", stdout=StringIO())
+        self.assertEqual(self.search("corolla"), [self.corolla.pk, self.sedan.pk])
+
+
+class FacetCountTest(TestCase):
+    """
+    Tests to ascertain that the catalogue facet counts follow manufacturing
+    orders, settlements, price changes and deletes, and that the catalogues
+    are filtered by facet
+    """
+    def setUp(self):
+        self.manu_admin = User.objects.create(username="manu_admin",user_type=User.MANUFACTURER)
+        self.dealer_admin = User.objects.create(username="dealer_admin",user_type=User.DEALERSHIP)
+        self.manufacturer = Manufacturer.objects.create(
+            name="first_manufacturer",country="JP",balance=2000000,admin=self.manu_admin)
+        self.dealership = Dealership.objects.create(
+            name="first_dealership",country="DE",balance=2000000,admin=self.dealer_admin)
+        self.blueprint = Car.objects.create(name="car", price=15000, manufacturer=self.manufacturer)
+
+    def stored(self):
+        return set(FacetCount.objects.filter(cars__gt=0).values_list(
+            "catalogue", "facet", "value", "cars"))
+
+    def assertFacetsMatchStock(self):
+        stored = self.stored()
+        facets.rebuild()
+        self.assertEqual(stored, self.stored())
+
+    def test_facet_counts(self):
+        self.client.force_login(self.manu_admin)
+        self.client.post(reverse("manufacturers:create"), data={"car": self.blueprint.pk, "count": 10})
+        fulfil_orders()
+        self.assertIn(("wholesale", "manufacturer", str(self.manufacturer.pk), 10), self.stored())
+        self.assertIn(("wholesale", "country", "JP", 10), self.stored())
+        self.assertIn(("wholesale", "price", "10000", 10), self.stored())
+        self.assertFacetsMatchStock()
+
+        car = WholesaleCar.objects.get(manufacturer=self.manufacturer)
+        self.client.post(reverse("inventory:wholesale_update", kwargs={"pk": car.pk}),
+            data={"wholesale_price": 32000})
+        self.assertIn(("wholesale", "price", "30000", 10), self.stored())
+        self.assertFacetsMatchStock()
+
+        deals = [WholesaleDeal.objects.create(car=car, asking_price=1000, amount=3,
+                 dealership=self.dealership) for _ in range(2)]
+        settle_wholesale_deal(deals[0].pk)
+        settle_wholesale_deals([deals[1].pk], self.manufacturer.pk)
+        self.assertIn(("retail", "country", "DE", 6), self.stored())
+        self.assertFacetsMatchStock()
+
+        retail_car = RetailCar.objects.get(dealership=self.dealership)
+        deal = RetailDeal.objects.create(car=retail_car, asking_price=2000, amount=2,
+            customer=User.objects.create(username="customer",user_type=User.CUSTOMER,balance=5000))
+        settle_retail_deal(deal.pk)
+        self.client.force_login(self.dealer_admin)
+        assign_perm("change_retailcar", self.dealer_admin, retail_car)
+        self.client.post(reverse("inventory:retail_update", kwargs={"pk": retail_car.pk}),
+            data={"retail_price": 60000})
+        self.assertIn(("retail", "price", "50000", 4), self.stored())
+        self.assertFacetsMatchStock()
+
+        self.client.post(reverse("inventory:retail_delete", kwargs={"pk": retail_car.pk}))
+        self.client.force_login(self.manu_admin)
+        self.client.post(reverse("inventory:wholesale_delete", kwargs={"pk": car.pk}))
+        self.assertEqual(self.stored(), set())
+
+    def test_facet_filters(self):
+        other = Manufacturer.objects.create(name="second_manufacturer", country="US")
+        for i, (manufacturer, price) in enumerate(
+                [(self.manufacturer, 5000), (self.manufacturer, 25000), (other, 25000)]):
+            RetailCar.objects.create(name="car%d" % i, retail_price=price, amount=i + 1,
+                dealership=self.dealership, manufacturer=manufacturer)
+        facets.rebuild()
+        page_cache.get_cache().clear()
+        self.client.force_login(User.objects.create(username="customer",user_type=User.CUSTOMER))
+
+        response = self.client.get(reverse("inventory:dealership_inventory"))
+        self.assertEqual(len(response.context_data["cars"]), 3)
+        self.assertContains(response, "first_manufacturer (3)")
+        self.assertContains(response, "Germany (6)")
+        self.assertContains(response, "$20,000 - $29,999 (5)")
+
+        response = self.client.get(reverse("inventory:dealership_inventory"),
+            data={"manufacturer": self.manufacturer.pk, "price": 20000})
+        self.assertEqual([car.name for car in response.context_data["cars"]], ["car1"])
+        self.assertIsNone(response.context_data["page_obj"].approximate_count)
+        self.assertContains(response, 'href="?price=20000"')
+
+        # Invalid filters are ignored, so this is the unfiltered page again
+        response = self.client.get(reverse("inventory:dealership_inventory"),
+            data={"manufacturer": "x", "price": 123, "country": "??"})
+        self.assertEqual(response["X-Cache"], "HIT")
+        self.assertContains(response, "first_manufacturer (3)")
+
+        self.client.force_login(self.dealer_admin)
+        response = self.client.get(reverse("inventory:manufacturers_inventory"),
+            data={"country": "JP"})
+        self.assertEqual(list(response.context_data["cars"]), [])
+
+
+class CataloguePageCacheTest(TestCase):
+    """
+    Tests to ascertain that the catalogue pages are served from the cache
+    until the cars on them change
+    """
+    def setUp(self):
+        self.manufacturer = Manufacturer.objects.create(name="first_manufacturer",balance=2000000)
+        self.dealership = Dealership.objects.create(name="first_dealership",balance=2000000)
+        self.w_car = WholesaleCar.objects.create(name="car", wholesale_price=2000, amount=5,
+            manufacturer=self.manufacturer)
+        self.r_car = RetailCar.objects.create(name="car", retail_price=2000, amount=3,
+            dealership=self.dealership, manufacturer=self.manufacturer)
+        self.customer = User.objects.create(username="customer",user_type=User.CUSTOMER,
+            balance=10000)
+        page_cache.get_cache().clear()
+        self.client.force_login(self.customer)
+
+    def get(self, **data):
+        return self.client.get(reverse("inventory:dealership_inventory"), data=data)
+
+    def test_hit_and_miss(self):
+        before = page_cache.stats()
+        self.assertEqual(self.get()["X-Cache"], "MISS")
+        # session, user
+        with self.assertNumQueries(2):
+            response = self.get()
+        self.assertEqual(response["X-Cache"], "HIT")
+        self.assertContains(response, "3 available")
+        self.assertEqual(self.get(price=0)["X-Cache"], "MISS")
+
+        after = page_cache.stats()
+        self.assertEqual(after[("retail", "hit")] - before.get(("retail", "hit"), 0), 1)
+        self.assertEqual(after[("retail", "miss")] - before.get(("retail", "miss"), 0), 2)
+
+    def test_invalidation(self):
+        self.get()
+        self.r_car.retail_price = 2500
+        self.r_car.save()
+        response = self.get()
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertContains(response, "$2,500")
+
+        deal = RetailDeal.objects.create(car=self.r_car, asking_price=2000, amount=1,
+            customer=self.customer)
+        settle_retail_deal(deal.pk)
+        response = self.get()
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertContains(response, "2 available")
+
+        self.client.force_login(User.objects.create(username="dealer",user_type=User.DEALERSHIP))
+        self.client.get(reverse("inventory:manufacturers_inventory"))
+        deal = WholesaleDeal.objects.create(car=self.w_car, asking_price=1000, amount=2,
+            dealership=self.dealership)
+        settle_wholesale_deal(deal.pk)
+        response = self.client.get(reverse("inventory:manufacturers_inventory"))
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertContains(response, "3 available")
+
+        self.w_car.delete()
+        response = self.client.get(reverse("inventory:manufacturers_inventory"))
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertNotContains(response, "available")
+
+
+class ConditionalGetTest(TestCase):
+    """
+    Tests to ascertain that catalogue and detail pages are answered with
+    304 Not Modified until the models they show change
+    """
+    def setUp(self):
+        self.dealer_admin = User.objects.create(username="dealer_admin",user_type=User.DEALERSHIP)
+        self.manufacturer = Manufacturer.objects.create(name="first_manufacturer",balance=2000000)
+        self.dealership = Dealership.objects.create(name="first_dealership",balance=2000000,
+            admin=self.dealer_admin)
+        self.r_car = RetailCar.objects.create(name="car", retail_price=2000, amount=3,
+            dealership=self.dealership, manufacturer=self.manufacturer)
+        assign_perm("change_retailcar", self.dealer_admin, self.r_car)
+        self.customer = User.objects.create(username="customer",user_type=User.CUSTOMER,
+            balance=10000)
+        versions.get_cache().clear()
+        self.client.force_login(self.customer)
+
+    def get(self, url=None, etag=None):
+        headers = {"HTTP_IF_NONE_MATCH": etag} if etag else {}
+        return self.client.get(url or reverse("inventory:dealership_inventory"), **headers)
+
+    def test_not_modified(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("no-cache", response["Cache-Control"])
+        etag = response["ETag"]
+        # session, user
+        with self.assertNumQueries(2):
+            response = self.get(etag=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        # The page shows the user's name
+        self.client.force_login(User.objects.create(username="other",user_type=User.CUSTOMER))
+        self.assertEqual(self.get(etag=etag).status_code, 200)
+
+    def test_changes(self):
+        etag = self.get()["ETag"]
+        self.r_car.retail_price = 2500
+        self.r_car.save()
+        response = self.get(etag=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "$2,500")
+
+        etag = response["ETag"]
+        deal = RetailDeal.objects.create(car=self.r_car, asking_price=2000, amount=1,
+            customer=self.customer)
+        settle_retail_deal(deal.pk)
+        response = self.get(etag=etag)
+        self.assertContains(response, "2 available")
+
+        etag = response["ETag"]
+        self.manufacturer.name = "renamed_manufacturer"
+        self.manufacturer.save()
+        self.assertContains(self.get(etag=etag), "renamed_manufacturer")
+
+    def test_last_modified(self):
+        versions.get_cache().set_many({versions._key(model): 10 ** 18 for model in versions.MODELS})
+        response = self.get()
+        self.assertEqual(response["Last-Modified"], "Sun, 09 Sep 2001 01:46:40 GMT")
+        response = self.client.get(reverse("inventory:dealership_inventory"),
+            HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_changes_in_other_processes(self):
+        # A worker renews the stamps in its own process's cache only, and a
+        # queryset update sends no signal; the stamps here expire instead
+        etag = self.get()["ETag"]
+        RetailCar.objects.filter(pk=self.r_car.pk).update(amount=1)
+        self.assertEqual(self.get(etag=etag).status_code, 304)
+        later = time.time() + versions.get_cache().default_timeout + 1
+        with mock.patch("time.time", return_value=later):
+            response = self.get(etag=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "1 available")
+
+    def test_detail_views(self):
+        self.client.force_login(self.dealer_admin)
+        url = reverse("inventory:retail_detail", kwargs={"pk": self.r_car.pk})
+        etag = self.get(url)["ETag"]
+        self.assertEqual(self.get(url, etag).status_code, 304)
+        RetailCar.objects.filter(pk=self.r_car.pk).update(amount=1)
+        self.assertEqual(self.get(url, etag).status_code, 304)
+        versions.touch(RetailCar)
+        self.assertContains(self.get(url, etag), "Total in stock: 1")
+
+        manu_admin = User.objects.create(username="manu_admin",user_type=User.MANUFACTURER)
+        blueprint = Car.objects.create(name="car", price=1000, manufacturer=self.manufacturer)
+        assign_perm("change_car", manu_admin, blueprint)
+        self.client.force_login(manu_admin)
+        url = reverse("blueprints:detail", kwargs={"pk": blueprint.pk})
+        etag = self.get(url)["ETag"]
+        self.assertEqual(self.get(url, etag).status_code, 304)
+        blueprint.price = 1200
+        blueprint.save()
+        self.assertContains(self.get(url, etag), "$1,200")
+
+        # No 304 for another user's car
+        self.assertEqual(self.get(reverse("inventory:retail_detail",
+            kwargs={"pk": self.r_car.pk}), etag).status_code, 403)
+
+
+class InventoryImportTest(TestCase):
+    """
+    Tests to ascertain that inventory files are imported in batches,
+    that invalid rows are reported and skipped, and that the counters and
+    facet counts follow the imported stock
+    """
+    def setUp(self):
+        self.manu_admin = User.objects.create(username="manu_admin",user_type=User.MANUFACTURER)
+        self.dealer_admin = User.objects.create(username="dealer_admin",user_type=User.DEALERSHIP)
+        self.manufacturer = Manufacturer.objects.create(
+            name="first_manufacturer",country="JP",admin=self.manu_admin)
+        self.dealership = Dealership.objects.create(
+            name="first_dealership",country="DE",admin=self.dealer_admin)
+        self.blueprint = Car.objects.create(name="car", price=1000, manufacturer=self.manufacturer)
+
+    def upload(self, name, content, **data):
+        return self.client.post(reverse("inventory:import"), data=dict(
+            file=SimpleUploadedFile(name, content.encode()), **data))
+
+    def assertStockConsistent(self):
+        for model in (Manufacturer, Dealership):
+            self.assertEqual(counters.reconcile(model, fix=False), [])
+        stored = set(FacetCount.objects.filter(cars__gt=0).values_list(
+            "catalogue", "facet", "value", "cars"))
+        facets.rebuild()
+        self.assertEqual(stored, set(FacetCount.objects.filter(cars__gt=0).values_list(
+            "catalogue", "facet", "value", "cars")))
+
+    def test_wholesale_import(self):
+        self.client.force_login(self.manu_admin)
+        content = ("name,price,amount\n"
+                   "car,1500,4\n"
+                   "new_car,25000,2\n"
+                   "blueprint_only,3000,\n"
+                   ",100,1\n"
+                   "bad_price,-5,1\n")
+        response = self.upload("stock.csv", content)
+        report = response.context_data["report"]
+        self.assertEqual((report.rows, report.created, report.updated), (5, 2, 1))
+        self.assertEqual(report.errors, [(4, "name is required"),
+            (5, "price must be a whole number of at least 0")])
+        self.assertContains(response, "Row 5: price must be a whole number of at least 0")
+
+        self.assertEqual(Car.objects.get(pk=self.blueprint.pk).price, 1500)
+        self.assertEqual(Car.objects.filter(manufacturer=self.manufacturer).count(), 3)
+        self.assertEqual(set(WholesaleCar.objects.values_list("name", "wholesale_price", "amount")),
+            {("car", 1500, 4), ("new_car", 25000, 2)})
+        new_car = WholesaleCar.objects.get(name="new_car")
+        self.assertTrue(self.manu_admin.has_perm("change_wholesalecar", new_car))
+        self.assertTrue(self.manu_admin.has_perm("change_car", Car.objects.get(name="new_car")))
+        self.assertStockConsistent()
+
+        # The amounts are set, not added, so the import can be repeated
+        report = self.upload("stock.csv", content).context_data["report"]
+        self.assertEqual((report.created, report.updated), (0, 3))
+        self.assertEqual(WholesaleCar.objects.get(name="car").amount, 4)
+        manufacturer = Manufacturer.objects.get(pk=self.manufacturer.pk)
+        self.assertEqual(manufacturer.cars_in_stock, 6)
+        self.assertEqual(manufacturer.stock_value, 4 * 1500 + 2 * 25000)
+
+    def test_retail_import(self):
+        self.client.force_login(self.dealer_admin)
+        content = ('{"brand": "first_manufacturer", "name": "car", "price": 2000, "amount": 5}\n'
+                   '{"brand": "first_manufacturer", "name": "car", "price": 2000, '
+                   '"cost_price": 1200, "amount": 3}\n'
+                   '{"brand": "unknown", "name": "car", "price": 2000, "amount": 1}\n'
+                   '{"brand": "first_manufacturer", "name": "car", "price": 2.5, "amount": 1}\n'
+                   'not json\n')
+        report = self.upload("stock.jsonl", content).context_data["report"]
+        self.assertEqual((report.rows, report.created, report.error_count), (5, 2, 3))
+        self.assertEqual([number for number, _ in report.errors], [4, 5, 3])
+        self.assertEqual(set(RetailCar.objects.values_list("cost_price", "amount")),
+            {(2000, 5), (1200, 3)})
+        self.assertTrue(self.dealer_admin.has_perm("change_retailcar", RetailCar.objects.first()))
+        self.assertStockConsistent()
+
+        self.upload("stock.jsonl", '{"brand": "first_manufacturer", "name": "car", '
+                    '"price": 2000, "amount": 1}\n')
+        self.assertEqual(Dealership.objects.get(pk=self.dealership.pk).cars_in_stock, 4)
+        self.assertStockConsistent()
+
+    def test_catalogue_import(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "car-models.json")
+        with open(path, "w") as file:
+            file.write('''[
+                {"brand": "first_manufacturer", "models": ["car", "other",
+                    {"name": "stocked", "price": 40000, "amount": 3}]},
+                {"brand": "unknown", "models": ["car"]}
+            ]''')
+        out = StringIO()
+        call_command("import_inventory", path, price=20000, stdout=out)
+        self.assertIn("Row 4: Unknown manufacturer unknown", out.getvalue())
+        self.assertIn("4 rows: 2 created, 1 updated, 1 skipped", out.getvalue())
+        self.assertEqual(set(Car.objects.values_list("name", "price")),
+            {("car", 20000), ("other", 20000), ("stocked", 40000)})
+        self.assertEqual(WholesaleCar.objects.get().amount, 3)
+        self.assertStockConsistent()
+
+        # Without --price the blueprints listed by name only cannot be imported
+        out = StringIO()
+        call_command("import_inventory", path, manufacturer=self.manufacturer.pk, stdout=out)
+        self.assertIn("Row 1: price is required", out.getvalue())
+        self.assertIn("Row 4: brand must be first_manufacturer", out.getvalue())
+
+    def test_invalid_files(self):
+        self.client.force_login(self.manu_admin)
+        response = self.upload("stock.txt", "name,price\n")
+        self.assertFormError(response, "form", "file",
+            "Unsupported file type, expected .csv, .json, .jsonl")
+        response = self.upload("stock.json", '{"name": "car"}')
+        self.assertFormError(response, "form", "file", "A JSON file must hold a list")
+        response = self.upload("stock.json", '[{"name": "car", "price": 5},')
+        self.assertFormError(response, "form", "file", "The JSON list is not closed")
+
+        self.client.force_login(User.objects.create(username="customer",user_type=User.CUSTOMER))
+        response = self.client.get(reverse("inventory:import"))
+        self.assertEqual(response.status_code, 403)
+
+    def test_json_read_in_pieces(self):
+        content = '[{"name": "a", "price": 12345}, {"name": "b\\"]", "price": 1.0e1}]'
+        read_size, imports.READ_SIZE = imports.READ_SIZE, 3
+        try:
+            rows = list(imports.read_rows(StringIO(content), "json"))
+        finally:
+            imports.READ_SIZE = read_size
+        self.assertEqual(rows, [{"name": "a", "price": 12345}, {"name": 'b"]', "price": 10.0}])
+
+
+class StockReservationTest(TestCase):
+    """
+    Tests to ascertain that deals reserve their cars until they are
+    settled, rejected or the reservation expires, and that no deal can
+    take the cars reserved for another
+    """
+    def setUp(self):
+        self.manu_admin = User.objects.create(username="manu_admin",user_type=User.MANUFACTURER)
+        self.dealer_admin = User.objects.create(username="dealer_admin",user_type=User.DEALERSHIP)
+        self.customer = User.objects.create(username="customer",user_type=User.CUSTOMER,
+            balance=100000)
+        self.manufacturer = Manufacturer.objects.create(
+            name="first_manufacturer",balance=0,admin=self.manu_admin)
+        self.dealership = Dealership.objects.create(
+            name="first_dealership",balance=100000,admin=self.dealer_admin)
+        self.w_car = WholesaleCar.objects.create(name="car", cost_price=1000,
+            wholesale_price=2000, amount=5, manufacturer=self.manufacturer)
+        self.r_car = RetailCar.objects.create(name="car", cost_price=2000, retail_price=3000,
+            amount=1, dealership=self.dealership, manufacturer=self.manufacturer)
+
+    def create_wholesale_deal(self, amount):
+        self.client.force_login(self.dealer_admin)
+        return self.client.post(reverse("deals:wholesale_deal_create",
+            kwargs={"pk": self.w_car.pk}), data={
+            "car": self.w_car.pk, "amount": amount, "asking_price": 1000})
+
+    def assertStock(self, car, amount, reserved):
+        car.refresh_from_db()
+        self.assertEqual((car.amount, car.reserved), (amount, reserved))
+
+    def test_deals_reserve_their_cars(self):
+        response = self.create_wholesale_deal(3)
+        self.assertEqual(response.status_code, 302)
+        deal = WholesaleDeal.objects.get()
+        self.assertEqual(WholesaleReservation.objects.get(pk=deal.reservation_id).amount, 3)
+        self.assertStock(self.w_car, 5, 3)
+
+        response = self.client.get(reverse("deals:wholesale_deal_create",
+            kwargs={"pk": self.w_car.pk}))
+        self.assertEqual(response.context_data["form"].fields["amount"].widget.attrs["max"], 2)
+        self.assertContains(self.client.get(reverse("inventory:manufacturers_inventory")),
+            "2 available")
+        response = self.create_wholesale_deal(3)
+        self.assertContains(response, "There are not enough cars available")
+        self.assertEqual(WholesaleDeal.objects.count(), 1)
+        self.assertStock(self.w_car, 5, 3)
+        self.manufacturer.refresh_from_db()
+        self.assertEqual(self.manufacturer.pending_deal_value, 1000)
+
+        self.client.force_login(self.customer)
+        self.client.post(reverse("deals:retail_deal_create", kwargs={"pk": self.r_car.pk}),
+            data={"car": self.r_car.pk, "asking_price": 3000})
+        response = self.client.post(reverse("deals:retail_deal_create",
+            kwargs={"pk": self.r_car.pk}), data={"car": self.r_car.pk, "asking_price": 3000})
+        self.assertContains(response, "There are not enough cars available")
+        self.assertStock(self.r_car, 1, 1)
+
+    def test_settling_and_rejecting_free_the_reservation(self):
+        self.create_wholesale_deal(3)
+        self.create_wholesale_deal(2)
+        first, second = WholesaleDeal.objects.order_by("pk")
+        settle_wholesale_deal(first.pk)
+        self.assertStock(self.w_car, 2, 2)
+        reject_wholesale_deal(second.pk)
+        self.assertStock(self.w_car, 2, 0)
+        self.assertFalse(WholesaleReservation.objects.exists())
+
+        self.client.force_login(self.customer)
+        self.client.post(reverse("deals:retail_deal_create", kwargs={"pk": self.r_car.pk}),
+            data={"car": self.r_car.pk, "asking_price": 3000})
+        settle_retail_deal(RetailDeal.objects.get().pk)
+        self.assertStock(self.r_car, 0, 0)
+
+    def test_reserved_cars_are_not_sold_to_other_deals(self):
+        self.create_wholesale_deal(4)
+        unreserved = WholesaleDeal.objects.create(car=self.w_car, asking_price=1000, amount=2,
+            dealership=self.dealership)
+        with self.assertRaises(InsufficientStock):
+            settle_wholesale_deal(unreserved.pk)
+        result = settle_wholesale_deals([unreserved.pk], self.manufacturer.pk)
+        self.assertIsInstance(result.outcomes[unreserved.pk], InsufficientStock)
+        self.assertStock(self.w_car, 5, 4)
+
+        # Cars added later are available to it
+        WholesaleCar.objects.filter(pk=self.w_car.pk).update(amount=6)
+        settle_wholesale_deal(unreserved.pk)
+        self.assertStock(self.w_car, 4, 4)
+
+    def test_bulk_settlement_and_rejection(self):
+        for amount in (2, 1, 1):
+            self.create_wholesale_deal(amount)
+        unreserved = WholesaleDeal.objects.create(car=self.w_car, asking_price=1000, amount=1,
+            dealership=self.dealership)
+        first, second, third = WholesaleDeal.objects.exclude(pk=unreserved.pk).order_by("pk")
+
+        result = settle_wholesale_deals([first.pk, second.pk, unreserved.pk], self.manufacturer.pk)
+        self.assertEqual(result.succeeded, [first.pk, second.pk, unreserved.pk])
+        self.assertStock(self.w_car, 1, 1)
+        result = reject_wholesale_deals([third.pk], self.manufacturer.pk)
+        self.assertEqual(result.succeeded, [third.pk])
+        self.assertStock(self.w_car, 1, 0)
+        self.assertFalse(WholesaleReservation.objects.exists())
+
+    def test_expired_reservations_are_released(self):
+        self.create_wholesale_deal(3)
+        deal = WholesaleDeal.objects.get()
+        WholesaleReservation.objects.update(expires_at=timezone.now())
+
+        out = StringIO()
+        call_command("release_reservations", once=True, stdout=out)
+        self.assertIn("Released 1 wholesale car reservations", out.getvalue())
+        self.assertStock(self.w_car, 5, 0)
+
+        # The deal stays pending and takes available cars when settled
+        self.assertEqual(WholesaleDeal.objects.get().status, WholesaleDeal.PENDING)
+        self.create_wholesale_deal(2)
+        settle_wholesale_deal(deal.pk)
+        self.assertStock(self.w_car, 2, 2)
+
+    def test_expired_reservations_make_room_at_once(self):
+        self.create_wholesale_deal(5)
+        WholesaleReservation.objects.update(expires_at=timezone.now())
+        self.assertEqual(self.create_wholesale_deal(4).status_code, 302)
+        self.assertStock(self.w_car, 5, 4)
+        self.assertEqual(WholesaleReservation.objects.count(), 1)
+
+    def test_expired_reservations_are_locked_before_the_car(self):
+        reservations.reserve(WholesaleCar, self.w_car.pk, 5)
+        WholesaleReservation.objects.update(expires_at=timezone.now())
+        with CaptureQueriesContext(connection) as queries:
+            reservations.reserve(WholesaleCar, self.w_car.pk, 4)
+        statements = [query["sql"] for query in queries.captured_queries]
+        locked = next(index for index, sql in enumerate(statements)
+                      if sql.startswith("SELECT") and "inventory_wholesalereservation" in sql)
+        updated = next(index for index, sql in enumerate(statements)
+                       if sql.startswith("UPDATE") and "inventory_wholesalecar" in sql)
+        self.assertLess(locked, updated)
+        self.assertStock(self.w_car, 5, 4)
+
+    def test_reserved_cars_stay_in_stock(self):
+        reservations.reserve(WholesaleCar, self.w_car.pk, 3)
+        with self.assertRaises(reservations.NotAvailable):
+            reservations.reserve(WholesaleCar, self.w_car.pk, 3)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            WholesaleCar.objects.filter(pk=self.w_car.pk).update(amount=2)
+
+        # Imports do not go below the reserved cars
+        counters.reconcile(Manufacturer)
+        imports._set_stock(FacetCount.WHOLESALE, {
+            (self.manufacturer.pk, "car", 1000, 2000): 1}, {self.manufacturer.pk: self.manufacturer})
+        self.assertStock(self.w_car, 3, 3)
+        self.assertEqual(counters.reconcile(Manufacturer, fix=False), [])
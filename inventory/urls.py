@@ -1,7 +1,7 @@
 from django.urls import path
 from .views import (WholesaleCarDetailView, CarListView, WholesaleCarUpdateView, 
 WholesaleCarDeleteView, AllWholesaleCarListView, RetailCarDetailView, RetailCarUpdateView,
-RetailCarDeleteView, AllRetailCarListView )
+RetailCarDeleteView, AllRetailCarListView, RetailCarSearchView, InventoryImportView )
 
 app_name = "inventory"
 urlpatterns = [
@@ -10,8 +10,10 @@ urlpatterns = [
     path('wholesale-<pk>/', WholesaleCarDetailView.as_view(), name='wholesale_detail'),
     path('wholesale-<pk>/update/', WholesaleCarUpdateView.as_view(), name='wholesale_update'),
     path('wholesale-<pk>/delete/', WholesaleCarDeleteView.as_view(), name='wholesale_delete'),
+    path('import/', InventoryImportView.as_view(), name='import'),
     path('retail-<pk>/', RetailCarDetailView.as_view(), name='retail_detail'),
     path('retail-<pk>/update/', RetailCarUpdateView.as_view(), name='retail_update'),
     path('retail-<pk>/delete/', RetailCarDeleteView.as_view(), name='retail_delete'),
     path('dealerships/', AllRetailCarListView.as_view(), name='dealership_inventory'),
+    path('dealerships/search/', RetailCarSearchView.as_view(), name='retail_search'),
 ]
\ No newline at end of file
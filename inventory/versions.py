@@ -0,0 +1,141 @@
+"""
+Version stamps of the models shown in the catalogue and detail pages.
+
+Every model in MODELS has a stamp in the "catalogue" cache: the time of its
+last change, in nanoseconds. A stamp is renewed when an instance of the
+model is saved or deleted (post_save / post_delete) and by touch(), called
+by the code paths that change rows with UPDATE statements instead: deal
+settlement, manufacturing order fulfilment, imports and bulk seeding (all
+through inventory.page_cache.invalidate()).
+
+The stamps key the cached catalogue pages (inventory.page_cache) and make
+the ETag and Last-Modified headers of the views using ConditionalGetMixin,
+so that a browser asking for a page again gets a 304 Not Modified response
+unless one of the models the page shows has changed since.
+
+Stamps expire with the cache's TIMEOUT and start again from the clock. A
+change made by another process (a worker, a management command or another
+server process) renews the stamps in the cache that process uses. Unless
+the "catalogue" cache is shared (see settings.py), those stamps are not
+the ones a server process reads, and the server notices the change when
+its own stamps expire.
+"""
+
+import hashlib
+import time
+
+from django.contrib.messages import get_messages
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+from blueprints.models import Car
+from dealerships.models import Dealership
+from manufacturers.models import Manufacturer
+
+from .models import RetailCar, WholesaleCar
+
+
+CACHE_ALIAS = "catalogue"
+
+MODELS = (WholesaleCar, RetailCar, Car, Manufacturer, Dealership)
+
+
+def get_cache():
+    return caches[CACHE_ALIAS]
+
+
+def _key(model):
+    return "model-version:%s" % model._meta.label_lower
+
+
+def version(model):
+    """ Returns the version stamp of a model. """
+
+    cache = get_cache()
+    key = _key(model)
+    current = cache.get(key)
+    if current is None:
+        # An evicted stamp starts again from the clock, so pages cached
+        # under it are never served again
+        cache.add(key, time.time_ns())
+        current = cache.get(key)
+    return current
+
+
+def versions(*models):
+    """ Returns the version stamps of models, in order, with one cache lookup. """
+
+    keys = [_key(model) for model in models]
+    found = get_cache().get_many(keys)
+    return [found[key] if key in found else version(model) for key, model in zip(keys, models)]
+
+
+def touch(*models):
+    """
+    Renews the version stamps of models.
+
+    Inside a transaction they are renewed again once it commits, so pages
+    another request rendered from the uncommitted rows' old values in the
+    meantime are not served either.
+    """
+
+    stamp = time.time_ns()
+    get_cache().set_many({_key(model): stamp for model in models})
+
+    connection = transaction.get_connection()
+    if connection.in_atomic_block:
+        transaction.on_commit(lambda: touch(*models))
+
+
+def model_changed(sender, **kwargs):
+    touch(sender)
+
+
+def connect_signals():
+    for model in MODELS:
+        post_save.connect(model_changed, sender=model, dispatch_uid="versions_save")
+        post_delete.connect(model_changed, sender=model, dispatch_uid="versions_delete")
+
+
+class ConditionalGetMixin:
+    """
+    View mixin answering GET requests with 304 Not Modified when none of
+    version_models changed since the client's copy of the page.
+
+    The ETag covers the version stamps, the URL and the user (the page
+    shows their name), and Last-Modified is the latest stamp. Responses are
+    marked private and no-cache, so browsers keep them but ask again every
+    time. Pages with messages waiting to be shown are always rendered.
+
+    Put it after the permission mixins, so that the permissions are checked
+    before the response is.
+    """
+
+    version_models = ()
+
+    def get_etag(self, stamps):
+        user = self.request.user.get_username() if self.request.user.is_authenticated else ""
+        parts = [self.request.get_full_path(), user] + [str(stamp) for stamp in stamps]
+        return quote_etag(hashlib.md5("\n".join(parts).encode()).hexdigest())
+
+    def get(self, request, *args, **kwargs):
+        stamps = versions(*self.version_models)
+        etag = self.get_etag(stamps)
+        last_modified = max(stamps) // 10 ** 9
+        # A change later in the same second would have the same Last-Modified
+        if last_modified >= int(time.time()):
+            last_modified = None
+
+        response = None
+        if not get_messages(request):
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        response["ETag"] = etag
+        if last_modified is not None:
+            response["Last-Modified"] = http_date(last_modified)
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
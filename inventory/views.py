@@ -1,19 +1,29 @@
+from django import forms
 from django.core.exceptions import PermissionDenied
+from django.db import transaction
+from django.http import Http404
 from django.shortcuts import render
 from django.urls import reverse_lazy
-from django.views.generic import DeleteView, DetailView, ListView, UpdateView
-from guardian.mixins import PermissionRequiredMixin
+from django.utils.decorators import method_decorator
+from django.views.generic import DeleteView, DetailView, FormView, ListView, UpdateView
 from guardian.shortcuts import assign_perm
 
-from users.permissions import (UserIsCustomer, UserIsDealership,
-                               UserIsManufacturer, UserIsNotCustomer)
+from users.affiliation import affiliation_id
+from users.permissions import (CachedPermissionRequiredMixin, UserIsCustomer,
+                               UserIsDealership, UserIsManufacturer,
+                               UserIsNotCustomer)
 
-from .models import RetailCar, WholesaleCar
+from . import counters, facets, imports, page_cache, search
+from .facets import FacetFilterMixin
+from .models import FacetCount, RetailCar, WholesaleCar
+from .page_cache import CachedCatalogueMixin
+from .pagination import KeysetPage, KeysetPaginationMixin, decode_cursor, encode_cursor
+from .versions import ConditionalGetMixin
 
 # Create your views here.
 
 
-class WholesaleCarDetailView(PermissionRequiredMixin, DetailView):
+class WholesaleCarDetailView(CachedPermissionRequiredMixin, DetailView):
     """ Detail view for Wholesale cars"""
 
     model = WholesaleCar
@@ -41,16 +51,42 @@ class CarListView(UserIsNotCustomer, ListView):
 
         if user_type == User.MANUFACTURER:
             self.template_name = "inventory/manufacturers/inventory_list.html"
-            return WholesaleCar.objects.filter(manufacturer__admin=self.request.user, amount__gt=0)
+            return WholesaleCar.objects.owned_by(affiliation_id(self.request)).for_catalogue()
         elif user_type == User.DEALERSHIP:
             self.template_name = "inventory/dealerships/inventory_list.html"
-            return RetailCar.objects.filter(dealership__admin=self.request.user, amount__gt=0)
+            return RetailCar.objects.owned_by(affiliation_id(self.request)).for_catalogue()
 
+    def get_context_data(self, **kwargs):
+        """ Adds the manufacturer or dealership, whose stock counters are shown as totals. """
 
-class WholesaleCarUpdateView(PermissionRequiredMixin, UpdateView):
+        context = super().get_context_data(**kwargs)
+        context["affiliation"] = self.request.affiliation
+        return context
+
+
+class FacetPriceUpdateMixin:
+    """
+    Moves the cars of an UpdateView's object between price bands in the
+    facet counts when its price field changes.
+    """
+
+    facet_catalogue = None
+
+    def form_valid(self, form):
+        field = facets.SOURCES[self.facet_catalogue][1]
+        old_price, car = form.initial[field], self.object
+        if facets.price_band(old_price) != facets.price_band(getattr(car, field)):
+            facets.add(facets.entry(self.facet_catalogue, car, -car.amount, price=old_price),
+                       facets.entry(self.facet_catalogue, car, car.amount))
+        return super().form_valid(form)
+
+
+@method_decorator(transaction.atomic, name="form_valid")
+class WholesaleCarUpdateView(CachedPermissionRequiredMixin, FacetPriceUpdateMixin, UpdateView):
     """ Update view for wholesale car. """
 
     model = WholesaleCar
+    facet_catalogue = FacetCount.WHOLESALE
     template_name = "inventory/manufacturers/wholesale_car_update.html"
     context_object_name = "car"
     fields = ("wholesale_price",)
@@ -59,7 +95,8 @@ class WholesaleCarUpdateView(PermissionRequiredMixin, UpdateView):
     raise_exception = True
 
 
-class WholesaleCarDeleteView(PermissionRequiredMixin, DeleteView):
+@method_decorator(transaction.atomic, name="form_valid")
+class WholesaleCarDeleteView(CachedPermissionRequiredMixin, DeleteView):
     """ Delete view for wholesale car. """
 
     model = WholesaleCar
@@ -70,33 +107,97 @@ class WholesaleCarDeleteView(PermissionRequiredMixin, DeleteView):
     permission_required = "change_wholesalecar"
     raise_exception = True
 
+    def form_valid(self, form):
+        counters.remove_car(self.object)
+        facets.add(facets.entry(FacetCount.WHOLESALE, self.object, -self.object.amount))
+        return super().form_valid(form)
+
 
-class AllWholesaleCarListView(UserIsDealership, ListView):
-    """ List view to list all cars by all manufacturers """
+class AllWholesaleCarListView(UserIsDealership, ConditionalGetMixin, CachedCatalogueMixin,
+                              FacetFilterMixin, KeysetPaginationMixin, ListView):
+    """
+    List view to list all cars by all manufacturers, filtered by
+    manufacturer, country and price band.
+    """
 
     template_name = "inventory/dealerships/wholesale_car_list.html"
+    fragment_template_name = "inventory/dealerships/wholesale_cars.html"
     context_object_name = "cars"
     paginate_by = 52
+    approximate_count = True
+    facet_catalogue = FacetCount.WHOLESALE
+    version_models = page_cache.MODELS[FacetCount.WHOLESALE]
 
     def get_queryset(self):
-        return WholesaleCar.objects.filter(amount__gt=0)
+        return self.filter_by_facets(WholesaleCar.objects.for_catalogue())
 
 
-class AllRetailCarListView(UserIsCustomer, ListView):
-    """ List view showing all cars owned by all dealerships. """
+class AllRetailCarListView(UserIsCustomer, ConditionalGetMixin, CachedCatalogueMixin,
+                           FacetFilterMixin, KeysetPaginationMixin, ListView):
+    """
+    List view showing all cars owned by all dealerships, filtered by
+    manufacturer, dealership country and price band.
+    """
 
     template_name = "inventory/customers/retail_car_list.html"
+    fragment_template_name = "inventory/customers/retail_cars.html"
     context_object_name = "cars"
     paginate_by = 52
+    approximate_count = True
+    facet_catalogue = FacetCount.RETAIL
+    version_models = page_cache.MODELS[FacetCount.RETAIL]
 
     def get_queryset(self):
-        return RetailCar.objects.filter(amount__gt=0)
+        return self.filter_by_facets(RetailCar.objects.for_catalogue())
 
 
-class RetailCarDetailView(PermissionRequiredMixin, DetailView):
+class RetailCarSearchView(UserIsCustomer, ListView):
+    """
+    Ranked search over all retail cars in stock by car name, manufacturer
+    name and dealership country (?q=).
+
+    Results are paged with the same opaque ?after= cursor as the catalogue,
+    holding the offset into the ranking.
+    """
+
+    template_name = "inventory/customers/retail_car_list.html"
+    context_object_name = "cars"
+    paginate_by = 52
+
+    def get_queryset(self):
+        return RetailCar.objects.none()
+
+    def paginate_queryset(self, queryset, page_size):
+        cursor = self.request.GET.get("after") or None
+        offset = 0
+        if cursor is not None:
+            try:
+                offset, = decode_cursor(cursor, 1)
+            except ValueError:
+                raise Http404("Invalid cursor")
+            if not isinstance(offset, int) or offset < 0:
+                raise Http404("Invalid cursor")
+
+        object_list = search.search(self.request.GET.get("q", ""), page_size + 1, offset)
+        next_cursor = None
+        if len(object_list) > page_size:
+            object_list = object_list[:page_size]
+            next_cursor = encode_cursor([offset + page_size])
+
+        page = KeysetPage(object_list, cursor, next_cursor)
+        return (None, page, object_list, page.has_other_pages())
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["query"] = self.request.GET.get("q", "")
+        return context
+
+
+class RetailCarDetailView(CachedPermissionRequiredMixin, ConditionalGetMixin, DetailView):
     """ Detail view for retail cars. """
 
     model = RetailCar
+    version_models = (RetailCar,)
     template_name = "inventory/dealerships/retail_car_detail.html"
     context_object_name = "car"
 
@@ -104,10 +205,12 @@ class RetailCarDetailView(PermissionRequiredMixin, DetailView):
     raise_exception = True
 
 
-class RetailCarUpdateView(PermissionRequiredMixin, UpdateView):
+@method_decorator(transaction.atomic, name="form_valid")
+class RetailCarUpdateView(CachedPermissionRequiredMixin, FacetPriceUpdateMixin, UpdateView):
     """ Update view for retail cars. """
 
     model = RetailCar
+    facet_catalogue = FacetCount.RETAIL
     template_name = "inventory/dealerships/retail_car_update.html"
     context_object_name = "car"
     fields = ("retail_price",)
@@ -116,7 +219,8 @@ class RetailCarUpdateView(PermissionRequiredMixin, UpdateView):
     raise_exception = True
 
 
-class RetailCarDeleteView(PermissionRequiredMixin, DeleteView):
+@method_decorator(transaction.atomic, name="form_valid")
+class RetailCarDeleteView(CachedPermissionRequiredMixin, DeleteView):
     """ Delete view for retail cars. """
     
     model = RetailCar
@@ -126,3 +230,58 @@ class RetailCarDeleteView(PermissionRequiredMixin, DeleteView):
 
     permission_required = "change_retailcar"
     raise_exception = True
+
+    def form_valid(self, form):
+        counters.remove_car(self.object)
+        facets.add(facets.entry(FacetCount.RETAIL, self.object, -self.object.amount))
+        return super().form_valid(form)
+
+
+class InventoryImportForm(forms.Form):
+    """ Form for uploading an inventory file to InventoryImportView. """
+
+    file = forms.FileField(help_text="CSV, JSON or JSON Lines (.csv, .json, .jsonl)")
+    default_price = forms.IntegerField(
+        required=False, min_value=0,
+        help_text="Price of blueprints listed without one (manufacturers only)")
+
+    def clean_file(self):
+        file = self.cleaned_data["file"]
+        try:
+            self.format = imports.detect_format(file.name)
+        except imports.ImportFileError as error:
+            raise forms.ValidationError(str(error))
+        return file
+
+
+class InventoryImportView(UserIsNotCustomer, FormView):
+    """
+    Imports an uploaded file into the inventory of the user's manufacturer
+    (blueprints and wholesale cars) or dealership (retail cars), and shows
+    the import report.
+
+    The file is imported in batches, each in its own transaction, so rows
+    before a file error stay imported; see inventory.imports.
+    """
+
+    form_class = InventoryImportForm
+    template_name = "inventory/import.html"
+
+    def get_importer(self, form):
+        from users.models import User
+        affiliation = self.request.affiliation
+        if not affiliation:
+            raise PermissionDenied
+        if self.request.user.user_type == User.MANUFACTURER:
+            return imports.WholesaleImport(affiliation, form.cleaned_data["default_price"])
+        return imports.RetailImport(affiliation)
+
+    def form_valid(self, form):
+        importer = self.get_importer(form)
+        try:
+            report = imports.run(importer, form.cleaned_data["file"], form.format)
+        except imports.ImportFileError as error:
+            form.add_error("file", str(error))
+            return self.form_invalid(form)
+        return self.render_to_response(self.get_context_data(form=self.form_class(),
+                                                             report=report))
@@ -0,0 +1,5 @@
+from django.contrib import admin
+from .models import Entry, Snapshot
+# Register your models here.
+admin.site.register(Entry)
+admin.site.register(Snapshot)
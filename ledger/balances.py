@@ -0,0 +1,167 @@
+"""
+Ledger of balance movements.
+
+Every change to the balance of a User, Manufacturer or Dealership is also
+appended to the ledger as an Entry, in the same transaction as the UPDATE
+that changes the balance; see users.views, deals.settlement and
+manufacturers.fulfilment. Entries are only ever inserted, so recording one
+does not contend with other movements.
+
+An account's ledger balance is its latest Snapshot plus the entries
+recorded after it. Snapshots are taken periodically so the sums stay short:
+
+    python manage.py snapshot_balances
+
+The stored balance is still what deals and orders check and debit, and
+movements made elsewhere, e.g. in the admin site, bypass the ledger.
+
+    python manage.py check_ledger
+
+compares the two and, with --adjust, records the difference as an
+adjustment entry.
+
+Entries must be recorded after the balance UPDATE of their account, so
+that the account row is locked when the entry is numbered; snapshots lock
+the account rows and so never skip an entry that commits later.
+"""
+
+from django.db import transaction
+from django.db.models import BigIntegerField, F, Max, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from dealerships.models import Dealership
+from manufacturers.models import Manufacturer
+from users.models import User
+
+from .models import Entry, Snapshot
+
+
+ACCOUNTS = {
+    User: Entry.USER,
+    Manufacturer: Entry.MANUFACTURER,
+    Dealership: Entry.DEALERSHIP,
+}
+
+
+def entry(model, pk, amount, kind, reference=None):
+    """
+    Returns an unsaved entry moving amount (negative when money leaves) into
+    the account of a User, Manufacturer or Dealership.
+    """
+
+    return Entry(account_type=ACCOUNTS[model], account_id=pk, amount=amount, kind=kind,
+                 reference=reference)
+
+
+def record(*entries):
+    """ Appends entries to the ledger with one INSERT, skipping empty ones. """
+
+    entries = [entry for entry in entries if entry.amount and entry.account_id is not None]
+    if entries:
+        Entry.objects.bulk_create(entries)
+
+
+def _subquery(queryset, expression):
+    return Coalesce(Subquery(
+        queryset.values("account_id").annotate(total=expression).values("total")[:1]),
+        Value(0), output_field=BigIntegerField())
+
+
+def with_ledger_balance(model):
+    """
+    Returns the users, manufacturers or dealerships annotated with their
+    ledger_balance and the last_entry_id it includes.
+    """
+
+    account_type = ACCOUNTS[model]
+    snapshots = Snapshot.objects.filter(account_type=account_type, account_id=OuterRef("pk"))
+    accounts = model.objects.annotate(
+        snapshot_balance=Coalesce(Subquery(snapshots.values("balance")[:1]), Value(0),
+                                  output_field=BigIntegerField()),
+        snapshot_entry_id=Coalesce(Subquery(snapshots.values("entry_id")[:1]), Value(0),
+                                   output_field=BigIntegerField()),
+    )
+    entries = Entry.objects.filter(account_type=account_type, account_id=OuterRef("pk"),
+                                   id__gt=OuterRef("snapshot_entry_id"))
+    return accounts.annotate(
+        ledger_delta=_subquery(entries, Sum("amount")),
+        last_entry_id=_subquery(entries, Max("id")),
+    ).annotate(ledger_balance=F("snapshot_balance") + F("ledger_delta"))
+
+
+def balance(obj):
+    """ Returns the ledger balance of a user, manufacturer or dealership. """
+
+    return with_ledger_balance(type(obj)).values_list(
+        "ledger_balance", flat=True).get(pk=obj.pk)
+
+
+def _batches(queryset, batch_size):
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk).order_by("pk")[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        yield batch
+
+
+def snapshot(model, batch_size=1000):
+    """
+    Folds the entries recorded since the last snapshot of every user,
+    manufacturer or dealership into a new snapshot, one batch of accounts
+    per transaction.
+
+    Returns the number of snapshots taken.
+    """
+
+    account_type = ACCOUNTS[model]
+    taken = 0
+    last_pk = 0
+    while True:
+        with transaction.atomic():
+            # Lock first and sum afterwards, so that movements committed
+            # while waiting for the locks are included
+            pks = list(model.objects.select_for_update().filter(pk__gt=last_pk).order_by(
+                "pk").values_list("pk", flat=True)[:batch_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+            batch = with_ledger_balance(model).filter(pk__in=pks)
+
+            changed = [account for account in batch if account.last_entry_id]
+            Snapshot.objects.filter(account_type=account_type, account_id__in=[
+                account.pk for account in changed]).delete()
+            Snapshot.objects.bulk_create([
+                Snapshot(account_type=account_type, account_id=account.pk,
+                         balance=account.ledger_balance,
+                         entry_id=account.last_entry_id)
+                for account in changed
+            ])
+            taken += len(changed)
+    return taken
+
+
+def check(model, adjust=False, batch_size=1000):
+    """
+    Compares the stored balance of every user, manufacturer or dealership
+    with its ledger balance, in batches.
+
+    With adjust, the difference is recorded as an adjustment entry; the
+    stored balance is left alone.
+
+    Returns a list of (obj, stored, ledger) for every account that differs.
+    """
+
+    drift = []
+    for batch in _batches(with_ledger_balance(model), batch_size):
+        adjustments = []
+        for account in batch:
+            if account.balance != account.ledger_balance:
+                drift.append((account, account.balance, account.ledger_balance))
+                adjustments.append(entry(model, account.pk,
+                                         account.balance - account.ledger_balance,
+                                         Entry.ADJUSTMENT))
+        if adjust:
+            record(*adjustments)
+    return drift
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from ledger import balances
+
+
+class Command(BaseCommand):
+    """
+    Compares the stored balance of every user, manufacturer and dealership
+    with its ledger balance and reports the accounts that differ.
+    """
+
+    help = "Check the stored balances against the ledger."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--adjust", action="store_true",
+                            help="Record the differences as adjustment entries.")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        for model in balances.ACCOUNTS:
+            drift = balances.check(
+                model, adjust=options["adjust"], batch_size=options["batch_size"])
+            for obj, stored, ledger in drift:
+                self.stdout.write("%s %d (%s): balance is %d, ledger says %d" % (
+                    model._meta.label, obj.pk, obj, stored, ledger))
+            verb = "adjusted" if options["adjust"] else "found"
+            self.stdout.write("%s: %d rows checked, %d differences %s" % (
+                model._meta.label, model.objects.count(), len(drift), verb))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from ledger import balances
+
+
+class Command(BaseCommand):
+    """
+    Folds the ledger entries recorded since the last snapshot of each
+    account into a new snapshot. Run it periodically, e.g. hourly from cron.
+    """
+
+    help = "Snapshot the ledger balance of every account."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        for model in balances.ACCOUNTS:
+            taken = balances.snapshot(model, batch_size=options["batch_size"])
+            self.stdout.write("%s: %d snapshots taken" % (model._meta.label, taken))
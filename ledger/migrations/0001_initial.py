@@ -0,0 +1,48 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Entry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account_type', models.CharField(choices=[('US', 'USER'), ('MA', 'MANUFACTURER'), ('DE', 'DEALERSHIP')], max_length=2)),
+                ('account_id', models.PositiveIntegerField()),
+                ('amount', models.BigIntegerField()),
+                ('kind', models.CharField(choices=[('OP', 'OPENING BALANCE'), ('TU', 'TOP UP'), ('WD', 'WHOLESALE DEAL'), ('RD', 'RETAIL DEAL'), ('MO', 'MANUFACTURING ORDER'), ('RF', 'REFUND'), ('AD', 'ADJUSTMENT')], max_length=2)),
+                ('reference', models.PositiveIntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name_plural': 'entries',
+            },
+        ),
+        migrations.CreateModel(
+            name='Snapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account_type', models.CharField(choices=[('US', 'USER'), ('MA', 'MANUFACTURER'), ('DE', 'DEALERSHIP')], max_length=2)),
+                ('account_id', models.PositiveIntegerField()),
+                ('balance', models.BigIntegerField(default=0)),
+                ('entry_id', models.BigIntegerField(default=0)),
+                ('taken_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='snapshot',
+            constraint=models.UniqueConstraint(fields=('account_type', 'account_id'), name='unique_snapshot_account'),
+        ),
+        migrations.AddIndex(
+            model_name='entry',
+            index=models.Index(fields=['account_type', 'account_id', 'id'], name='ledger_entry_account_idx'),
+        ),
+    ]
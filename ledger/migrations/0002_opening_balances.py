@@ -0,0 +1,39 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:20
+
+from django.db import migrations
+
+
+# (app label, model, account type)
+ACCOUNTS = (
+    ('users', 'User', 'US'),
+    ('manufacturers', 'Manufacturer', 'MA'),
+    ('dealerships', 'Dealership', 'DE'),
+)
+
+
+def opening_balances(apps, schema_editor):
+    """ Records the balances held before the ledger existed as opening entries. """
+
+    Entry = apps.get_model('ledger', 'Entry')
+    using = schema_editor.connection.alias
+    for app_label, model_name, account_type in ACCOUNTS:
+        accounts = apps.get_model(app_label, model_name).objects.using(using).exclude(
+            balance=0).values_list('pk', 'balance').order_by('pk')
+        Entry.objects.using(using).bulk_create([
+            Entry(account_type=account_type, account_id=pk, amount=balance, kind='OP')
+            for pk, balance in accounts.iterator()
+        ], batch_size=5000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ledger', '0001_initial'),
+        ('users', '0006_auto_20200502_0406'),
+        ('manufacturers', '0011_manufacturingorder_queue'),
+        ('dealerships', '0005_stock_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(opening_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,79 @@
+from django.db import models
+
+
+# Create your models here.
+class Entry(models.Model):
+    """
+    Model definition for a ledger entry: one balance movement of one
+    account, positive for money coming in. Entries are never updated or
+    deleted.
+    """
+
+    USER = "US"
+    MANUFACTURER = "MA"
+    DEALERSHIP = "DE"
+    ACCOUNTS = (
+        (USER, "USER"),
+        (MANUFACTURER, "MANUFACTURER"),
+        (DEALERSHIP, "DEALERSHIP"),
+    )
+
+    OPENING = "OP"
+    TOP_UP = "TU"
+    WHOLESALE_DEAL = "WD"
+    RETAIL_DEAL = "RD"
+    MANUFACTURING_ORDER = "MO"
+    REFUND = "RF"
+    ADJUSTMENT = "AD"
+    KINDS = (
+        (OPENING, "OPENING BALANCE"),
+        (TOP_UP, "TOP UP"),
+        (WHOLESALE_DEAL, "WHOLESALE DEAL"),
+        (RETAIL_DEAL, "RETAIL DEAL"),
+        (MANUFACTURING_ORDER, "MANUFACTURING ORDER"),
+        (REFUND, "REFUND"),
+        (ADJUSTMENT, "ADJUSTMENT"),
+    )
+
+    account_type = models.CharField(max_length=2, choices=ACCOUNTS)
+    account_id = models.PositiveIntegerField()
+    amount = models.BigIntegerField()
+    kind = models.CharField(max_length=2, choices=KINDS)
+    # pk of the deal or manufacturing order, if any
+    reference = models.PositiveIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name_plural = "entries"
+        indexes = [
+            # Sums of an account's entries after its snapshot
+            models.Index(fields=["account_type", "account_id", "id"],
+                         name="ledger_entry_account_idx"),
+        ]
+
+    def __str__(self):
+        return "%s %d: %+d (%s)" % (
+            self.get_account_type_display(), self.account_id, self.amount,
+            self.get_kind_display())
+
+
+class Snapshot(models.Model):
+    """
+    Model definition for a balance snapshot: the sum of an account's
+    entries up to and including entry_id.
+    """
+
+    account_type = models.CharField(max_length=2, choices=Entry.ACCOUNTS)
+    account_id = models.PositiveIntegerField()
+    balance = models.BigIntegerField(default=0)
+    entry_id = models.BigIntegerField(default=0)
+    taken_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["account_type", "account_id"],
+                                    name="unique_snapshot_account"),
+        ]
+
+    def __str__(self):
+        return "%s %d: %d" % (self.get_account_type_display(), self.account_id, self.balance)
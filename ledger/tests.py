@@ -0,0 +1,104 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.urls import reverse
+
+from blueprints.models import Car
+from dealerships.models import Dealership
+from deals.models import RetailDeal, WholesaleDeal
+from deals.settlement import settle_retail_deal, settle_wholesale_deals
+from inventory.models import RetailCar, WholesaleCar
+from manufacturers import fulfilment
+from manufacturers.models import Manufacturer
+from users.models import User
+
+from . import balances
+from .models import Entry, Snapshot
+
+# Create your tests here.
+
+
+class LedgerTest(TestCase):
+    """
+    Tests to ascertain that every balance movement is recorded in the
+    ledger, and that snapshots and the consistency check agree with it
+    """
+    def setUp(self):
+        self.manu_admin = User.objects.create(username="manu_admin",user_type=User.MANUFACTURER)
+        self.dealer_admin = User.objects.create(username="dealer_admin",user_type=User.DEALERSHIP)
+        self.customer = User.objects.create(username="customer",user_type=User.CUSTOMER,
+            balance=50000)
+        self.manufacturer = Manufacturer.objects.create(
+            name="first_manufacturer",balance=2000000,admin=self.manu_admin)
+        self.dealership = Dealership.objects.create(
+            name="first_dealership",balance=2000000,admin=self.dealer_admin)
+        self.blueprint = Car.objects.create(name="car", price=1000, manufacturer=self.manufacturer)
+        # Opening balances
+        for model in balances.ACCOUNTS:
+            balances.check(model, adjust=True)
+
+    def assertLedgerMatches(self):
+        for model in balances.ACCOUNTS:
+            self.assertEqual(balances.check(model), [])
+
+    def test_movements_are_recorded(self):
+        self.client.force_login(self.dealer_admin)
+        self.client.post(reverse("user:add_balance"), data={"balance": 500})
+        self.assertEqual(balances.balance(self.dealership), 2000500)
+
+        order = fulfilment.place_order(self.blueprint, 10)
+        fulfilment.fulfil_orders()
+        car = WholesaleCar.objects.get()
+        deals = [WholesaleDeal.objects.create(car=car, asking_price=3000, amount=2,
+            dealership=self.dealership) for _ in range(2)]
+        settle_wholesale_deals([deal.pk for deal in deals], self.manufacturer.pk)
+        retail_car = RetailCar.objects.get()
+        deal = RetailDeal.objects.create(car=retail_car, asking_price=2500, amount=1,
+            customer=self.customer)
+        settle_retail_deal(deal.pk)
+
+        self.assertLedgerMatches()
+        self.assertEqual(list(Entry.objects.filter(
+            account_type=Entry.MANUFACTURER).exclude(kind=Entry.ADJUSTMENT).values_list(
+            "kind", "amount", "reference")), [
+            (Entry.MANUFACTURING_ORDER, -10000, order.pk),
+            (Entry.WHOLESALE_DEAL, 3000, deals[0].pk),
+            (Entry.WHOLESALE_DEAL, 3000, deals[1].pk),
+        ])
+        self.assertEqual(balances.balance(self.customer), 47500)
+
+    def test_refund_is_recorded(self):
+        fulfilment.place_order(self.blueprint, 10)
+        self.blueprint.delete()
+        fulfilment.fulfil_orders()
+        self.assertLedgerMatches()
+        self.assertEqual(Entry.objects.filter(kind=Entry.REFUND).get().amount, 10000)
+
+    def test_snapshot(self):
+        self.assertEqual(balances.snapshot(Manufacturer), 1)
+        snapshot = Snapshot.objects.get(account_type=Entry.MANUFACTURER)
+        self.assertEqual(snapshot.balance, 2000000)
+
+        fulfilment.place_order(self.blueprint, 10)
+        self.assertEqual(balances.balance(self.manufacturer), 1990000)
+        self.assertEqual(balances.snapshot(Manufacturer), 1)
+        self.assertEqual(balances.snapshot(Manufacturer), 0)
+        snapshot = Snapshot.objects.get(account_type=Entry.MANUFACTURER)
+        self.assertEqual(snapshot.balance, 1990000)
+        self.assertEqual(snapshot.entry_id, Entry.objects.latest("pk").pk)
+        self.assertLedgerMatches()
+
+    def test_check_ledger_command(self):
+        # e.g. an edit in the admin site
+        Dealership.objects.filter(pk=self.dealership.pk).update(balance=1000)
+
+        out = StringIO()
+        call_command("check_ledger", stdout=out)
+        self.assertIn("balance is 1000, ledger says 2000000", out.getvalue())
+        self.assertIn("dealerships.Dealership: 1 rows checked, 1 differences found",
+            out.getvalue())
+
+        call_command("check_ledger", adjust=True, stdout=StringIO())
+        self.assertLedgerMatches()
+        self.assertEqual(balances.balance(self.dealership), 1000)
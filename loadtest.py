@@ -0,0 +1,295 @@
+"""
+Load test for a running Car Supply Chain server.
+
+Simulates manufacturers placing manufacturing orders and settling wholesale
+deals, dealerships buying wholesale cars and settling retail deals, and
+customers buying retail cars, then reports latency percentiles and
+throughput per URL name.
+
+Seed a database first (python manage.py seed), start the server
+(python manage.py runserver or gunicorn CarSupply.wsgi) and run
+
+    python loadtest.py --url http://localhost:8000 --users 20 --duration 60
+
+Only the standard library is used, so it runs anywhere the app does.
+"""
+
+import argparse
+import http.cookiejar
+import json
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+
+
+MANUFACTURERS = ["acura_admin", "buick_admin", "toyota_admin", "volvo_admin"]
+DEALERSHIPS = ["smith_admin", "jessica_admin", "jackson_admin", "andrew_admin"]
+CUSTOMERS = ["customer"]
+
+PASSWORDS = {"customer": "customer"}
+DEFAULT_PASSWORD = "admin"
+
+BLUEPRINT_LINK = re.compile(r'href="/blueprints/(\d+)/"')
+WHOLESALE_DEAL_ACCEPT_LINK = re.compile(r'href="/deals/from-dealerships/(\d+)/accept/"')
+RETAIL_DEAL_ACCEPT_LINK = re.compile(r'href="/deals/from-customers/(\d+)/accept/"')
+WHOLESALE_CAR_BUY_LINK = re.compile(r'href="/deals/create-wholesale-deal/(\d+)/"')
+RETAIL_CAR_BUY_LINK = re.compile(r'href="/deals/create-retail-deal/(\d+)/"')
+NEXT_PAGE_LINK = re.compile(r'href="\?after=([\w-]+)"')
+ASKING_PRICE = re.compile(r'name="asking_price" value="(\d+)"')
+
+
+class Stats:
+    """ Thread-safe collection of request latencies per URL name. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, name, seconds, ok):
+        with self.lock:
+            self.latencies[name].append(seconds)
+            if not ok:
+                self.errors[name] += 1
+
+    def report(self, duration):
+        rows = {}
+        for name, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            rows[name] = {
+                "requests": len(latencies),
+                "errors": self.errors[name],
+                "rps": len(latencies) / duration,
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+            }
+        return rows
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile of a sorted list. """
+
+    if not values:
+        return 0
+    rank = max(0, min(len(values) - 1, round(p / 100 * len(values) + 0.5) - 1))
+    return values[rank]
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    """ Returns redirects to the caller so each hop is timed on its own. """
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class Client:
+    """ A logged in browser session. """
+
+    def __init__(self, base_url, stats):
+        self.base_url = base_url.rstrip("/")
+        self.stats = stats
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(self.cookies), NoRedirect())
+
+    def csrf_token(self):
+        for cookie in self.cookies:
+            if cookie.name == "csrftoken":
+                return cookie.value
+        return ""
+
+    def request(self, name, path, data=None):
+        """
+        Requests path and records the latency under the URL name.
+
+        Returns the status code and the body. Redirects are not followed.
+        """
+
+        body = None
+        headers = {"Referer": self.base_url + path}
+        if data is not None:
+            data = dict(data, csrfmiddlewaretoken=self.csrf_token())
+            body = urllib.parse.urlencode(data, doseq=True).encode()
+        request = urllib.request.Request(self.base_url + path, data=body, headers=headers)
+
+        start = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=30) as response:
+                status, content = response.status, response.read()
+        except urllib.error.HTTPError as error:
+            status, content = error.code, error.read()
+        except (urllib.error.URLError, OSError):
+            status, content = 0, b""
+        self.stats.record(name, time.perf_counter() - start, 0 < status < 400)
+        return status, content.decode(errors="replace")
+
+    def login(self, username):
+        self.request("login", "/user/login/")
+        status, _ = self.request("login", "/user/login/", {
+            "username": username,
+            "password": PASSWORDS.get(username, DEFAULT_PASSWORD),
+        })
+        return status == 302
+
+    def add_balance(self, amount):
+        self.request("user:add_balance", "/user/add-balance", {"balance": amount})
+
+
+def manufacturer_flow(client, rng):
+    """ Places a manufacturing order and settles a pending wholesale deal. """
+
+    _, page = client.request("blueprints:index", "/blueprints/")
+    blueprints = BLUEPRINT_LINK.findall(page)
+    if blueprints:
+        client.request("manufacturers:create", "/manufacturers/create-mo/")
+        status, _ = client.request("manufacturers:create", "/manufacturers/create-mo/", {
+            "car": rng.choice(blueprints),
+            "count": rng.randint(1, 5),
+        })
+
+    _, page = client.request("deals:from_dealerships", "/deals/from-dealerships/")
+    pending = WHOLESALE_DEAL_ACCEPT_LINK.findall(page)
+    if pending:
+        pk = rng.choice(pending)
+        client.request("deals:wholesale_deal_accept", "/deals/from-dealerships/%s/accept/" % pk)
+        client.request("deals:wholesale_deal_detail", "/deals/wholesale-deal-%s/" % pk)
+
+    client.request("inventory:index", "/inventory/")
+
+
+def dealership_flow(client, rng):
+    """ Makes a wholesale deal and settles a pending retail deal. """
+
+    _, page = client.request("inventory:manufacturers_inventory", "/inventory/manufacturers/")
+    cursor = NEXT_PAGE_LINK.search(page)
+    if cursor and rng.random() < 0.3:
+        _, page = client.request("inventory:manufacturers_inventory",
+                                 "/inventory/manufacturers/?after=%s" % cursor.group(1))
+    cars = WHOLESALE_CAR_BUY_LINK.findall(page)
+    if cars:
+        pk = rng.choice(cars)
+        _, form = client.request("deals:wholesale_deal_create",
+                                 "/deals/create-wholesale-deal/%s/" % pk)
+        price = ASKING_PRICE.search(form)
+        client.request("deals:wholesale_deal_create", "/deals/create-wholesale-deal/%s/" % pk, {
+            "car": pk,
+            "amount": 1,
+            "asking_price": price.group(1) if price else 1000,
+        })
+
+    _, page = client.request("deals:from_customers", "/deals/from-customers/")
+    pending = RETAIL_DEAL_ACCEPT_LINK.findall(page)
+    if pending:
+        pk = rng.choice(pending)
+        client.request("deals:retail_deal_accept", "/deals/from-customers/%s/accept/" % pk)
+
+    client.request("deals:to_manufacturers", "/deals/to-manufacturers/")
+    client.request("inventory:index", "/inventory/")
+
+
+def customer_flow(client, rng):
+    """ Browses the retail catalogue and makes a retail deal. """
+
+    _, page = client.request("inventory:dealership_inventory", "/inventory/dealerships/")
+    cursor = NEXT_PAGE_LINK.search(page)
+    if cursor and rng.random() < 0.3:
+        _, page = client.request("inventory:dealership_inventory",
+                                 "/inventory/dealerships/?after=%s" % cursor.group(1))
+    cars = RETAIL_CAR_BUY_LINK.findall(page)
+    if cars:
+        pk = rng.choice(cars)
+        _, form = client.request("deals:retail_deal_create", "/deals/create-retail-deal/%s/" % pk)
+        price = ASKING_PRICE.search(form)
+        client.request("deals:retail_deal_create", "/deals/create-retail-deal/%s/" % pk, {
+            "car": pk,
+            "asking_price": price.group(1) if price else 1000,
+        })
+
+    client.request("deals:to_dealerships", "/deals/to-dealerships/")
+    client.request("user:profile", "/user/")
+
+
+ROLES = {
+    "manufacturer": (MANUFACTURERS, manufacturer_flow),
+    "dealership": (DEALERSHIPS, dealership_flow),
+    "customer": (CUSTOMERS, customer_flow),
+}
+
+
+def virtual_user(base_url, stats, role, seed, deadline):
+    rng = random.Random(seed)
+    usernames, flow = ROLES[role]
+    client = Client(base_url, stats)
+    if not client.login(rng.choice(usernames)):
+        return
+    client.add_balance(10 ** 8)
+    while time.monotonic() < deadline:
+        flow(client, rng)
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        role, _, weight = part.partition("=")
+        if role not in ROLES:
+            raise argparse.ArgumentTypeError("Unknown role %r" % role)
+        mix[role] = float(weight or 1)
+    return mix
+
+
+def print_report(rows, duration):
+    header = "%-40s %8s %6s %8s %9s %9s %9s" % (
+        "url name", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms")
+    print(header)
+    print("-" * len(header))
+    for name, row in rows.items():
+        print("%-40s %8d %6d %8.1f %9.1f %9.1f %9.1f" % (
+            name, row["requests"], row["errors"], row["rps"],
+            row["p50_ms"], row["p95_ms"], row["p99_ms"]))
+    total = sum(row["requests"] for row in rows.values())
+    print("-" * len(header))
+    print("%d requests in %.1fs (%.1f req/s)" % (total, duration, total / duration))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--users", type=int, default=10, help="Concurrent virtual users.")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to run for.")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("manufacturer=1,dealership=2,customer=6"),
+                        help="Weights of each role, e.g. manufacturer=1,dealership=2,customer=6")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the report to this file as JSON.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    roles = rng.choices(list(args.mix), weights=list(args.mix.values()), k=args.users)
+    stats = Stats()
+
+    start = time.monotonic()
+    deadline = start + args.duration
+    threads = [
+        threading.Thread(target=virtual_user, args=(args.url, stats, role, rng.random(), deadline))
+        for role in roles
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.monotonic() - start
+
+    rows = stats.report(duration)
+    print_report(rows, duration)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"duration": duration, "users": args.users, "urls": rows}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
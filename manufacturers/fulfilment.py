@@ -0,0 +1,194 @@
+"""
+Queued manufacturing orders.
+
+Placing an order only pays for it: the cost is deducted from the
+manufacturer's balance with a conditional UPDATE (and recorded in the
+ledger) and the order is saved as PENDING, so the request holds the
+manufacturer row for one statement.
+The cars are added to the wholesale inventory later, many orders at a
+time, by the worker command
+
+    python manage.py fulfil_orders
+
+Each batch claims the oldest pending orders (skipping orders locked by
+another worker where the database supports it) and writes the stock,
+counter and facet changes of the whole batch with one statement per table,
+in the lock order documented in deals.settlement. Orders whose blueprint
+was deleted in the meantime fail and are refunded.
+"""
+
+from collections import defaultdict
+
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from deals.settlement import QueryCounter
+from inventory import counters, facets, page_cache
+from inventory.lookups import candidates
+from inventory.models import FacetCount, WholesaleCar
+from ledger import balances
+from ledger.models import Entry
+from users.permissions import assign_object_perm
+
+from .models import Manufacturer, ManufacturingOrder
+
+
+class FulfilmentError(Exception):
+    """ Raised when a manufacturing order cannot be placed or fulfilled. """
+
+
+class InsufficientBalance(FulfilmentError):
+    pass
+
+
+class BlueprintDeleted(FulfilmentError):
+    pass
+
+
+class BatchFulfilment:
+    """
+    Result of fulfilling a batch of manufacturing orders.
+
+    Attributes:
+        outcomes (dict): maps each order pk to None if it was fulfilled or
+            to the FulfilmentError explaining why it failed
+        queries (int): number of SQL statements the batch executed
+    """
+
+    def __init__(self, outcomes, queries):
+        self.outcomes = outcomes
+        self.queries = queries
+
+    @property
+    def succeeded(self):
+        return [pk for pk, error in self.outcomes.items() if error is None]
+
+    @property
+    def failed(self):
+        return {pk: error for pk, error in self.outcomes.items() if error is not None}
+
+
+def place_order(car, count):
+    """
+    Pays for count cars of a blueprint and queues the manufacturing order.
+
+    Parameters:
+        car (obj): blueprint
+        count (int): number of cars
+
+    Returns the pending ManufacturingOrder.
+    Raises InsufficientBalance if the manufacturer cannot afford it.
+    """
+
+    total_cost = car.price * count
+    with transaction.atomic():
+        if not Manufacturer.objects.filter(
+                pk=car.manufacturer_id, balance__gte=total_cost).update(
+                balance=F('balance') - total_cost):
+            raise InsufficientBalance("Your balance is too low")
+        order = ManufacturingOrder.objects.create(
+            manufacturer_id=car.manufacturer_id, car=car, count=count, price=car.price)
+        balances.record(balances.entry(Manufacturer, car.manufacturer_id, -total_cost,
+                                       Entry.MANUFACTURING_ORDER, order.pk))
+    return order
+
+
+def _wholesale_cars(keys):
+    """ Locks the wholesale cars matching (manufacturer_id, name, price) keys. """
+
+    keys = set(keys)
+    cars = {}
+    for car in candidates(WholesaleCar.objects.select_for_update(),
+                          ("manufacturer_id", "name", "cost_price"), keys).order_by("pk"):
+        key = (car.manufacturer_id, car.name, car.cost_price)
+        if key in keys and car.wholesale_price == car.cost_price:
+            cars[key] = car
+    return cars
+
+
+def fulfil_orders(batch_size=100):
+    """
+    Fulfils up to batch_size pending manufacturing orders, oldest first, in
+    a single transaction.
+
+    Orders for the same car are merged into one stock change, so the
+    number of statements does not depend on the number of orders (apart
+    from the permission of each newly created wholesale car).
+
+    Returns a BatchFulfilment; its outcomes are empty when the queue is.
+    """
+
+    counter = QueryCounter()
+    outcomes = {}
+
+    with connection.execute_wrapper(counter), transaction.atomic():
+        orders = list(ManufacturingOrder.objects.select_for_update(
+            skip_locked=True, of=("self",)).select_related(
+            "car", "manufacturer__admin").filter(
+            status=ManufacturingOrder.PENDING).order_by("pk")[:batch_size])
+        if not orders:
+            return BatchFulfilment(outcomes, counter.count)
+
+        refunds = defaultdict(int)
+        stock = defaultdict(int)
+        stock_value = defaultdict(int)
+        made = defaultdict(int)
+        owners = {}
+        facet_entries = []
+        ledger_entries = []
+        for order in orders:
+            if order.car is None or order.manufacturer is None:
+                outcomes[order.pk] = BlueprintDeleted(
+                    "The blueprint was deleted; the order was refunded")
+                refunds[order.manufacturer_id] += order.price * order.count
+                ledger_entries.append(balances.entry(
+                    Manufacturer, order.manufacturer_id, order.price * order.count,
+                    Entry.REFUND, order.pk))
+                continue
+            outcomes[order.pk] = None
+            key = (order.manufacturer_id, order.car.name, order.price)
+            made[key] += order.count
+            owners[key] = order.manufacturer
+            stock[order.manufacturer_id] += order.count
+            stock_value[order.manufacturer_id] += order.price * order.count
+            facet_entries.append((FacetCount.WHOLESALE, order.manufacturer_id,
+                                  order.manufacturer.country, order.price, order.count))
+
+        counters.add_many(Manufacturer, balance=refunds, cars_in_stock=stock,
+                          stock_value=stock_value)
+        balances.record(*ledger_entries)
+
+        if made:
+            cars = _wholesale_cars(made)
+            missing = [key for key in made if key not in cars]
+            if missing:
+                # Created empty and topped up below like the existing rows;
+                # unique_wholesale_car skips any created concurrently
+                WholesaleCar.objects.bulk_create([
+                    WholesaleCar(manufacturer_id=manufacturer_id, name=name, cost_price=price,
+                                 wholesale_price=price, amount=0)
+                    for manufacturer_id, name, price in missing
+                ], ignore_conflicts=True)
+                created = _wholesale_cars(missing)
+                for key, car in created.items():
+                    if owners[key].admin is not None:
+                        assign_object_perm("change_wholesalecar", owners[key].admin, car)
+                cars.update(created)
+
+            counters.add_many(WholesaleCar, amount={
+                cars[key].pk: count for key, count in made.items()})
+            facets.add(*facet_entries)
+            page_cache.invalidate(FacetCount.WHOLESALE)
+
+        batch = BatchFulfilment(outcomes, 0)
+        now = timezone.now()
+        if batch.succeeded:
+            ManufacturingOrder.objects.filter(pk__in=batch.succeeded).update(
+                status=ManufacturingOrder.FULFILLED, processed_at=now)
+        if batch.failed:
+            ManufacturingOrder.objects.filter(pk__in=batch.failed).update(
+                status=ManufacturingOrder.FAILED, processed_at=now)
+
+    batch.queries = counter.count
+    return batch
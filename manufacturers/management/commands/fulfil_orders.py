@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from manufacturers import fulfilment
+
+
+class Command(BaseCommand):
+    """
+    Worker fulfilling the queued manufacturing orders in batches. Polls the
+    queue until stopped, or with --once until it is empty. Several workers
+    can run at once on databases supporting SKIP LOCKED (PostgreSQL).
+    """
+
+    help = "Fulfil pending manufacturing orders."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument("--interval", type=float, default=1.0,
+                            help="Seconds to wait when the queue is empty.")
+        parser.add_argument("--once", action="store_true",
+                            help="Exit once the queue is empty.")
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            batch = fulfilment.fulfil_orders(options["batch_size"])
+            if batch.outcomes:
+                for pk, error in batch.failed.items():
+                    self.stdout.write("Order %d failed: %s" % (pk, error))
+                self.stdout.write("Fulfilled %d orders, %d failed (%d queries)" % (
+                    len(batch.succeeded), len(batch.failed), batch.queries))
+            elif options["once"]:
+                break
+            else:
+                time.sleep(options["interval"])
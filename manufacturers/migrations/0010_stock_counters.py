@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manufacturers', '0009_manufacturingorder_manufacturer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='manufacturer',
+            name='cars_in_stock',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='manufacturer',
+            name='pending_deal_value',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='manufacturer',
+            name='stock_value',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+    ]
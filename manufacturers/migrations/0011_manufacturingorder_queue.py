@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-18 14:05
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manufacturers', '0010_stock_counters'),
+    ]
+
+    operations = [
+        # Orders placed so far were fulfilled when they were placed
+        migrations.AddField(
+            model_name='manufacturingorder',
+            name='status',
+            field=models.CharField(choices=[('PE', 'PENDING'), ('FU', 'FULFILLED'), ('FA', 'FAILED')], default='FU', max_length=2),
+        ),
+        migrations.AlterField(
+            model_name='manufacturingorder',
+            name='status',
+            field=models.CharField(choices=[('PE', 'PENDING'), ('FU', 'FULFILLED'), ('FA', 'FAILED')], default='PE', max_length=2),
+        ),
+        migrations.AddField(
+            model_name='manufacturingorder',
+            name='price',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='manufacturingorder',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='manufacturingorder',
+            name='processed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='manufacturingorder',
+            index=models.Index(condition=models.Q(('status', 'PE')), fields=['id'], name='mo_pending_idx'),
+        ),
+    ]
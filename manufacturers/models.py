@@ -1,36 +1,63 @@
-import json
-
 from django.core.validators import MinValueValidator
 from django.db import models
 
 from blueprints.models import Car
+from CarSupply.countries import get_countries
 from users.models import User
 
-with open("countries-django.json") as file:
-    countries = json.loads(file.read())
-
 
 # Create your models here.
 class Manufacturer(models.Model):
     """Model definition for Manufacturer. """
 
     name = models.CharField(max_length=30)
-    country = models.CharField(max_length=3, choices=countries)
+    country = models.CharField(max_length=3, choices=get_countries())
     balance = models.PositiveIntegerField(
         default=0, validators=[MinValueValidator(1)])
     admin = models.ForeignKey(User, on_delete=models.CASCADE, null=True)
 
+    # Maintained by inventory.counters
+    cars_in_stock = models.BigIntegerField(default=0, editable=False)
+    stock_value = models.BigIntegerField(default=0, editable=False)
+    pending_deal_value = models.BigIntegerField(default=0, editable=False)
+
     def __str__(self):
         return self.name
 
 
 class ManufacturingOrder(models.Model):
-    """Model definition for Manufacturing Order """
-    
+    """
+    Model definition for Manufacturing Order
+
+    Orders are paid for when placed and queued as PENDING; the cars are
+    added to the wholesale inventory later by manufacturers.fulfilment.
+    """
+
+    PENDING = "PE"
+    FULFILLED = "FU"
+    FAILED = "FA"
+    STATUS = (
+        (PENDING, "PENDING"),
+        (FULFILLED, "FULFILLED"),
+        (FAILED, "FAILED"),
+    )
+
     manufacturer = models.ForeignKey(
         Manufacturer, on_delete=models.CASCADE, null=True)
     car = models.ForeignKey(Car, on_delete=models.SET_NULL, null=True)
     count = models.PositiveIntegerField()
+    status = models.CharField(max_length=2, choices=STATUS, default=PENDING)
+    # Blueprint price when the order was placed
+    price = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # The fulfilment queue, oldest first
+            models.Index(fields=["id"], condition=models.Q(status="PE"),
+                         name="mo_pending_idx"),
+        ]
 
     def __str__(self):
         return "%d - %d %ss" % (self.pk, self.count, self.car)
@@ -1,8 +1,13 @@
+from io import StringIO
+
+from django.core.management import call_command
 from django.test import TestCase
 from django.urls import reverse
 
 from users.models import User
 from blueprints.models import Car
+from inventory.models import FacetCount, WholesaleCar
+from . import fulfilment
 from .models import Manufacturer, ManufacturingOrder
 # Create your tests here.
 
@@ -47,6 +52,11 @@ class ManufacturingOrderTest(TestCase):
         self.assertRedirects(post_response,reverse("manufacturers:mo_detail",kwargs={"pk":1}))
         last_response =self.client.get(reverse("user:profile"))
         self.assertContains(last_response, "Balance: $1,300,000")
+        order = ManufacturingOrder.objects.get()
+        self.assertEqual(order.status, ManufacturingOrder.PENDING)
+        self.assertFalse(WholesaleCar.objects.exists())
+        detail_response = self.client.get(reverse("manufacturers:mo_detail",kwargs={"pk":order.pk}))
+        self.assertContains(detail_response, "PENDING")
  
     def test_manufacturer_manufacturing_order_create_fail(self):
         """
@@ -63,3 +73,83 @@ class ManufacturingOrderTest(TestCase):
             "car": self.blueprint.pk
         })
         self.assertContains(post_response,"Your balance is too low")
+
+
+class ManufacturingOrderFulfilmentTest(TestCase):
+    """
+    Tests to ascertain that queued manufacturing orders are fulfilled in
+    batches by the worker
+    """
+    def setUp(self):
+        self.user = User.objects.create(username="tester", user_type=User.MANUFACTURER)
+        self.manufacturer = Manufacturer.objects.create(name="NaijaManufacturer",
+            country="NGA", balance=1500000, admin=self.user)
+        self.blueprint = Car.objects.create(name="model-1", price=20000,
+            manufacturer=self.manufacturer)
+        self.other_blueprint = Car.objects.create(name="model-2", price=30000,
+            manufacturer=self.manufacturer)
+
+    def test_fulfil_orders(self):
+        WholesaleCar.objects.create(name="model-1", cost_price=20000, wholesale_price=20000,
+            amount=1, manufacturer=self.manufacturer)
+        first = fulfilment.place_order(self.blueprint, 2)
+        second = fulfilment.place_order(self.blueprint, 3)
+        third = fulfilment.place_order(self.other_blueprint, 4)
+        self.manufacturer.refresh_from_db()
+        self.assertEqual(self.manufacturer.balance, 1500000 - 5 * 20000 - 4 * 30000)
+        self.assertEqual(self.manufacturer.cars_in_stock, 0)
+
+        batch = fulfilment.fulfil_orders(batch_size=2)
+        self.assertEqual(batch.succeeded, [first.pk, second.pk])
+        batch = fulfilment.fulfil_orders()
+        self.assertEqual(batch.succeeded, [third.pk])
+        self.assertEqual(fulfilment.fulfil_orders().outcomes, {})
+
+        self.assertEqual(dict(WholesaleCar.objects.values_list("name", "amount")),
+                         {"model-1": 6, "model-2": 4})
+        self.assertTrue(self.user.has_perm("change_wholesalecar",
+                                           WholesaleCar.objects.get(name="model-2")))
+        self.assertEqual(set(ManufacturingOrder.objects.values_list("status", flat=True)),
+                         {ManufacturingOrder.FULFILLED})
+        self.manufacturer.refresh_from_db()
+        self.assertEqual(self.manufacturer.cars_in_stock, 9)
+        self.assertEqual(self.manufacturer.stock_value, 5 * 20000 + 4 * 30000)
+        self.assertEqual(FacetCount.objects.get(catalogue=FacetCount.WHOLESALE,
+            facet=FacetCount.COUNTRY, value="NGA").cars, 9)
+
+    def test_fulfil_orders_for_many_cars(self):
+        # More cars than SQLite nests in an expression
+        Car.objects.bulk_create([Car(name="model-%d" % i, price=1, manufacturer=self.manufacturer)
+            for i in range(3, 1103)])
+        WholesaleCar.objects.bulk_create([WholesaleCar(name="model-%d" % i, cost_price=1,
+            wholesale_price=1, manufacturer=self.manufacturer) for i in range(3, 1103)])
+        ManufacturingOrder.objects.bulk_create([ManufacturingOrder(manufacturer=self.manufacturer,
+            car=car, count=2, price=1) for car in Car.objects.filter(price=1)])
+
+        batch = fulfilment.fulfil_orders(batch_size=2000)
+        self.assertEqual(len(batch.succeeded), 1100)
+        self.assertEqual(set(WholesaleCar.objects.values_list("amount", flat=True)), {2})
+
+    def test_insufficient_balance(self):
+        with self.assertRaises(fulfilment.InsufficientBalance):
+            fulfilment.place_order(self.blueprint, 100)
+        self.assertFalse(ManufacturingOrder.objects.exists())
+
+    def test_deleted_blueprint_is_refunded(self):
+        order = fulfilment.place_order(self.blueprint, 10)
+        self.blueprint.delete()
+        batch = fulfilment.fulfil_orders()
+        self.assertIsInstance(batch.failed[order.pk], fulfilment.BlueprintDeleted)
+
+        order.refresh_from_db()
+        self.manufacturer.refresh_from_db()
+        self.assertEqual(order.status, ManufacturingOrder.FAILED)
+        self.assertEqual(self.manufacturer.balance, 1500000)
+        self.assertFalse(WholesaleCar.objects.exists())
+
+    def test_worker_command(self):
+        fulfilment.place_order(self.blueprint, 2)
+        out = StringIO()
+        call_command("fulfil_orders", once=True, stdout=out)
+        self.assertEqual(WholesaleCar.objects.get().amount, 2)
+        self.assertIn("Fulfilled 1 orders, 0 failed", out.getvalue())
@@ -1,20 +1,19 @@
 from django import forms
 from django.core.exceptions import PermissionDenied
 from django.db import transaction
-from django.db.models import F
 from django.shortcuts import redirect, render
 from django.urls import reverse_lazy
 from django.utils.decorators import method_decorator
 from django.views.generic import CreateView, DetailView, UpdateView
 
 from blueprints.models import Car
-from inventory.models import WholesaleCar
-from users.permissions import UserIsManufacturer
+from users.affiliation import affiliation_id, owner_id
+from users.permissions import (CachedPermissionRequiredMixin, UserIsManufacturer,
+                               assign_object_perm)
 
-from .models import Manufacturer, ManufacturingOrder
+from . import fulfilment
+from .models import ManufacturingOrder
 
-from guardian.shortcuts import assign_perm
-from guardian.mixins import PermissionRequiredMixin
 
 # Create your views here.
 
@@ -26,7 +25,7 @@ class ManufacturingOrderForm(forms.ModelForm):
     created by the manufacturer.
 
     Parameters:
-        user (obj): The current user object (request.user)
+        manufacturer_id (int): The primary key of the user's manufacturer
 
     Returns a manufacturung order model form.
     """
@@ -35,17 +34,16 @@ class ManufacturingOrderForm(forms.ModelForm):
         model = ManufacturingOrder
         fields = ("car", "count")
 
-    def __init__(self, user, *args, **kwargs):
+    def __init__(self, manufacturer_id, *args, **kwargs):
         """
         The constructor for ManufacturingOrder form
 
         Parameters:
-            user (obj): the current user object (request.user)
+            manufacturer_id (int): the primary key of the user's manufacturer
         """
 
         super().__init__(*args, **kwargs)
-        self.fields['car'].queryset = Car.objects.filter(
-            manufacturer__admin=user)
+        self.fields['car'].queryset = Car.objects.owned_by(manufacturer_id).for_listing()
 
 
 @method_decorator(transaction.atomic, name="form_valid")
@@ -56,9 +54,9 @@ class ManufacturingOrderCreateView(UserIsManufacturer, CreateView):
     A view for creating manufacturing orders. Passes the current user object to 
     the model form to obtain a personalied form.
     When the form is returned, the total cost of the manufacturing order is
-    deducted from the manufacturer's balance and new Wholesale cars
-    corresponding to the specifications in the manufacturing order are
-    created.
+    deducted from the manufacturer's balance and the order is queued; the
+    wholesale cars are created later by the fulfil_orders worker (see
+    manufacturers.fulfilment).
 
     Diplays an error when the  manufacturer's balance is lesser than the
     total cost.
@@ -69,43 +67,29 @@ class ManufacturingOrderCreateView(UserIsManufacturer, CreateView):
     template_name = "manufacturing-order-create.html"
 
     def get_form(self):
-        return ManufacturingOrderForm(self.request.user, **self.get_form_kwargs())
+        # The blueprints offered come from the session, those accepted from the database
+        if self.request.method == "POST":
+            manufacturer_id = owner_id(self.request)
+        else:
+            manufacturer_id = affiliation_id(self.request)
+        return ManufacturingOrderForm(manufacturer_id, **self.get_form_kwargs())
 
     def form_valid(self, form):
-        car = form.instance.car
-        count = form.instance.count
-
-        total_cost = car.price * count
-        balance = car.manufacturer.balance
-
-        if balance >= total_cost:
-            form.instance.manufacturer = car.manufacturer
-            manufacturing_order = form.save()
-
-            assign_perm("change_manufacturingorder",
-                        self.request.user, manufacturing_order)
-
-            car.manufacturer.balance = F('balance') - total_cost
-            car.manufacturer.save()
-
-            wholesale_car, _ = WholesaleCar.objects.update_or_create(
-                name=car.name,
-                cost_price=car.price,
-                wholesale_price=car.price,
-                manufacturer=car.manufacturer)
-            wholesale_car.amount = F('amount') + count
-            wholesale_car.save()
+        try:
+            manufacturing_order = fulfilment.place_order(
+                form.instance.car, form.instance.count)
+        except fulfilment.InsufficientBalance as error:
+            form.add_error(field=None, error=str(error))
+            return self.form_invalid(form)
 
-            assign_perm("change_wholesalecar", self.request.user, wholesale_car)
+        assign_object_perm("change_manufacturingorder",
+                    self.request.user, manufacturing_order)
 
-            success_url = "manufacturers:mo_detail"
-            return redirect(success_url, manufacturing_order.pk)
-        else:
-            form.add_error(field=None, error="Your balance is too low")
-            return self.form_invalid(form)
+        success_url = "manufacturers:mo_detail"
+        return redirect(success_url, manufacturing_order.pk)
 
 
-class ManufacturingOrderDetailView(PermissionRequiredMixin, DetailView):
+class ManufacturingOrderDetailView(CachedPermissionRequiredMixin, DetailView):
     """ Detail View to show Manufacturing Orders"""
 
     model = ManufacturingOrder
@@ -1,16 +1,29 @@
 import json
 import random
+import time
+from collections import defaultdict
+from itertools import cycle, islice
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.auth.models import Permission
+from django.db import connection, transaction
+from django.db.models import F
+from guardian.models import UserObjectPermission
 
 from blueprints.models import Car
 from manufacturers.models import Manufacturer
-from inventory.models import WholesaleCar
+from inventory import counters, facets, page_cache
+from inventory.models import FacetCount, WholesaleCar
 from users.models import User
 from dealerships.models import Dealership
 
-from guardian.shortcuts import assign_perm
+from CarSupply.countries import get_country_codes
+from users.permissions import assign_object_perm, guardian_enabled
+
 
-with open("countries-django.json") as file:
-    countries = json.loads(file.read())
+def manufacturer_username(brand):
+    return f"{brand}_admin".lower().replace(" ","_").replace("-","_")
 
 
 def populate_cars(initial=True):
@@ -20,10 +33,10 @@ def populate_cars(initial=True):
     for car in cars:
 
         brand = car['brand']
-        country = random.choice(countries)[0]
+        country = random.choice(get_country_codes())
 
         if initial:
-            username = f"{brand}_admin".lower().replace(" ","_").replace("-","_")
+            username = manufacturer_username(brand)
             manufacturer_admin = User(
                 username=username, user_type=User.MANUFACTURER)
 
@@ -48,19 +61,29 @@ def populate_cars(initial=True):
             car = Car.objects.create(name=model, price=price,
                                manufacturer=manufacturer)
             amount = price/1000
-            w_car = WholesaleCar.objects.create(
-                name=model, wholesale_price=price, cost_price=price, amount=amount, manufacturer=manufacturer)
+            # Wholesale cars are unique per manufacturer, name and price
+            w_car, created = WholesaleCar.objects.get_or_create(
+                name=model, wholesale_price=price, cost_price=price, manufacturer=manufacturer,
+                defaults={"amount": amount})
+            if not created:
+                w_car.amount = F('amount') + amount
+                w_car.save()
+
+            assign_object_perm("change_car", manufacturer.admin, car)
+            assign_object_perm("change_wholesalecar", manufacturer.admin, w_car)
+
+    counters.reconcile(Manufacturer)
+    facets.rebuild()
+
 
-            assign_perm("change_car", manufacturer.admin, car)
-            assign_perm("change_wholesalecar", manufacturer.admin, w_car)
+DEALERSHIP_NAMES = "Andrew Jefferson Nicholas Smith Sydney Williams Samuel Robertson Jessica Price Jackson Kingston"
 
 
 def populate_dealerships():
-    names = "Andrew Jefferson Nicholas Smith Sydney Williams Samuel Robertson Jessica Price Jackson Kingston"
-    split_names = names.split()
+    split_names = DEALERSHIP_NAMES.split()
 
     for name in split_names:
-        country = random.choice(countries)[0]
+        country = random.choice(get_country_codes())
         dealership_name = f"{name} Motors"
 
         username = f"{name.lower()}_admin"
@@ -92,3 +115,171 @@ def populate_database():
     print("Customer username: customer")
     print("Customer password: customer")
 
+
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class SeedReport:
+    """ Counts the rows created per model and the time spent creating them. """
+
+    def __init__(self):
+        self.rows = {}
+        self.seconds = {}
+
+    def add(self, label, rows, seconds):
+        self.rows[label] = self.rows.get(label, 0) + rows
+        self.seconds[label] = self.seconds.get(label, 0) + seconds
+
+    def lines(self):
+        for label, rows in self.rows.items():
+            seconds = self.seconds[label]
+            rate = rows / seconds if seconds else 0
+            yield f"{label}: {rows} rows in {seconds:.2f}s ({rate:,.0f} rows/sec)"
+
+
+def _bulk_create(report, model, objects, batch_size, **kwargs):
+    start = time.perf_counter()
+    created = model.objects.bulk_create(objects, batch_size=batch_size, **kwargs)
+    report.add(model._meta.label, len(objects), time.perf_counter() - start)
+    return created
+
+
+def _create_users(report, usernames, user_type, password, batch_size):
+    """ Creates the users that do not exist yet and returns all of them by username. """
+
+    existing = set(User.objects.filter(username__in=usernames).values_list("username", flat=True))
+    _bulk_create(report, User, [
+        User(username=username, user_type=user_type, password=password)
+        for username in usernames if username not in existing
+    ], batch_size)
+    return {user.username: user for user in User.objects.filter(username__in=usernames)}
+
+
+def _assign_perms(report, codename, model, rows, batch_size):
+    """ Bulk inserts guardian rows granting codename on each (user_id, obj) in rows. """
+
+    if not guardian_enabled():
+        return
+    content_type = ContentType.objects.get_for_model(model)
+    permission = Permission.objects.get(content_type=content_type, codename=codename)
+    _bulk_create(report, UserObjectPermission, [
+        UserObjectPermission(permission=permission, content_type=content_type,
+                             user_id=user_id, object_pk=str(obj.pk))
+        for user_id, obj in rows
+    ], batch_size, ignore_conflicts=True)
+
+
+def seed_database(cars=4752, dealerships=12, customers=1, seed=0, batch_size=5000):
+    """
+    Seeds the database in bulk.
+
+    Like populate_database, but creates rows with bulk_create in batches,
+    hashes the admin password once and grants guardian permissions with bulk
+    inserts. Existing manufacturers and users are reused, so it can be run
+    repeatedly to grow the database.
+
+    Parameters:
+        cars (int): number of blueprints to create, each with a matching
+            wholesale car. The models in car-models.json are cycled through.
+            A blueprint whose wholesale car already exists (same
+            manufacturer, name and price) does not get a second one.
+        dealerships (int): number of dealerships to create
+        customers (int): number of customers to create
+        seed (int): random seed, the same seed produces the same data
+        batch_size (int): rows per INSERT statement
+
+    Returns a SeedReport.
+    """
+
+    if not connection.features.can_return_rows_from_bulk_insert:
+        raise RuntimeError("Seeding needs a database that returns primary keys from bulk inserts")
+
+    # Separate streams so car prices do not depend on how many
+    # manufacturers and dealerships already existed.
+    rng = random.Random(seed)
+    country_rng = random.Random(f"countries-{seed}")
+    countries = get_country_codes()
+    report = SeedReport()
+    password = make_password("admin")
+
+    with open("car-models.json") as file:
+        catalogue = json.loads(file.read())
+
+    with transaction.atomic():
+        admins = _create_users(
+            report, [manufacturer_username(car['brand']) for car in catalogue],
+            User.MANUFACTURER, password, batch_size)
+        manufacturers = {m.name: m for m in Manufacturer.objects.filter(
+            name__in=[car['brand'] for car in catalogue])}
+        _bulk_create(report, Manufacturer, [
+            Manufacturer(name=car['brand'], country=country_rng.choice(countries),
+                         admin=admins[manufacturer_username(car['brand'])])
+            for car in catalogue if car['brand'] not in manufacturers
+        ], batch_size)
+        manufacturers = {m.name: m for m in Manufacturer.objects.filter(
+            name__in=[car['brand'] for car in catalogue])}
+
+        models = [(manufacturers[car['brand']], model)
+                  for car in catalogue for model in car['models']]
+        # Wholesale cars are unique per (manufacturer, name, cost_price, wholesale_price)
+        wholesale_keys = set(WholesaleCar.objects.filter(
+            manufacturer__in=manufacturers.values()).values_list(
+            "manufacturer_id", "name", "cost_price", "wholesale_price"))
+        stock = defaultdict(int)
+        stock_value = defaultdict(int)
+        for batch in batched(islice(cycle(models), cars), batch_size):
+            blueprints = []
+            wholesale_cars = []
+            for manufacturer, model in batch:
+                price = round(rng.random() * 100000)
+                blueprints.append(Car(name=model, price=price, manufacturer=manufacturer))
+                key = (manufacturer.pk, model, price, price)
+                if key in wholesale_keys:
+                    continue
+                wholesale_keys.add(key)
+                wholesale_cars.append(WholesaleCar(
+                    name=model, wholesale_price=price, cost_price=price,
+                    amount=price // 1000, manufacturer=manufacturer))
+                stock[manufacturer.pk] += price // 1000
+                stock_value[manufacturer.pk] += price // 1000 * price
+            _bulk_create(report, Car, blueprints, batch_size)
+            _bulk_create(report, WholesaleCar, wholesale_cars, batch_size)
+            facets.add(*[facets.entry(FacetCount.WHOLESALE, car, car.amount)
+                         for car in wholesale_cars])
+            _assign_perms(report, "change_car", Car, [
+                (car.manufacturer.admin_id, car) for car in blueprints], batch_size)
+            _assign_perms(report, "change_wholesalecar", WholesaleCar, [
+                (car.manufacturer.admin_id, car) for car in wholesale_cars], batch_size)
+
+        counters.add_many(Manufacturer, cars_in_stock=stock, stock_value=stock_value)
+        page_cache.invalidate(FacetCount.WHOLESALE)
+
+        names = DEALERSHIP_NAMES.split()
+        dealership_names = [
+            name if i < len(names) else f"{name}{i // len(names)}"
+            for i, name in enumerate(islice(cycle(names), dealerships))
+        ]
+        admins = _create_users(
+            report, [f"{name.lower()}_admin" for name in dealership_names],
+            User.DEALERSHIP, password, batch_size)
+        existing = set(Dealership.objects.filter(
+            admin__in=admins.values()).values_list("admin__username", flat=True))
+        _bulk_create(report, Dealership, [
+            Dealership(name=f"{name} Motors", country=country_rng.choice(countries),
+                       admin=admins[f"{name.lower()}_admin"])
+            for name in dealership_names if f"{name.lower()}_admin" not in existing
+        ], batch_size)
+
+        customer_password = make_password("customer")
+        usernames = ["customer"] + [f"customer{i}" for i in range(1, customers)]
+        _create_users(report, usernames[:customers], User.CUSTOMER, customer_password, batch_size)
+
+    return report
@@ -0,0 +1,121 @@
+"""
+The manufacturer or dealership a user is the admin of.
+
+AffiliationMiddleware attaches it to every request as request.affiliation,
+fetched with one query on first use and kept for the rest of the request
+(None for customers, anonymous users and admins without one). Views that
+only need its pk, e.g. to filter a list by owner, use affiliation_id();
+views that write on its behalf use owner_id(), checked against the
+database on every request.
+
+The pk is also kept in the session, looked up when the user logs in, so
+affiliation_id() runs no query at all. A manufacturer or dealership given
+to another admin in the admin panel is noticed at their next login, or the
+next time request.affiliation is loaded; AFFILIATION_SESSION_CACHE = False
+turns the session copy off.
+"""
+
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_in
+
+from .models import User
+
+
+SESSION_KEY = "_affiliation"
+
+
+def affiliation_model(user):
+    """ Returns Manufacturer or Dealership for their admins, None for other users. """
+
+    from dealerships.models import Dealership
+    from manufacturers.models import Manufacturer
+
+    if not user.is_authenticated:
+        return None
+    return {User.MANUFACTURER: Manufacturer, User.DEALERSHIP: Dealership}.get(user.user_type)
+
+
+def _use_session(request):
+    return getattr(settings, "AFFILIATION_SESSION_CACHE", True) and hasattr(request, "session")
+
+
+def _remember(request, user, pk):
+    request._affiliation_id = pk
+    if _use_session(request):
+        request.session[SESSION_KEY] = [user.pk, pk]
+
+
+def _session_id(request):
+    if _use_session(request):
+        value = request.session.get(SESSION_KEY)
+        if value and value[0] == request.user.pk:
+            return value[1]
+    return None
+
+
+def _lookup_id(model, user):
+    return model.objects.filter(admin=user).order_by("pk").values_list("pk", flat=True).first()
+
+
+def affiliation_id(request):
+    """
+    Returns the pk of the manufacturer or dealership of request.user, or
+    None if they have none.
+    """
+
+    if not hasattr(request, "_affiliation_id"):
+        model = affiliation_model(request.user)
+        if model is None:
+            request._affiliation_id = None
+        else:
+            pk = _session_id(request) if "_affiliation" not in request.__dict__ else None
+            if pk is None:
+                affiliation = get_affiliation(request)
+                pk = affiliation and affiliation.pk
+            request._affiliation_id = pk
+    return request._affiliation_id
+
+
+def owner_id(request):
+    """
+    Returns the pk of the manufacturer or dealership of request.user, or
+    None if they have none, as stored in the database rather than the
+    session, so that an admin removed from it mid-session cannot act for it.
+    """
+
+    affiliation = get_affiliation(request)
+    return affiliation and affiliation.pk
+
+
+def get_affiliation(request):
+    """
+    Returns the manufacturer or dealership of request.user, or None if they
+    have none, with one query per request.
+    """
+
+    if "_affiliation" not in request.__dict__:
+        model = affiliation_model(request.user)
+        affiliation = None
+        if model is not None:
+            admin_of = model.objects.filter(admin=request.user)
+            pk = getattr(request, "_affiliation_id", None) or _session_id(request)
+            if pk is not None:
+                affiliation = admin_of.filter(pk=pk).first()
+            if affiliation is None:
+                affiliation = admin_of.order_by("pk").first()
+            if (affiliation and affiliation.pk) != pk:
+                _remember(request, request.user, affiliation and affiliation.pk)
+        request._affiliation = affiliation
+    return request._affiliation
+
+
+def logged_in(sender, request, user, **kwargs):
+    """ Keeps the pk of the affiliation of a user who just logged in in their session. """
+
+    model = affiliation_model(user)
+    if model is not None and request is not None and _use_session(request):
+        _remember(request, user, _lookup_id(model, user))
+
+
+def connect_signals():
+    user_logged_in.connect(logged_in, dispatch_uid="affiliation_logged_in")
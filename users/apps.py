@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class UsersConfig(AppConfig):
     name = 'users'
+
+    def ready(self):
+        from . import affiliation, user_cache
+        affiliation.connect_signals()
+        user_cache.connect_signals()
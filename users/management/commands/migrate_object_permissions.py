@@ -0,0 +1,88 @@
+from django.apps import apps
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from guardian.models import UserObjectPermission
+
+from users.permissions import OWNERSHIP_RULES
+
+
+BACKEND = "users.permissions.OwnershipPermissionBackend"
+
+
+class Command(BaseCommand):
+    """
+    Removes the guardian object permission rows that
+    OwnershipPermissionBackend makes redundant.
+
+    A row is redundant when ownership grants the same permission to the
+    same user, or when its object no longer exists. Rows granting access
+    that ownership would not grant are kept and reported unless --all is
+    given.
+
+    Refuses to delete anything, --dry-run aside, until
+    OwnershipPermissionBackend is in AUTHENTICATION_BACKENDS, as the rows
+    are all guardian's backend has to go on.
+    """
+
+    help = "Delete guardian object permissions implied by ownership."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Report what would be deleted without deleting it.")
+        parser.add_argument("--all", action="store_true",
+                            help="Also delete rows that ownership does not imply.")
+        parser.add_argument("--batch-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        if not options["dry_run"] and BACKEND not in settings.AUTHENTICATION_BACKENDS:
+            raise CommandError(
+                "Add %s to AUTHENTICATION_BACKENDS before deleting object permissions." % BACKEND)
+
+        for label, rules in OWNERSHIP_RULES.items():
+            model = apps.get_model(label)
+            content_type = ContentType.objects.get_for_model(model)
+            removed, kept = self.migrate_model(model, content_type, rules, options)
+            verb = "would be removed" if options["dry_run"] else "removed"
+            self.stdout.write("%s: %d rows %s, %d rows not implied by ownership" % (
+                label, removed, verb, kept))
+
+    def migrate_model(self, model, content_type, rules, options):
+        lookups = sorted({lookup for action in rules.values() for lookup in action})
+        rows = UserObjectPermission.objects.filter(content_type=content_type).order_by("pk")
+        removed = kept = 0
+        last_pk = 0
+
+        while True:
+            batch = list(rows.filter(pk__gt=last_pk).values_list(
+                "pk", "object_pk", "user_id", "permission__codename")[:options["batch_size"]])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+
+            object_pks = {int(object_pk) for _, object_pk, _, _ in batch if object_pk.isdigit()}
+            owners = {
+                values[0]: dict(zip(lookups, values[1:]))
+                for values in model._default_manager.filter(pk__in=object_pks).values_list(
+                    "pk", *lookups)
+            }
+
+            redundant = []
+            for pk, object_pk, user_id, codename in batch:
+                action = codename.split("_")[0]
+                obj_owners = owners.get(int(object_pk)) if object_pk.isdigit() else None
+                if obj_owners is None or any(
+                        obj_owners[lookup] == user_id for lookup in rules.get(action, ())):
+                    redundant.append(pk)
+                else:
+                    kept += 1
+                    if options["all"]:
+                        redundant.append(pk)
+                    if options["verbosity"] > 1:
+                        self.stdout.write("  user %s: %s on %s" % (user_id, codename, object_pk))
+
+            removed += len(redundant)
+            if not options["dry_run"]:
+                UserObjectPermission.objects.filter(pk__in=redundant).delete()
+
+        return removed, kept
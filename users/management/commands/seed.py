@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from populate import seed_database
+
+
+class Command(BaseCommand):
+    """
+    Seeds the database in bulk with manufacturers from car-models.json,
+    blueprints, wholesale cars, dealerships and customers.
+
+    Manufacturer and dealership admins get the password "admin", customers
+    get "customer".
+    """
+
+    help = "Seed the database in bulk."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--cars", type=int, default=4752,
+                            help="Number of blueprints and wholesale cars to create.")
+        parser.add_argument("--dealerships", type=int, default=12)
+        parser.add_argument("--customers", type=int, default=1)
+        parser.add_argument("--seed", type=int, default=0,
+                            help="Random seed. The same seed produces the same data.")
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        report = seed_database(
+            cars=options["cars"],
+            dealerships=options["dealerships"],
+            customers=options["customers"],
+            seed=options["seed"],
+            batch_size=options["batch_size"],
+        )
+        for line in report.lines():
+            self.stdout.write(line)
+
+        seconds = time.perf_counter() - start
+        rows = sum(report.rows.values())
+        self.stdout.write(self.style.SUCCESS(
+            "Seeded %d rows in %.2fs (%.0f rows/sec)" % (rows, seconds, rows / seconds)))
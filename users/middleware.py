@@ -0,0 +1,37 @@
+from django.utils.functional import SimpleLazyObject
+
+from .affiliation import get_affiliation
+from .permissions import PermissionCache
+
+
+class PermissionCacheMiddleware:
+    """
+    Attaches a PermissionCache to every request as request.permissions.
+
+    Must come after AuthenticationMiddleware. The cache is created on first
+    use, so requests that never check object permissions pay nothing.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.permissions = SimpleLazyObject(lambda: PermissionCache(request.user))
+        return self.get_response(request)
+
+
+class AffiliationMiddleware:
+    """
+    Attaches the manufacturer or dealership of the user to every request
+    as request.affiliation (see users.affiliation).
+
+    Must come after SessionMiddleware and AuthenticationMiddleware. It is
+    fetched on first use, with one query for the whole request.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.affiliation = SimpleLazyObject(lambda: get_affiliation(request))
+        return self.get_response(request)
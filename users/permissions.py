@@ -1,8 +1,18 @@
 """
 Permissions for everyobody YaaaY!!!."""
 
+from django.conf import settings
+from django.contrib.auth import get_backends
 from django.contrib.auth.decorators import user_passes_test
 from django.contrib.auth.mixins import UserPassesTestMixin
+from django.contrib.auth.models import Permission
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import PermissionDenied
+from guardian.backends import ObjectPermissionBackend
+from guardian.core import ObjectPermissionChecker
+from guardian.mixins import PermissionRequiredMixin
+from guardian.models import UserObjectPermission
+from guardian.shortcuts import assign_perm
 
 
 class UserIsManufacturer(UserPassesTestMixin):
@@ -37,3 +47,276 @@ class UserIsNotCustomer(UserPassesTestMixin):
     def test_func(self):
         user = self.request.user
         return user.is_authenticated and user.user_type != "CU"
+
+
+class UserIsStaff(UserPassesTestMixin):
+    def test_func(self):
+        user = self.request.user
+        return user.is_authenticated and user.is_staff
+
+
+# Object permissions derived from ownership.
+#
+# Maps each model to the actions it supports and, for each action, the
+# lookups from the object to the users allowed to perform it.
+OWNERSHIP_RULES = {
+    "deals.wholesaledeal": {
+        "view": ("dealership__admin", "car__manufacturer__admin"),
+        "change": ("car__manufacturer__admin",),
+    },
+    "deals.retaildeal": {
+        "view": ("customer", "car__dealership__admin"),
+        "change": ("car__dealership__admin",),
+    },
+    "inventory.wholesalecar": {
+        "view": ("manufacturer__admin",),
+        "change": ("manufacturer__admin",),
+        "delete": ("manufacturer__admin",),
+    },
+    "inventory.retailcar": {
+        "view": ("dealership__admin",),
+        "change": ("dealership__admin",),
+        "delete": ("dealership__admin",),
+    },
+    "blueprints.car": {
+        "view": ("manufacturer__admin",),
+        "change": ("manufacturer__admin",),
+        "delete": ("manufacturer__admin",),
+    },
+    "manufacturers.manufacturingorder": {
+        "view": ("manufacturer__admin",),
+        "change": ("manufacturer__admin",),
+    },
+}
+
+
+def get_owners(obj):
+    """
+    Returns a dict mapping each ownership lookup of obj to a user id.
+
+    All lookups are fetched with a single query and cached on the object,
+    so checking several permissions on the same object costs one query.
+    """
+
+    owners = getattr(obj, "_owners_cache", None)
+    if owners is None:
+        rules = OWNERSHIP_RULES[obj._meta.label_lower]
+        lookups = sorted({lookup for action in rules.values() for lookup in action})
+        values = type(obj)._default_manager.filter(pk=obj.pk).values_list(*lookups).first()
+        owners = dict(zip(lookups, values or [None] * len(lookups)))
+        obj._owners_cache = owners
+    return owners
+
+
+def prefetch_owners(objects):
+    """ Fills the get_owners cache of objects of one model with a single query. """
+
+    objects = [obj for obj in objects if not hasattr(obj, "_owners_cache")]
+    if not objects:
+        return
+    rules = OWNERSHIP_RULES.get(objects[0]._meta.label_lower)
+    if rules is None:
+        return
+
+    lookups = sorted({lookup for action in rules.values() for lookup in action})
+    rows = {
+        values[0]: values[1:]
+        for values in type(objects[0])._default_manager.filter(
+            pk__in=[obj.pk for obj in objects]).values_list("pk", *lookups)
+    }
+    for obj in objects:
+        obj._owners_cache = dict(zip(lookups, rows.get(obj.pk, [None] * len(lookups))))
+
+
+class OwnershipPermissionBackend:
+    """
+    Authentication backend granting object permissions from ownership.
+
+    Instead of storing a guardian row per user and object, permissions on
+    the models in OWNERSHIP_RULES are derived from the foreign keys that
+    already link each object to its dealership, manufacturer or customer.
+    Enable it in place of guardian.backends.ObjectPermissionBackend.
+    """
+
+    def authenticate(self, request, **credentials):
+        return None
+
+    def get_all_permissions(self, user_obj, obj=None):
+        if obj is None or not user_obj.is_active:
+            return set()
+        rules = OWNERSHIP_RULES.get(obj._meta.label_lower)
+        if rules is None:
+            return set()
+
+        owners = get_owners(obj)
+        return {
+            "%s.%s_%s" % (obj._meta.app_label, action, obj._meta.model_name)
+            for action, lookups in rules.items()
+            if any(owners[lookup] == user_obj.pk for lookup in lookups)
+        }
+
+    def has_perm(self, user_obj, perm, obj=None):
+        if obj is None or not user_obj.is_active:
+            return False
+        rules = OWNERSHIP_RULES.get(obj._meta.label_lower)
+        if rules is None:
+            return False
+
+        app_label, _, codename = perm.rpartition(".")
+        if app_label and app_label != obj._meta.app_label:
+            return False
+        action, _, model_name = codename.partition("_")
+        if model_name != obj._meta.model_name:
+            return False
+
+        owners = get_owners(obj)
+        return any(owners[lookup] == user_obj.pk for lookup in rules.get(action, ()))
+
+
+def guardian_enabled():
+    return "guardian.backends.ObjectPermissionBackend" in settings.AUTHENTICATION_BACKENDS
+
+
+def assign_object_perm(perm, user, obj):
+    """
+    Grants perm on obj to user with a guardian row.
+
+    Does nothing when guardian is not an authentication backend, since
+    the ownership backend does not need the rows.
+    """
+
+    if guardian_enabled():
+        assign_perm(perm, user, obj)
+
+
+def assign_object_perms(perm, model, rows):
+    """
+    Grants perm on many objects of one model with a single INSERT of
+    guardian rows. rows are (user_id, object pk) pairs; rows that already
+    exist are skipped.
+
+    Does nothing when guardian is not an authentication backend.
+    """
+
+    if not guardian_enabled() or not rows:
+        return
+    content_type = ContentType.objects.get_for_model(model)
+    permission = Permission.objects.get(content_type=content_type, codename=perm)
+    UserObjectPermission.objects.bulk_create([
+        UserObjectPermission(permission=permission, content_type=content_type,
+                             user_id=user_id, object_pk=str(pk))
+        for user_id, pk in rows
+    ], ignore_conflicts=True)
+
+
+class PermissionCache:
+    """
+    Request-scoped cache of object permission checks for one user.
+
+    Each (permission, object) pair is resolved once per request. Guardian
+    checks go through a single ObjectPermissionChecker, so prefetch() can
+    load the guardian rows for a whole list of objects with one query
+    instead of one query per object.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.results = {}
+        self._checker = None
+
+    @property
+    def checker(self):
+        if self._checker is None:
+            self._checker = ObjectPermissionChecker(self.user)
+        return self._checker
+
+    def prefetch(self, objects):
+        """ Loads the permissions of a list of objects of one model in bulk. """
+
+        objects = list(objects)
+        if not objects or not self.user.is_authenticated:
+            return
+        for backend in get_backends():
+            if isinstance(backend, ObjectPermissionBackend):
+                self.checker.prefetch_perms(objects)
+            elif isinstance(backend, OwnershipPermissionBackend):
+                prefetch_owners(objects)
+
+    def has_perm(self, perm, obj):
+        key = (perm.rpartition(".")[2], obj._meta.label_lower, obj.pk)
+        if key not in self.results:
+            self.results[key] = self._has_perm(perm, obj)
+        return self.results[key]
+
+    def _has_perm(self, perm, obj):
+        if not self.user.is_authenticated:
+            return self.user.has_perm(perm, obj)
+        if not self.user.is_active:
+            return False
+        if self.user.is_superuser:
+            return True
+
+        for backend in get_backends():
+            if isinstance(backend, ObjectPermissionBackend):
+                allowed = self.checker.has_perm(perm, obj)
+            elif hasattr(backend, "has_perm"):
+                try:
+                    allowed = backend.has_perm(self.user, perm, obj)
+                except PermissionDenied:
+                    return False
+            else:
+                continue
+            if allowed:
+                return True
+        return False
+
+
+def get_permission_cache(request):
+    """ Returns the request's PermissionCache, creating one if the middleware is not installed. """
+
+    if not hasattr(request, "permissions"):
+        request.permissions = PermissionCache(request.user)
+    return request.permissions
+
+
+class CachedPermissionRequiredMixin(PermissionRequiredMixin):
+    """
+    guardian's PermissionRequiredMixin checking object permissions through
+    the request's PermissionCache.
+
+    The object fetched for the permission check is reused by the view
+    instead of being fetched a second time.
+    """
+
+    def get_object(self, queryset=None):
+        if queryset is not None:
+            return super().get_object(queryset)
+        if not hasattr(self, "_cached_object"):
+            self._cached_object = super().get_object()
+        return self._cached_object
+
+    def check_permissions(self, request):
+        obj = self.get_permission_object()
+        if obj is None or self.accept_global_perms:
+            return super().check_permissions(request)
+
+        permissions = get_permission_cache(request)
+        perms = self.get_required_permissions(request)
+        if self.any_perm:
+            allowed = any(permissions.has_perm(perm, obj) for perm in perms)
+        else:
+            allowed = all(permissions.has_perm(perm, obj) for perm in perms)
+        if allowed:
+            return None
+        if self.raise_exception:
+            raise PermissionDenied
+        return super().check_permissions(request)
+
+
+class PrefetchPermissionsMixin:
+    """ ListView mixin warming the request's PermissionCache for the listed objects. """
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        get_permission_cache(self.request).prefetch(context["object_list"])
+        return context
@@ -0,0 +1,37 @@
+from django import template
+
+from users.permissions import get_permission_cache
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def has_object_perm(context, perm, obj):
+    """
+    Checks an object permission for the current user through the request's
+    PermissionCache.
+
+    Usage:
+        {% has_object_perm "change_wholesaledeal" deal as can_change %}
+    """
+
+    request = context.get("request")
+    if request is None:
+        return False
+    return get_permission_cache(request).has_perm(perm, obj)
+
+
+@register.simple_tag(takes_context=True)
+def prefetch_object_perms(context, objects):
+    """
+    Loads the current user's permissions on a list of objects in bulk so
+    that has_object_perm does not query the database for each of them.
+
+    Usage:
+        {% prefetch_object_perms deals %}
+    """
+
+    request = context.get("request")
+    if request is not None:
+        get_permission_cache(request).prefetch(objects)
+    return ""
@@ -1,9 +1,21 @@
-from django.test import TestCase
+from io import StringIO
+
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from guardian.models import UserObjectPermission
+from guardian.shortcuts import assign_perm
 
+from . import user_cache
+from .affiliation import SESSION_KEY
 from .models import User
+from .permissions import PermissionCache
+from blueprints.models import Car
 from dealerships.models import Dealership
-from manufacturers.models import Manufacturer
+from deals.models import RetailDeal, WholesaleDeal
+from deals.settlement import settle_retail_deal
+from inventory.models import RetailCar, WholesaleCar
+from manufacturers.models import Manufacturer, ManufacturingOrder
 
 # Create your tests here.
 
@@ -72,6 +84,18 @@ class UserDetailViewTestCase(TestCase):
         new_response = self.client.get(redirection)
         self.assertContains(new_response, "Balance: $10,000")
 
+    def test_add_balance_of_several_manufacturers(self):
+        user = User.objects.create(username="manufacturer_tester",
+            user_type=User.MANUFACTURER)
+        Manufacturer.objects.create(name="Naija Manufacturer", admin=user)
+        Manufacturer.objects.create(name="Lagos Manufacturer", admin=user)
+        self.client.force_login(user)
+        self.client.post(reverse("user:add_balance"),data={
+            "balance": 10000
+        })
+        self.assertEqual(
+            list(Manufacturer.objects.values_list("balance", flat=True)), [10000, 10000])
+
 
 
     def test_manufacturer_add_negative_balance(self):
@@ -89,3 +113,311 @@ class UserDetailViewTestCase(TestCase):
         self.assertContains(response, "Ensure this value is greater than or equal to 0")
 
 
+
+
+OWNERSHIP_BACKENDS = [
+    'django.contrib.auth.backends.ModelBackend',
+    'users.permissions.OwnershipPermissionBackend',
+]
+
+
+@override_settings(AUTHENTICATION_BACKENDS=OWNERSHIP_BACKENDS)
+class OwnershipPermissionBackendTestCase(TestCase):
+
+    def setUp(self):
+        self.manu_admin = User.objects.create(
+            username="manu_admin", user_type=User.MANUFACTURER)
+        self.dealer_admin = User.objects.create(
+            username="dealer_admin", user_type=User.DEALERSHIP)
+        self.customer = User.objects.create(
+            username="customer", user_type=User.CUSTOMER, balance=30000)
+        self.manufacturer = Manufacturer.objects.create(
+            name="Test Manufacturer", admin=self.manu_admin)
+        self.dealership = Dealership.objects.create(
+            name="Test Dealership", balance=20000, admin=self.dealer_admin)
+        self.w_car = WholesaleCar.objects.create(
+            name="Model-100", amount=30, manufacturer=self.manufacturer, wholesale_price=2000)
+        self.r_car = RetailCar.objects.create(
+            name="Model-100", amount=30, dealership=self.dealership, retail_price=2000)
+
+    def test_wholesale_deal_permissions(self):
+        deal = WholesaleDeal.objects.create(car=self.w_car, asking_price=5000, amount=5,
+                                            dealership=self.dealership)
+        self.assertTrue(self.dealer_admin.has_perm("view_wholesaledeal", deal))
+        self.assertFalse(self.dealer_admin.has_perm("change_wholesaledeal", deal))
+        self.assertTrue(self.manu_admin.has_perm("deals.view_wholesaledeal", deal))
+        self.assertTrue(self.manu_admin.has_perm("deals.change_wholesaledeal", deal))
+        self.assertFalse(self.customer.has_perm("view_wholesaledeal", deal))
+        self.assertFalse(self.manu_admin.has_perm("view_retaildeal", deal))
+        self.assertEqual(self.manu_admin.get_all_permissions(deal),
+                         {"deals.view_wholesaledeal", "deals.change_wholesaledeal"})
+
+    def test_retail_deal_permissions(self):
+        deal = RetailDeal.objects.create(car=self.r_car, asking_price=5000, amount=1,
+                                         customer=self.customer)
+        self.assertTrue(self.customer.has_perm("view_retaildeal", deal))
+        self.assertFalse(self.customer.has_perm("change_retaildeal", deal))
+        self.assertTrue(self.dealer_admin.has_perm("change_retaildeal", deal))
+        self.assertFalse(self.manu_admin.has_perm("view_retaildeal", deal))
+
+    def test_permissions_checked_with_one_query(self):
+        deal = WholesaleDeal.objects.create(car=self.w_car, asking_price=5000, amount=5,
+                                            dealership=self.dealership)
+        with self.assertNumQueries(1):
+            self.manu_admin.has_perm("view_wholesaledeal", deal)
+            self.manu_admin.has_perm("change_wholesaledeal", deal)
+            self.dealer_admin.has_perm("view_wholesaledeal", deal)
+
+    def test_deal_flow_without_guardian_rows(self):
+        self.client.force_login(self.dealer_admin)
+        self.client.post(reverse("deals:wholesale_deal_create", kwargs={"pk": self.w_car.pk}), data={
+            "car": self.w_car.pk,
+            "amount": 3,
+            "asking_price": 10000,
+        })
+        deal = WholesaleDeal.objects.get()
+        self.assertFalse(UserObjectPermission.objects.exists())
+
+        response = self.client.get(reverse("deals:wholesale_deal_detail", kwargs={"pk": deal.pk}))
+        self.assertEqual(response.status_code, 200)
+
+        self.client.force_login(self.customer)
+        response = self.client.get(reverse("deals:wholesale_deal_detail", kwargs={"pk": deal.pk}))
+        self.assertEqual(response.status_code, 403)
+
+
+class MigrateObjectPermissionsTestCase(TestCase):
+
+    @override_settings(AUTHENTICATION_BACKENDS=OWNERSHIP_BACKENDS)
+    def test_migrate_object_permissions(self):
+        manu_admin = User.objects.create(username="manu_admin", user_type=User.MANUFACTURER)
+        other = User.objects.create(username="other", user_type=User.MANUFACTURER)
+        manufacturer = Manufacturer.objects.create(name="Test Manufacturer", admin=manu_admin)
+        car = WholesaleCar.objects.create(name="Model-100", amount=30, manufacturer=manufacturer)
+        assign_perm("change_wholesalecar", manu_admin, car)
+        assign_perm("change_wholesalecar", other, car)
+
+        out = StringIO()
+        call_command("migrate_object_permissions", "--dry-run", stdout=out)
+        self.assertIn("inventory.wholesalecar: 1 rows would be removed, 1 rows not implied by ownership",
+                      out.getvalue())
+        self.assertEqual(UserObjectPermission.objects.count(), 2)
+
+        call_command("migrate_object_permissions", stdout=StringIO())
+        self.assertEqual(list(UserObjectPermission.objects.values_list("user", flat=True)), [other.pk])
+
+        call_command("migrate_object_permissions", "--all", stdout=StringIO())
+        self.assertFalse(UserObjectPermission.objects.exists())
+
+    def test_refuses_without_ownership_backend(self):
+        manu_admin = User.objects.create(username="manu_admin", user_type=User.MANUFACTURER)
+        manufacturer = Manufacturer.objects.create(name="Test Manufacturer", admin=manu_admin)
+        car = WholesaleCar.objects.create(name="Model-100", amount=30, manufacturer=manufacturer)
+        assign_perm("change_wholesalecar", manu_admin, car)
+
+        with self.assertRaises(CommandError):
+            call_command("migrate_object_permissions", "--all", stdout=StringIO())
+        self.assertEqual(UserObjectPermission.objects.count(), 1)
+
+
+class PermissionCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.manu_admin = User.objects.create(
+            username="manu_admin", user_type=User.MANUFACTURER)
+        manufacturer = Manufacturer.objects.create(name="Test Manufacturer", admin=self.manu_admin)
+        self.cars = [
+            WholesaleCar.objects.create(name="Model-%d" % i, amount=3, manufacturer=manufacturer)
+            for i in range(5)
+        ]
+        for car in self.cars[:3]:
+            assign_perm("change_wholesalecar", self.manu_admin, car)
+
+    def test_has_perm_is_cached(self):
+        permissions = PermissionCache(self.manu_admin)
+        self.assertTrue(permissions.has_perm("change_wholesalecar", self.cars[0]))
+        with self.assertNumQueries(0):
+            self.assertTrue(permissions.has_perm("change_wholesalecar", self.cars[0]))
+            self.assertTrue(permissions.has_perm("inventory.change_wholesalecar", self.cars[0]))
+
+    def test_prefetch(self):
+        permissions = PermissionCache(self.manu_admin)
+        # user and group object permissions
+        with self.assertNumQueries(2):
+            permissions.prefetch(self.cars)
+        with self.assertNumQueries(0):
+            allowed = [permissions.has_perm("change_wholesalecar", car) for car in self.cars]
+        self.assertEqual(allowed, [True, True, True, False, False])
+
+    @override_settings(AUTHENTICATION_BACKENDS=OWNERSHIP_BACKENDS)
+    def test_prefetch_ownership(self):
+        permissions = PermissionCache(self.manu_admin)
+        with self.assertNumQueries(1):
+            permissions.prefetch(self.cars)
+        with self.assertNumQueries(0):
+            self.assertTrue(all(permissions.has_perm("change_wholesalecar", car) for car in self.cars))
+
+    def test_detail_view_fetches_object_once(self):
+        self.client.force_login(self.manu_admin)
+        # car, session, user, user and group object permissions
+        with self.assertNumQueries(5):
+            response = self.client.get(
+                reverse("inventory:wholesale_detail", kwargs={"pk": self.cars[0].pk}))
+        self.assertEqual(response.status_code, 200)
+
+
+class AffiliationTestCase(TestCase):
+    """
+    Tests to ascertain that the manufacturer or dealership of a user is
+    fetched once per request, and its pk kept in the session from login
+    """
+    def setUp(self):
+        self.manu_admin = User.objects.create(username="manu_admin",user_type=User.MANUFACTURER)
+        self.manufacturer = Manufacturer.objects.create(
+            name="first_manufacturer",balance=1000,admin=self.manu_admin)
+
+    def test_pk_kept_in_session_from_login(self):
+        self.client.force_login(self.manu_admin)
+        self.assertEqual(self.client.session[SESSION_KEY], [self.manu_admin.pk, self.manufacturer.pk])
+        # session, user, blueprints
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse("manufacturers:create"))
+        self.assertEqual(response.status_code, 200)
+
+    def test_affiliation_fetched_once(self):
+        self.client.force_login(self.manu_admin)
+        # session, user, manufacturer
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse("user:add_balance"))
+        self.assertContains(response, "Manufacturer name: first_manufacturer")
+        self.assertContains(response, "Current balance: $1,000")
+
+    def test_reassigned_affiliation(self):
+        self.client.force_login(self.manu_admin)
+        other_admin = User.objects.create(username="other_admin",user_type=User.MANUFACTURER)
+        Manufacturer.objects.filter(pk=self.manufacturer.pk).update(admin=other_admin)
+        second = Manufacturer.objects.create(name="second_manufacturer",admin=self.manu_admin)
+
+        response = self.client.get(reverse("user:add_balance"))
+        self.assertContains(response, "Manufacturer name: second_manufacturer")
+        self.assertEqual(self.client.session[SESSION_KEY], [self.manu_admin.pk, second.pk])
+
+    def test_removed_admin_cannot_act_for_affiliation(self):
+        car = WholesaleCar.objects.create(name="Model-100", amount=10,
+            manufacturer=self.manufacturer)
+        dealership = Dealership.objects.create(name="first_dealership",balance=10000)
+        deal = WholesaleDeal.objects.create(car=car,asking_price=1000,amount=1,
+            dealership=dealership,manufacturer=self.manufacturer)
+        blueprint = Car.objects.create(name="Model-100",price=10,manufacturer=self.manufacturer)
+        self.client.force_login(self.manu_admin)
+        other_admin = User.objects.create(username="other_admin",user_type=User.MANUFACTURER)
+        Manufacturer.objects.filter(pk=self.manufacturer.pk).update(admin=other_admin)
+
+        response = self.client.post(reverse("deals:wholesale_deal_bulk"),
+            data={"deals": [deal.pk], "action": "accept"})
+        self.assertEqual(response.status_code, 403)
+        deal.refresh_from_db()
+        self.assertEqual(deal.status, WholesaleDeal.PENDING)
+
+        response = self.client.post(reverse("blueprints:create"),
+            data={"name": "Model-200", "price": 10})
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Car.objects.filter(name="Model-200").exists())
+
+        response = self.client.post(reverse("manufacturers:create"),
+            data={"car": blueprint.pk, "count": 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(ManufacturingOrder.objects.exists())
+
+    @override_settings(AFFILIATION_SESSION_CACHE=False)
+    def test_without_session_cache(self):
+        self.client.force_login(self.manu_admin)
+        self.assertNotIn(SESSION_KEY, self.client.session)
+        # session, user, manufacturer, blueprints
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse("manufacturers:create"))
+        self.assertEqual(response.status_code, 200)
+        # the manufacturer is fetched once for the view and the template
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse("blueprints:index"))
+        self.assertContains(response, "Manufacturer: first_manufacturer")
+
+
+@override_settings(CACHED_SESSIONS=True, SESSION_CACHE_ALIAS="sessions",
+                   SESSION_ENGINE="django.contrib.sessions.backends.cached_db")
+class UserCacheTestCase(TestCase):
+    """
+    Tests to ascertain that sessions and users are read from the cache,
+    and that users are dropped from it when their balance changes
+    """
+    def setUp(self):
+        user_cache.get_cache().clear()
+        self.customer = User.objects.create(username="customer",user_type=User.CUSTOMER,
+            balance=30000)
+        self.client.force_login(self.customer)
+
+    def test_no_auth_queries(self):
+        self.client.get(reverse("deals:to_dealerships"))
+        # deals
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("deals:to_dealerships"))
+        self.assertEqual(response.status_code, 200)
+
+    def test_add_balance(self):
+        self.assertContains(self.client.get(reverse("user:profile")), "Balance: $30,000")
+        self.client.post(reverse("user:add_balance"), data={"balance": 500})
+        self.assertContains(self.client.get(reverse("user:profile")), "Balance: $30,500")
+
+    def test_retail_deal(self):
+        dealer_admin = User.objects.create(username="dealer_admin",user_type=User.DEALERSHIP)
+        dealership = Dealership.objects.create(name="first_dealership",admin=dealer_admin)
+        car = RetailCar.objects.create(name="car",amount=2,dealership=dealership,
+            retail_price=2000)
+        deal = RetailDeal.objects.create(car=car,amount=1,asking_price=2000,
+            customer=self.customer)
+        self.assertContains(self.client.get(reverse("user:profile")), "Balance: $30,000")
+
+        settle_retail_deal(deal.pk)
+        self.assertContains(self.client.get(reverse("user:profile")), "Balance: $28,000")
+
+    def test_saved_user(self):
+        self.client.get(reverse("user:profile"))
+        self.customer.is_active = False
+        self.customer.save()
+        self.assertRedirects(self.client.get(reverse("user:profile")),
+            "/user/login/?next=%s" % reverse("user:profile"),
+            fetch_redirect_response=False)
+
+    def test_model_backend_session(self):
+        self.client.logout()
+        self.client.force_login(self.customer, backend="django.contrib.auth.backends.ModelBackend")
+        self.assertContains(self.client.get(reverse("user:profile")), "Balance: $30,000")
+
+
+class SeedCommandTestCase(TestCase):
+
+    def test_seed(self):
+        out = StringIO()
+        call_command("seed", cars=50, dealerships=14, customers=2, seed=1, stdout=out)
+        self.assertIn("Seeded", out.getvalue())
+        self.assertEqual(Car.objects.count(), 50)
+        self.assertEqual(WholesaleCar.objects.count(), 50)
+        self.assertEqual(Dealership.objects.count(), 14)
+        self.assertEqual(User.objects.filter(username__startswith="customer").count(), 2)
+        self.assertEqual(UserObjectPermission.objects.count(), 100)
+
+        acura_admin = User.objects.get(username="acura_admin")
+        self.assertTrue(acura_admin.check_password("admin"))
+        car = WholesaleCar.objects.filter(manufacturer__admin=acura_admin).first()
+        self.assertTrue(acura_admin.has_perm("change_wholesalecar", car))
+
+        # Seeding again reuses the users, manufacturers and dealerships
+        prices = list(Car.objects.order_by("pk").values_list("price", flat=True))
+        call_command("seed", cars=50, dealerships=14, customers=2, seed=1, stdout=StringIO())
+        self.assertEqual(Car.objects.count(), 100)
+        # but not the wholesale cars, which are unique per manufacturer, name and price
+        self.assertEqual(WholesaleCar.objects.count(), 50)
+        self.assertEqual(Dealership.objects.count(), 14)
+        self.assertEqual(Manufacturer.objects.filter(name="Acura").count(), 1)
+        self.assertEqual(
+            list(Car.objects.order_by("pk").values_list("price", flat=True)[50:]), prices)
@@ -0,0 +1,88 @@
+"""
+Cache of the users loaded on every request.
+
+With CACHED_SESSIONS on, CachedModelBackend (the first of the
+AUTHENTICATION_BACKENDS in settings.py) reads the logged-in user from the
+"sessions" cache instead of the users.User table, and the sessions
+themselves are read from the same cache by the cached_db session engine,
+so an authenticated request runs neither query.
+
+A user is dropped from the cache when they are saved or deleted
+(post_save / post_delete, e.g. a login, a password change or an edit in the
+admin panel) and by the code paths that update users without sending
+signals: balance top-ups (users.views.AddBalanceView) and retail deal
+settlement (deals.settlement.settle_retail_deal). Any other change shows
+up when the entry expires (USER_CACHE_TIMEOUT).
+"""
+
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from .models import User
+
+
+CACHE_ALIAS = "sessions"
+
+
+def enabled():
+    return getattr(settings, "CACHED_SESSIONS", False)
+
+
+def get_cache():
+    return caches[CACHE_ALIAS]
+
+
+def _key(pk):
+    return "user:%s" % pk
+
+
+def invalidate(*pks):
+    """
+    Drops the cached users with the given pks.
+
+    Inside a transaction they are dropped again once it commits, so a user
+    another request loaded with the uncommitted rows' old values in the
+    meantime is not served either.
+    """
+
+    if not enabled():
+        return
+    keys = [_key(pk) for pk in pks]
+    get_cache().delete_many(keys)
+
+    connection = transaction.get_connection()
+    if connection.in_atomic_block:
+        transaction.on_commit(lambda: get_cache().delete_many(keys))
+
+
+def user_changed(sender, instance, **kwargs):
+    invalidate(instance.pk)
+
+
+def connect_signals():
+    post_save.connect(user_changed, sender=User, dispatch_uid="user_cache_save")
+    post_delete.connect(user_changed, sender=User, dispatch_uid="user_cache_delete")
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    ModelBackend loading the users of sessions from the cache when
+    CACHED_SESSIONS is on; see the module docstring.
+    """
+
+    def get_user(self, user_id):
+        if not enabled():
+            return super().get_user(user_id)
+
+        cache = get_cache()
+        key = _key(user_id)
+        user = cache.get(key)
+        if user is None:
+            user = super().get_user(user_id)
+            if user is None:
+                return None
+            cache.set(key, user, getattr(settings, "USER_CACHE_TIMEOUT", 300))
+        return user if self.user_can_authenticate(user) else None
@@ -3,13 +3,17 @@ from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.db import transaction
 from django.db.models import F
 from django.shortcuts import redirect, render
 from django.views.generic import CreateView, DetailView, UpdateView, TemplateView
 
 from dealerships.models import Dealership
+from ledger import balances
+from ledger.models import Entry
 from manufacturers.models import Manufacturer
 
+from . import user_cache
 from .models import User
 
 # Create your views here.
@@ -32,15 +36,10 @@ class UserDetailView(LoginRequiredMixin, DetailView):
 
 		context = super().get_context_data(**kwargs)
 
-		user_type = self.object.user_type
-		if user_type == "MA":
-			affiliation = self.object.manufacturer_set.get()
-		elif user_type == "DE":
-			affiliation = self.object.dealership_set.get()
-		elif user_type == "CU":
-			affiliation = self.object
-
-		context["affiliation"] = affiliation
+		if self.object.user_type == User.CUSTOMER:
+			context["affiliation"] = self.object
+		else:
+			context["affiliation"] = self.request.affiliation
 		return context
 
 	def get_template_names(self):
@@ -79,7 +78,7 @@ class RegisterView(CreateView):
 
 	def form_valid(self, form):
 		user = form.save()
-		user.backend = 'django.contrib.auth.backends.ModelBackend'
+		user.backend = 'users.user_cache.CachedModelBackend'
 		login(self.request, user)
 		return redirect("user:profile")
 
@@ -156,18 +155,21 @@ def AddBalanceView(request):
 		if form.is_valid():
 			increment = form.instance.balance
 
-			if user_type == User.MANUFACTURER:
-				manufacturer = request.user.manufacturer_set.all()
-				manufacturer.update(balance=F('balance') + increment)
-			
-			elif user_type == User.DEALERSHIP:
-				dealership = request.user.dealership_set.all()
-				dealership.update(balance=F('balance') + increment)
-			
-			elif user_type == User.CUSTOMER:
-				customer = request.user
-				customer.balance = F('balance') + increment
-				customer.save()
+			with transaction.atomic():
+				if user_type == User.MANUFACTURER:
+					model = Manufacturer
+					pks = list(request.user.manufacturer_set.values_list('pk', flat=True))
+				elif user_type == User.DEALERSHIP:
+					model = Dealership
+					pks = list(request.user.dealership_set.values_list('pk', flat=True))
+				else:
+					model = User
+					pks = [request.user.pk]
+				model.objects.filter(pk__in=pks).update(balance=F('balance') + increment)
+				balances.record(*[
+					balances.entry(model, pk, increment, Entry.TOP_UP) for pk in pks])
+				if model is User:
+					user_cache.invalidate(request.user.pk)
 
 			success_url = "user:profile"
 			return redirect(success_url)